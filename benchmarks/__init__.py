@@ -0,0 +1,30 @@
+from collections import OrderedDict
+
+from .parsing import bench_parser_setup, bench_field_typing, bench_info_lookup, bench_info_decode, \
+    bench_catalog_filter, bench_listing_memory, bench_export_pipeline, bench_parallel_parse
+from .images import bench_levels, bench_levels_proxy, bench_tiled_levels, bench_image_variants, bench_watermark, \
+    bench_dedupe
+from .attachments import bench_attachment_download, bench_media_cache, bench_image_pool
+from .sync_state import bench_sync_state, bench_listing_ids
+
+BENCHMARKS = OrderedDict([
+    ('parser_setup', bench_parser_setup),
+    ('field_typing', bench_field_typing),
+    ('info_lookup', bench_info_lookup),
+    ('info_decode', bench_info_decode),
+    ('catalog_filter', bench_catalog_filter),
+    ('listing_memory', bench_listing_memory),
+    ('export_pipeline', bench_export_pipeline),
+    ('parallel_parse', bench_parallel_parse),
+    ('levels', bench_levels),
+    ('levels_proxy', bench_levels_proxy),
+    ('tiled_levels', bench_tiled_levels),
+    ('image_variants', bench_image_variants),
+    ('watermark', bench_watermark),
+    ('attachment_download', bench_attachment_download),
+    ('media_cache', bench_media_cache),
+    ('image_pool', bench_image_pool),
+    ('dedupe', bench_dedupe),
+    ('sync_state', bench_sync_state),
+    ('listing_ids', bench_listing_ids),
+])
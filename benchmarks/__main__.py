@@ -0,0 +1,7 @@
+import sys
+
+from . import BENCHMARKS
+
+# python -m benchmarks [name ...], from the root of the repository: every benchmark when no name is given
+for name in sys.argv[1:] or BENCHMARKS.keys():
+    BENCHMARKS[name]()
@@ -0,0 +1,165 @@
+import asyncio
+import os
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+
+from aiohttp import web, test_utils
+from PIL import Image
+
+from configuration import DEFAULT_IMAGE_SIZES, ImageProcessingConfiguration
+from gestionaleimmobiliare.sync_agenzia.attachments import AttachmentDownloader, AdaptiveLimit
+from gestionaleimmobiliare.sync_agenzia.media_cache import MediaCache
+from gestionaleimmobiliare.sync_agenzia.image_pool import ImageWorkerPool
+from gestionaleimmobiliare.sync_agenzia.fetch_remote import close_session
+
+from .common import mock_photo
+
+
+def bench_attachment_download(files: int = 400, tolerated: int = 4) -> None:
+
+    photo = os.urandom(32 * 1024)
+    state = {'concurrent': 0, 'rejected': 0}
+
+    @asyncio.coroutine
+    def rate_limited(request):
+        # a server answering 429 beyond a few requests at once, as the export host does
+        if state['concurrent'] >= tolerated:
+            state['rejected'] += 1
+            return web.Response(status=429)
+        state['concurrent'] += 1
+        try:
+            yield from asyncio.sleep(0.005)
+            return web.Response(body=photo)
+        finally:
+            state['concurrent'] -= 1
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = web.Application()
+    app.router.add_get('/photos/{name}', rate_limited)
+    server = test_utils.TestServer(app)
+    loop.run_until_complete(server.start_server(loop=loop))
+
+    print('{} photos from a server tolerating {} requests at once'.format(files, tolerated))
+    for label, fixed in (('fixed, 8 per host', True), ('adaptive, up to 8', False)):
+        state['rejected'] = 0
+        downloader = AttachmentDownloader(max_per_host=8, retry_base_delay=0.05, max_attempts=10)
+        if fixed:
+            downloader.limits[server.make_url('/').host + ':{}'.format(server.port)] = AdaptiveLimit(8, 8, minimum=8)
+
+        with tempfile.TemporaryDirectory() as directory:
+            downloads = [(str(server.make_url('/photos/{}.jpg'.format(i))), os.path.join(directory, '{}.jpg'.format(i)))
+                         for i in range(files)]
+            errors = loop.run_until_complete(downloader.download_all(downloads))
+
+        print('    {:<24} {:8.1f} files/s {:6d} rejected {:4d} failed'.format(
+            label, downloader.stats.files_per_second, state['rejected'], sum(e is not None for e in errors)))
+
+    close_session()
+    loop.run_until_complete(server.close())
+    loop.close()
+
+
+def bench_media_cache(photos: int = 40) -> None:
+
+    jpeg = BytesIO()
+    Image.open(BytesIO(mock_photo((1600, 1200)))).save(jpeg, 'JPEG')
+    photo = jpeg.getvalue()
+
+    @asyncio.coroutine
+    def tagged_photo(request):
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        # bytes after the end of the image make every photo a different blob
+        return web.Response(body=photo + request.match_info['name'].encode('utf-8'), headers={'ETag': '"v1"'})
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = web.Application()
+    app.router.add_get('/photos/{name}', tagged_photo)
+    server = test_utils.TestServer(app)
+    loop.run_until_complete(server.start_server(loop=loop))
+    urls = [str(server.make_url('/photos/{}.jpg'.format(i))) for i in range(photos)]
+    options = ImageProcessingConfiguration({})
+
+    @asyncio.coroutine
+    def sync(cache):
+        downloader = AttachmentDownloader()
+        digests = yield from asyncio.gather(*[downloader.download_to_cache(url, cache) for url in urls])
+        for digest in digests:
+            cache.process(digest, options, DEFAULT_IMAGE_SIZES)
+        cache.save()
+
+    print('{} photos of 1600x1200, all WordPress sizes'.format(photos))
+    with tempfile.TemporaryDirectory() as directory:
+        for label in ('first sync', 'repeated sync'):
+            started = time.monotonic()
+            loop.run_until_complete(sync(MediaCache(directory)))
+            print('    {:<24} {:8.1f} ms/photo'.format(label, (time.monotonic() - started) / photos * 1000))
+
+    close_session()
+    loop.run_until_complete(server.close())
+    loop.close()
+
+
+def bench_image_pool(photos: int = 24) -> None:
+
+    photo = mock_photo((1600, 1200))
+    options = ImageProcessingConfiguration({})
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    @asyncio.coroutine
+    def ticker(lags: list):
+        # how late the event loop runs a callback due every 10 ms
+        while True:
+            expected = loop.time() + 0.01
+            yield from asyncio.sleep(0.01)
+            lags.append(loop.time() - expected)
+
+    @asyncio.coroutine
+    def inline(cache, digests):
+        for digest in digests:
+            cache.process(digest, options, DEFAULT_IMAGE_SIZES)
+            yield from asyncio.sleep(0)
+
+    @asyncio.coroutine
+    def pooled(cache, digests, workers):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pool = ImageWorkerPool(cache, executor, 2 * workers)
+
+            @asyncio.coroutine
+            def one(digest):
+                with (yield from pool.slots):
+                    return (yield from pool.process(digest, options, DEFAULT_IMAGE_SIZES))
+
+            yield from asyncio.gather(*[one(digest) for digest in digests])
+
+    runs = [('inline', lambda c, d: inline(c, d))]
+    runs += [('pool, {} workers'.format(w), lambda c, d, w=w: pooled(c, d, w)) for w in sorted({1, 2, os.cpu_count() or 1})]
+
+    print('{} photos of 1600x1200, all WordPress sizes, {} cores'.format(photos, os.cpu_count()))
+    for label, run in runs:
+        with tempfile.TemporaryDirectory() as directory:
+            cache = MediaCache(directory)
+            digests = []
+            for i in range(photos):
+                blob = cache.temporary_path()
+                with open(blob, 'wb') as f:
+                    f.write(photo + str(i).encode('utf-8'))
+                digests.append(cache.store_blob(str(i), blob, {}))
+
+            lags = []
+            tick = loop.create_task(ticker(lags))
+            started = time.monotonic()
+            loop.run_until_complete(run(cache, digests))
+            elapsed = time.monotonic() - started
+            tick.cancel()
+            loop.run_until_complete(asyncio.wait([tick]))
+            print('    {:<24} {:8.1f} ms/photo, event loop late by {:6.1f} ms at most'.format(
+                label, elapsed / photos * 1000, max(lags, default=0) * 1000))
+
+    loop.close()
@@ -0,0 +1,57 @@
+import gc
+import os
+import timeit
+
+from io import BytesIO
+from os.path import join
+
+import numpy as np
+from PIL import Image
+
+relative_path = ['tests', 'resources']
+
+
+def read_resource(resource_name: str) -> str:
+    with open(join(*relative_path, resource_name), 'r') as f:
+        return f.read()
+
+
+def mock_export(copies: int) -> bytes:
+    xml_content = read_resource('annuncio.xml')
+    annuncio = xml_content[xml_content.index('<annuncio>'):xml_content.index('</dataset>')]
+    return bytes(xml_content.replace('</dataset>', annuncio * (copies - 1) + '</dataset>'), 'UTF-8')
+
+
+def report(title: str, timings: dict, number: int) -> None:
+    print(title)
+    for label, seconds in timings.items():
+        print('    {:<24} {:10.2f} us/call'.format(label, seconds / number * 1e6))
+
+
+def measure(function, number: int) -> float:
+    return min(timeit.repeat(function, number=number, repeat=5))
+
+
+def rss_bytes() -> int:
+    # lxml allocates through libxml2, invisible to tracemalloc: resident set size it is (Linux only)
+    gc.collect()
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def report_memory(title: str, sizes: dict, count: int) -> None:
+    print(title)
+    for label, size in sizes.items():
+        print('    {:<24} {:10.2f} KiB/listing'.format(label, size / count / 1024))
+
+
+def mock_photo(size=(4000, 3000)) -> bytes:
+
+    y, x = np.mgrid[0:size[1], 0:size[0]].astype(np.float32)
+    shapes = 125 + 45 * np.sin(x / 97.0) * np.cos(y / 61.0) + 40 * np.sin((x + y) / 211.0)
+    bands = [(shapes + noise).clip(0, 255).astype(np.uint8)
+             for noise in np.random.RandomState(0).normal(0, 3, (3, size[1], size[0])).astype(np.float32)]
+
+    jpeg = BytesIO()
+    Image.fromarray(np.dstack(bands), 'RGB').save(jpeg, 'JPEG', quality=90)
+    return jpeg.getvalue()
@@ -0,0 +1,170 @@
+import resource
+import time
+
+from collections import OrderedDict
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+import image_processing
+from image_processing import auto_level, dedupe, pipeline, watermark
+from configuration import DEFAULT_IMAGE_SIZES
+
+from .common import report, measure, mock_photo
+
+
+def legacy_lut(histogram: list, clip: int = 0) -> list:
+    # the pure Python version levels replaced, its RGB path with all_same=0 being the one that worked
+
+    def find_hi_lo(lut):
+        min_value = next(i for i in range(len(lut)) if lut[i] > clip)
+        max_value = 255 - next(i for i in range(len(lut)) if lut[::-1][i] > clip)
+        return min_value, max_value
+
+    def scale(min_value, max_value):
+        return [max(0, min(255, int((j - min_value) * (255.0 / float(max_value - min_value))))) for j in range(256)]
+
+    lut = []
+    for band in range(3):
+        lut.extend(scale(*find_hi_lo([histogram[band * 256 + i] for i in range(256)])))
+    return lut
+
+
+def bench_levels(number: int = 200) -> None:
+
+    pixels = np.random.RandomState(0).normal(128, 30, (768, 1024, 3)).clip(20, 230).astype(np.uint8)
+    image = Image.fromarray(pixels, 'RGB')
+    histogram = image.histogram()
+
+    assert legacy_lut(histogram, clip=5) == image_processing.make_lut(histogram, 'RGB', clip=5)
+
+    report('auto levels lookup table, RGB', OrderedDict([
+        ('pure Python', measure(lambda: legacy_lut(histogram, clip=5), number)),
+        ('NumPy', measure(lambda: image_processing.make_lut(histogram, 'RGB', clip=5), number)),
+        ('histogram alone', measure(image.histogram, number)),
+    ]), number)
+
+
+def bench_levels_proxy(number: int = 5) -> None:
+
+    jpeg = mock_photo()
+    image = Image.open(BytesIO(jpeg))
+    image.load()
+
+    def decoded():
+        decoded_image = Image.open(BytesIO(jpeg))
+        decoded_image.load()
+        return decoded_image
+
+    report('auto levels of a 12 MP photo', OrderedDict([
+        ('levels, full histogram', measure(lambda: image_processing.levels(image, clip=500), number)),
+        ('levels, proxy histogram', measure(lambda: image_processing.levels(
+            image, clip=500, proxy_pixels=image_processing.DEFAULT_PROXY_PIXELS), number)),
+        ('decode alone', measure(decoded, number)),
+        ('decode + levels, full', measure(lambda: image_processing.levels(decoded(), clip=500), number)),
+        ('open_levelled, draft', measure(lambda: image_processing.open_levelled(BytesIO(jpeg), clip=500), number)),
+    ]), number)
+
+
+def bench_tiled_levels(size=(12000, 9000)) -> None:
+
+    def peak_rss() -> int:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    # a scanned floor plan: white paper, grey lines
+    scan = Image.new('L', size, 235)
+    scan.paste(90, (size[0] // 4, size[1] // 4, size[0] // 2, size[1] // 2))
+    baseline = peak_rss()
+
+    # peaks never go down: the tiled engine has to come first
+    started = time.monotonic()
+    auto_level.auto_level(scan)
+    tiled = (peak_rss() - baseline, time.monotonic() - started)
+
+    started = time.monotonic()
+    image_processing.levels(scan)
+    whole = (peak_rss() - baseline, time.monotonic() - started)
+
+    print('auto levels of a {}x{} scan, {:.0f} MiB'.format(size[0], size[1], size[0] * size[1] / 2 ** 20))
+    for label, (peak, seconds) in (('tiled, in place', tiled), ('levels', whole)):
+        print('    {:<24} peak +{:8.1f} MiB {:8.3f} s'.format(label, peak / 2 ** 20, seconds))
+
+
+def bench_image_variants(number: int = 3) -> None:
+
+    jpeg = mock_photo()
+
+    def decode_per_size():
+        # every size decoded, levelled and resized from the original on its own
+        for image_size in DEFAULT_IMAGE_SIZES:
+            data = image_processing.levels(Image.open(BytesIO(jpeg)))
+            resized, box = pipeline.resize_plan(data.size, image_size)
+            variant = data.resize(resized, Image.LANCZOS)
+            if box is not None:
+                variant.crop(box)
+
+    report('WordPress sizes of a 12 MP photo', OrderedDict([
+        ('decode per size', measure(decode_per_size, number)),
+        ('single decode', measure(lambda: pipeline.process_attachment(BytesIO(jpeg), DEFAULT_IMAGE_SIZES),
+                                  number)),
+    ]), number)
+
+
+def bench_watermark(number: int = 50) -> None:
+
+    mark = Image.new('RGBA', (1200, 400), (0, 0, 0, 0))
+    mark.paste((255, 255, 255, 160), (50, 50, 1150, 350))
+    source = BytesIO()
+    mark.save(source, 'PNG')
+
+    photo = Image.new('RGB', (1024, 768), (90, 120, 150))
+    cached = watermark.Watermark(BytesIO(source.getvalue()))
+
+    def uncached():
+        # what every photo would pay without the cache
+        fresh = watermark.Watermark(BytesIO(source.getvalue()), cache_size=0)
+        fresh.apply(photo)
+
+    report('watermark on a 1024x768 variant', OrderedDict([
+        ('load and scale per photo', measure(uncached, number)),
+        ('scale per photo', measure(lambda: cached.scale(256, 'RGB'), number)),
+        ('cached, composite only', measure(lambda: cached.apply(photo), number)),
+    ]), number)
+
+
+def bench_dedupe(photos: int = 100000, number: int = 1000) -> None:
+
+    jpeg = BytesIO()
+    Image.open(BytesIO(mock_photo((1600, 1200)))).save(jpeg, 'JPEG')
+
+    def hash_photo():
+        jpeg.seek(0)
+        dedupe.dhash(jpeg)
+
+    def process_photo():
+        jpeg.seek(0)
+        pipeline.process_attachment(jpeg, DEFAULT_IMAGE_SIZES)
+
+    print('1600x1200 photo')
+    report('per photo', OrderedDict([('dhash', measure(hash_photo, 20) / 20),
+                                     ('process_attachment', measure(process_photo, 3) / 3)]), 1)
+
+    random = np.random.RandomState(0)
+    hashes = [int(h) for h in random.randint(0, 2 ** 62, photos)]
+    index = dedupe.PerceptualIndex()
+    for key, fingerprint in enumerate(hashes):
+        index.add(str(key), fingerprint)
+    queries = [hashes[i] ^ (1 << int(random.randint(0, 64))) for i in random.randint(0, photos, number)]
+
+    def linear_scan():
+        for query in queries[:10]:
+            min(hashes, key=lambda h: dedupe.hamming(h, query))
+
+    def banded():
+        for query in queries:
+            index.find(query)
+
+    print('{} hashes indexed, {} near duplicate lookups'.format(photos, number))
+    report('per lookup', OrderedDict([('linear_scan', measure(linear_scan, 1) / 10),
+                                      ('banded', measure(banded, 1) / number)]), 1)
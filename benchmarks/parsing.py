@@ -0,0 +1,258 @@
+import asyncio
+import os
+import tarfile
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from io import BytesIO
+
+from aiohttp import web, test_utils
+from lxml import objectify
+
+from gestionaleimmobiliare.sync_agenzia.agent import SyncInterpreter, DateElement, FIELD_TYPES
+from gestionaleimmobiliare.sync_agenzia.fetch_remote import GIFetch, ChunkPipe, TarFile, close_session
+from gestionaleimmobiliare.sync_agenzia.feature_matrix import FeatureMatrix
+from gestionaleimmobiliare.sync_agenzia.mapping.info_inserite import InfoInserita, EnergyLabel
+from gestionaleimmobiliare.sync_agenzia.mapping.decode import decode_info_inserite
+
+from .common import read_resource, mock_export, report, measure, rss_bytes, report_memory
+
+
+def bench_parser_setup(number: int = 2000) -> None:
+
+    xml_bytes = bytearray(read_resource('annuncio.xml'), 'UTF-8')
+
+    def fresh_setup():
+        return SyncInterpreter.build_parser()
+
+    def fresh_parse():
+        objectify.parse(BytesIO(xml_bytes), parser=fresh_setup())
+
+    def cached_parse():
+        objectify.parse(BytesIO(xml_bytes), parser=SyncInterpreter.get_parser())
+
+    report('per-document parser overhead', OrderedDict([
+        ('setup, rebuilt', measure(fresh_setup, number)),
+        ('setup, cached', measure(SyncInterpreter.get_parser, number)),
+        ('parse, rebuilt parser', measure(fresh_parse, number)),
+        ('parse, cached parser', measure(cached_parse, number)),
+    ]), number)
+
+
+def bench_field_typing(number: int = 5) -> None:
+
+    xml_bytes = mock_export(500)
+
+    def check_date(text):
+        datetime.strptime(text, DateElement.date_format)
+
+    # type guessing as done before FIELD_TYPES: every leaf goes through the registered PyTypes
+    guessing_parser = objectify.makeparser(remove_blank_text=True)
+    guessing_lookup = SyncInterpreter.build_lookup()
+    for tag_name in FIELD_TYPES:
+        del guessing_lookup.get_namespace(None)[tag_name]
+    guessing_parser.set_element_class_lookup(guessing_lookup)
+
+    def typed_leaves(parser):
+        # element classes are resolved when the proxies are first created
+        for _ in objectify.parse(BytesIO(xml_bytes), parser=parser).iter():
+            pass
+
+    typing_timings = OrderedDict([
+        ('schema typing', measure(lambda: typed_leaves(SyncInterpreter.get_parser()), number)),
+    ])
+
+    date_type = objectify.PyType('date', check_date, DateElement)
+    date_type.register()
+    typing_timings['strptime type guessing'] = measure(lambda: typed_leaves(guessing_parser), number)
+    date_type.unregister()
+
+    report('parse and type 500 listings', typing_timings, number)
+
+
+def bench_info_lookup(number: int = 200) -> None:
+
+    annuncio = SyncInterpreter.parse_xml(read_resource('annuncio.xml')).getroot().annuncio
+
+    # every lookup goes through attribute access, as callers do: lxml hands out a new proxy each time
+    def linear_lookups():
+        for info_inserita in InfoInserita:
+            for info in annuncio.info_inserite.iterchildren():
+                if info.id == info_inserita.value:
+                    break
+
+    def path_lookups():
+        for info_inserita in InfoInserita:
+            annuncio.info_inserite[info_inserita]
+
+    def index_lookups():
+        index = annuncio.info_inserite.id_index()
+        for info_inserita in InfoInserita:
+            index.get(info_inserita.value)
+
+    report('look up every InfoInserita of a listing', OrderedDict([
+        ('linear scan', measure(linear_lookups, number)),
+        ('find by id attribute', measure(path_lookups, number)),
+        ('one id_index()', measure(index_lookups, number)),
+    ]), number)
+
+
+def bench_info_decode(number: int = 200) -> None:
+
+    info_inserite = SyncInterpreter.parse_xml(read_resource('annuncio.xml')).getroot().annuncio.info_inserite
+
+    def enum_decode():
+        # per info enum construction, as InfoElement did before the decode table
+        decoded = {}
+        for info in info_inserite.iterchildren():
+            information_type = InfoInserita(int(info.get('id')))
+            decoded[information_type] = information_type.mapped_value(info.valore_assegnato.pyval)
+            information_type.keep_in_list(info.valore_assegnato.pyval)
+        return decoded
+
+    def table_decode():
+        return decode_info_inserite(info_inserite)
+
+    report('decode the info_inserite of a listing', OrderedDict([
+        ('enum per info', measure(enum_decode, number)),
+        ('decode table', measure(table_decode, number)),
+    ]), number)
+
+
+def bench_catalog_filter(count: int = 20000, number: int = 20) -> None:
+
+    records = list(SyncInterpreter.iter_records(BytesIO(mock_export(1)))) * count
+    catalog = FeatureMatrix.from_records(records)
+    energy_labels = (EnergyLabel.A4, EnergyLabel.A3, EnergyLabel.A2, EnergyLabel.A1,
+                     EnergyLabel.A_plus_passiva, EnergyLabel.A, EnergyLabel.B, EnergyLabel.C)
+    energy_values = {energy_label.value for energy_label in energy_labels}
+
+    def record_loop():
+        return [record.info.id for record in records
+                if record.info_inserita(InfoInserita.garage)
+                and record.info_inserita(InfoInserita.ascensore)
+                and record.info_inserita(InfoInserita.classe_energetica) in energy_values]
+
+    def vectorized():
+        mask = catalog.has(InfoInserita.garage, InfoInserita.ascensore) \
+            & catalog.isin(InfoInserita.classe_energetica, *energy_labels)
+        return catalog.select(mask)
+
+    report('filter {} listings on garage, ascensore and classe_energetica'.format(count), OrderedDict([
+        ('python loop on records', measure(record_loop, number)),
+        ('feature matrix', measure(vectorized, number)),
+    ]), number)
+
+
+def bench_listing_memory(count: int = 2000) -> None:
+
+    xml_bytes = mock_export(count)
+    sizes = OrderedDict()
+
+    baseline = rss_bytes()
+    records = list(SyncInterpreter.iter_records(BytesIO(xml_bytes)))
+    sizes['AnnuncioRecord'] = rss_bytes() - baseline
+    del records
+
+    baseline = rss_bytes()
+    annunci = list(objectify.parse(BytesIO(xml_bytes), parser=SyncInterpreter.get_parser()).getroot().iterchildren())
+    sizes['objectify tree'] = rss_bytes() - baseline
+    del annunci
+
+    report_memory('memory held per listing', sizes, count)
+
+
+def bench_export_pipeline(members: int = 4, copies: int = 500, bytes_per_second: int = 64 * 1024) -> None:
+
+    xml_bytes = mock_export(copies)
+    export = BytesIO()
+    with tarfile.open(fileobj=export, mode='w:gz') as archive:
+        for member in range(members):
+            info = tarfile.TarInfo('export/{}.xml'.format(member))
+            info.size = len(xml_bytes)
+            archive.addfile(info, BytesIO(xml_bytes))
+    tarball = export.getvalue()
+
+    @asyncio.coroutine
+    def throttled_export(request):
+        # a slow link: the download must dominate for the overlap to show
+        response = web.StreamResponse()
+        yield from response.prepare(request)
+        for start in range(0, len(tarball), 4096):
+            response.write(tarball[start:start + 4096])
+            yield from asyncio.sleep(4096 / bytes_per_second)
+        yield from response.write_eof()
+        return response
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    app = web.Application()
+    app.router.add_get('/export', throttled_export)
+    server = test_utils.TestServer(app)
+    loop.run_until_complete(server.start_server(loop=loop))
+    url = str(server.make_url('/export'))
+
+    @asyncio.coroutine
+    def sequential(first):
+        archive = yield from GIFetch(url).fetch_all()
+        with archive:
+            for _, xml_file in archive.extract_xml_files():
+                for _ in SyncInterpreter.iter_records(xml_file):
+                    first.append(time.monotonic())
+
+    @asyncio.coroutine
+    def pipelined(first):
+        fetch = GIFetch(url)
+        pipe = ChunkPipe()
+        response = yield from fetch.request_export()
+        yield from asyncio.gather(
+            fetch.stream_remote_tarball(response, pipe),
+            loop.run_in_executor(None, SyncInterpreter.parse_stream, pipe,
+                                 lambda record: record is not None and first.append(time.monotonic())))
+
+    print('export of {} listings, {:.0f} KiB gzipped'.format(members * copies, len(tarball) / 1024))
+    for label, pipeline in (('download, then parse', sequential), ('pipelined', pipelined)):
+        timestamps = []
+        started = time.monotonic()
+        loop.run_until_complete(pipeline(timestamps))
+        print('    {:<24} first listing {:8.3f} s, all {:8.3f} s'.format(label,
+                                                                          timestamps[0] - started,
+                                                                          timestamps[-1] - started))
+
+    close_session()
+    loop.run_until_complete(server.close())
+    loop.close()
+
+
+def bench_parallel_parse(members: int = 16, copies: int = 250) -> None:
+
+    xml_bytes = mock_export(copies)
+    export = BytesIO()
+    with tarfile.open(fileobj=export, mode='w') as archive:
+        for member in range(members):
+            info = tarfile.TarInfo('export/{}.xml'.format(member))
+            info.size = len(xml_bytes)
+            archive.addfile(info, BytesIO(xml_bytes))
+    tarball = export.getvalue()
+
+    def serial():
+        with TarFile(tarball) as tar:
+            for _, xml_file in tar.extract_xml_files():
+                for _ in SyncInterpreter.iter_records(xml_file):
+                    pass
+
+    def parallel(executor):
+        with TarFile(tarball) as tar:
+            for _ in SyncInterpreter.map_xml_files(tar.extract_xml_files(), executor):
+                pass
+
+    timings = OrderedDict([('serial', measure(serial, 1))])
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        with ProcessPoolExecutor(workers) as executor:
+            parallel(executor)  # warm up the workers and their parsers
+            timings['{} workers'.format(workers)] = measure(lambda: parallel(executor), 1)
+
+    print('{} cores'.format(os.cpu_count()))
+    report('parse of {} files of {} listings'.format(members, copies), timings, members * copies)
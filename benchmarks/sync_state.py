@@ -0,0 +1,76 @@
+import os
+import tempfile
+import time
+
+from collections import OrderedDict
+from os.path import join
+
+import numpy as np
+
+from configuration import db_access
+from gestionaleimmobiliare.sync_agenzia.agent import SyncInterpreter
+from gestionaleimmobiliare.sync_agenzia.sync_state import SyncStateStore
+from gestionaleimmobiliare.sync_agenzia.listing_ids import ListingIdIndex
+
+from .common import relative_path, report, measure
+
+
+def bench_sync_state(listings: int = 20000, edited: int = 200) -> None:
+
+    record = SyncInterpreter.iter_records(join(*relative_path, 'annuncio.xml')).__next__()
+    first = [record._replace(info=record.info._replace(id=i)) for i in range(listings)]
+    second = [r._replace(info=r.info._replace(price=1)) if r.info.id < edited else r for r in first]
+
+    print('{} listings, {} edited between syncs'.format(listings, edited))
+    with tempfile.TemporaryDirectory() as directory:
+        database = db_access.sync_state_initialize(join(directory, 'sync_state.sqlite'))
+        database.create_tables([db_access.LocalListingSyncState])
+
+        for label, records in (('first sync', first), ('delta sync', second)):
+            started = time.monotonic()
+            store = SyncStateStore('Rome agency', db_access.LocalListingSyncState)
+            store.load()
+            for r in records:
+                store.classify(r)
+            counts = store.counts()
+            store.commit()
+            print('    {:<24} {:8.1f} ms  {}'.format(label, (time.monotonic() - started) * 1000,
+                                                     ', '.join('{} {}'.format(n, c.value) for c, n in counts.items())))
+        database.close()
+
+
+def bench_listing_ids(listings: int = 200000, churn: int = 2000, number: int = 5) -> None:
+
+    random = np.random.RandomState(0)
+    published = np.unique(random.choice(10 * listings, listings, replace=False)).astype(np.int64)
+    exported = np.union1d(published[churn:], np.arange(10 * listings, 10 * listings + churn, dtype=np.int64))
+    deleted = np.zeros(len(exported), dtype=bool)
+    archived = np.zeros(len(exported), dtype=bool)
+    deleted[random.choice(len(exported), churn, replace=False)] = True
+    archived[random.choice(len(exported), churn, replace=False)] = True
+    archived &= ~deleted
+    index = ListingIdIndex(published)
+
+    published_set = set(published.tolist())
+    rows = list(zip(exported.tolist(), deleted.tolist(), archived.tolist()))
+
+    def sets():
+        exported_set = {listing_id for listing_id, _, _ in rows}
+        removed = published_set - exported_set
+        deleted_ids = {listing_id for listing_id, d, _ in rows if d and listing_id in published_set}
+        archived_ids = {listing_id for listing_id, _, a in rows if a and listing_id in published_set}
+        return removed, deleted_ids, archived_ids
+
+    def vectorized():
+        return index.diff(exported, deleted, archived)
+
+    print('{} listings published, {} of each kind of change'.format(listings, churn))
+    report('per diff', OrderedDict([('python_sets', measure(sets, number)),
+                                    ('searchsorted', measure(vectorized, number))]), number)
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = join(directory, 'index.npy')
+        index.save(file_path)
+        print('    {:<24} {:10d} bytes, loaded in {:.2f} ms'.format(
+            'saved index', os.path.getsize(file_path),
+            measure(lambda: ListingIdIndex.load(file_path), number) / number * 1000))
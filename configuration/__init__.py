@@ -3,12 +3,26 @@ import os
 import yaml
 
 from collections import OrderedDict
-from typing import List, Union, Optional
+from typing import List, NamedTuple, Union, Optional
 from threading import RLock
 
 from .db_access import db_initialize, JobGlobalOption, AgencySyncConfiguration
 
 
+class ImageSize(NamedTuple):
+    name: str
+    width: int  # 0 for no limit
+    height: int  # 0 for no limit
+    crop: bool
+
+
+# the sizes of a stock WordPress install
+DEFAULT_IMAGE_SIZES = (ImageSize('thumbnail', 150, 150, True),
+                       ImageSize('medium', 300, 300, False),
+                       ImageSize('medium_large', 768, 0, False),
+                       ImageSize('large', 1024, 1024, False))
+
+
 class ImageProcessingConfiguration:
 
     def __init__(self, processing_opts: dict):
@@ -26,6 +40,10 @@ class ImageProcessingConfiguration:
     def apply_watermark(self) -> bool:
         return self.processing_opts.get('apply_watermark', False)
 
+    @property
+    def watermark_path(self) -> Optional[str]:
+        return self.processing_opts.get('watermark_path')
+
     def __eq__(self, other):
 
         if other is self:
@@ -33,7 +51,10 @@ class ImageProcessingConfiguration:
         elif other is None or type(other) is not ImageProcessingConfiguration:
             return False
 
-        return self.processing_opts == other.processing_opts
+        return self.resize == other.resize \
+            and self.normalize == other.normalize \
+            and self.apply_watermark == other.apply_watermark \
+            and self.watermark_path == other.watermark_path
 
     def __repr__(self):
         return self.__str__()
@@ -53,7 +74,7 @@ class AgencyConfiguration:
                                  conf['export_url'],
                                  conf.get('homepage'),
                                  {k: bool(v) for k, v in conf['options'].items()},
-                                 {k: bool(v) for k, v in conf['image'].items()})
+                                 {k: v if isinstance(v, str) else bool(v) for k, v in conf['image'].items()})
 
         elif conf_type == AgencySyncConfiguration:
             self.__set_internals(conf.agency_description,
@@ -101,6 +122,8 @@ class AgencyConfiguration:
 class LocalConfiguration:
 
     DEFAULT_TIMEOUT = 30
+    DEFAULT_MAX_CONCURRENT_SYNCS = 4
+    DEFAULT_PARSE_WORKERS = 1
 
     def __init__(self, base_config: dict, agencies_config: List[AgencySyncConfiguration] = None):
 
@@ -129,6 +152,38 @@ class LocalConfiguration:
         except (KeyError, TypeError):  # conf value not found or value not valid
             return self.DEFAULT_TIMEOUT
 
+    @property
+    def max_concurrent_syncs(self) -> int:
+        try:
+            return max(1, int(self.base_config['max_concurrent_syncs']))
+        except (KeyError, TypeError, ValueError):  # conf value not found or value not valid
+            return self.DEFAULT_MAX_CONCURRENT_SYNCS
+
+    @property
+    def parse_workers(self) -> int:
+        try:
+            return max(1, int(self.base_config['parse_workers']))
+        except (KeyError, TypeError, ValueError):  # conf value not found or value not valid
+            return self.DEFAULT_PARSE_WORKERS
+
+    @property
+    def image_sizes(self) -> List[ImageSize]:
+        sizes = self.base_config.get('image_sizes')
+        if sizes is None:
+            return list(DEFAULT_IMAGE_SIZES)
+
+        try:
+            if isinstance(sizes, str):  # options stored in the database are plain strings
+                sizes = json.loads(sizes)
+            return [ImageSize(name, int(size.get('width', 0)), int(size.get('height', 0)), bool(size.get('crop', 0)))
+                    for name, size in sizes.items()]
+        except (AttributeError, TypeError, ValueError):  # conf value not valid
+            return list(DEFAULT_IMAGE_SIZES)
+
+    @property
+    def cache_directory(self) -> Optional[str]:
+        return self.base_config.get('cache_directory')
+
     @property
     def agencies_configuration(self) -> List[AgencyConfiguration]:
         return self.agencies_conf
@@ -142,6 +197,10 @@ class LocalConfiguration:
 
         return self.gi_homepage == other.gi_homepage \
             and self.connection_timeout == other.connection_timeout \
+            and self.max_concurrent_syncs == other.max_concurrent_syncs \
+            and self.parse_workers == other.parse_workers \
+            and self.image_sizes == other.image_sizes \
+            and self.cache_directory == other.cache_directory \
             and self.agencies_conf == other.agencies_conf
 
     def __repr__(self):
@@ -149,9 +208,11 @@ class LocalConfiguration:
 
     def __str__(self):
         return '<configuration.LocalConfiguration ' \
-               'hp={hp} timeout={timeout}, ' \
+               'hp={hp} timeout={timeout}, max_concurrent_syncs={syncs}, parse_workers={workers}, ' \
                'agencies_configuration={agencies}>'.format(hp=self.gi_homepage,
                                                            timeout=self.connection_timeout,
+                                                           syncs=self.max_concurrent_syncs,
+                                                           workers=self.parse_workers,
                                                            agencies=self.agencies_conf)
 
 
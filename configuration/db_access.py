@@ -5,6 +5,8 @@ import peewee
 from typing import List
 
 db_proxy = peewee.Proxy()
+# the SQLite file keeping the sync state when the configuration does not come from a database
+sync_state_proxy = peewee.Proxy()
 
 
 class BaseDBConfiguration(peewee.Model):
@@ -63,6 +65,7 @@ class AgencySyncConfiguration(BaseDBConfiguration):
     image_resize = peewee.BooleanField(default=True, null=False)
     image_normalize = peewee.BooleanField(default=True, null=False)
     image_apply_watermark = peewee.BooleanField(default=False, null=False)
+    image_watermark_path = peewee.CharField(max_length=255, null=True)
 
     def __str__(self):
         return AgencySyncConfiguration.string_format.format(o=self)
@@ -86,6 +89,34 @@ class AgencySyncConfiguration(BaseDBConfiguration):
         return {key[len(prefix):]: getattr(self, key) for key, value in opt_fields if key.startswith(prefix)}
 
 
+class ListingSyncState(BaseDBConfiguration):
+    """
+    What the last sync of an agency saw of each of its listings.
+    """
+
+    class Meta:
+        db_table = os.getenv('GISYNC_LISTING_STATE_TABLE', 'listing_sync_state')
+        indexes = ((('agency_description', 'listing_id'), True),)
+
+    id_listing_sync_state = peewee.PrimaryKeyField()
+
+    agency_description = peewee.CharField(max_length=255, null=False)
+    listing_id = peewee.IntegerField(null=False)
+    last_editor_time = peewee.DateTimeField(null=True)
+    content_hash = peewee.CharField(max_length=40, null=False)
+
+
+class LocalListingSyncState(ListingSyncState):
+    """
+    ListingSyncState kept in a SQLite file of its own, see sync_state_initialize().
+    """
+
+    class Meta:
+        database = sync_state_proxy
+        db_table = ListingSyncState._meta.db_table
+        schema = None  # SQLite files hold a single schema
+
+
 def __get_postgres_connection(db_type: str, **kwargs) -> peewee.Database:
     return peewee.PostgresqlDatabase(**kwargs)
 
@@ -122,6 +153,20 @@ def db_initialize(settings: dict) -> peewee.Database:
     return database
 
 
+def sync_state_initialize(file_path: str) -> peewee.Database:
+    """
+    Keeps the sync state in a SQLite file, through LocalListingSyncState, when the configuration
+    does not come from a database.
+
+    :param file_path: the SQLite file, created when missing
+    :return: the database
+    """
+    database = peewee.SqliteDatabase(file_path)
+    sync_state_proxy.initialize(database)
+
+    return database
+
+
 def global_options(opt_prefix: str) -> peewee._ModelQueryResultWrapper:
     return JobGlobalOption.select().where(JobGlobalOption.option_name ** '{}%'.format(opt_prefix)).execute()
 
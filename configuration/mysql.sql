@@ -31,6 +31,21 @@ CREATE TABLE `agency_sync_configuration` (
   `image_resize` BOOLEAN NOT NULL DEFAULT TRUE,
   `image_normalize` BOOLEAN NOT NULL DEFAULT TRUE,
   `image_apply_watermark` BOOLEAN NOT NULL DEFAULT FALSE,
+  `image_watermark_path` VARCHAR(255) NULL,
   PRIMARY KEY `job_configuration` (`id_agency_job_configuration`),
   UNIQUE INDEX `agency_description_uq` (`agency_description` ASC));
   UNIQUE INDEX `export_url_uq` (`export_url` ASC));
+
+
+-- MySQL script for the sync state table
+
+DROP TABLE `listing_sync_state`;
+
+CREATE TABLE `listing_sync_state` (
+  `id_listing_sync_state` INTEGER NOT NULL AUTO_INCREMENT,
+  `agency_description` VARCHAR(255) NOT NULL,
+  `listing_id` INTEGER NOT NULL,
+  `last_editor_time` DATETIME NULL,
+  `content_hash` VARCHAR(40) NOT NULL,
+  PRIMARY KEY `listing_sync_state_pk` (`id_listing_sync_state`),
+  UNIQUE INDEX `listing_sync_state_agency_listing_uq` (`agency_description` ASC, `listing_id` ASC));
@@ -47,6 +47,7 @@ CREATE TABLE agency_job_configuration
     image_resize boolean NOT NULL DEFAULT true,
     image_normalize boolean NOT NULL DEFAULT true,
     image_apply_watermark boolean NOT NULL DEFAULT false,
+    image_watermark_path character varying(255),
 )
 WITH (
     OIDS = FALSE
@@ -61,3 +62,25 @@ ALTER TABLE agency_job_configuration
 ALTER TABLE agency_job_configuration
     ADD CONSTRAINT agency_job_configuration_agency_description_uq UNIQUE (agency_description);
 
+
+-- PostgreSQL script for the sync state table
+
+DROP TABLE IF EXISTS listing_sync_state;
+
+CREATE TABLE listing_sync_state
+(
+    id_listing_sync_state serial NOT NULL,
+    agency_description character varying(255) NOT NULL,
+    listing_id integer NOT NULL,
+    last_editor_time timestamp without time zone,
+    content_hash character varying(40) NOT NULL
+)
+WITH (
+    OIDS = FALSE
+);
+
+ALTER TABLE listing_sync_state
+    ADD CONSTRAINT listing_sync_state_pk PRIMARY KEY (id_listing_sync_state);
+
+ALTER TABLE listing_sync_state
+    ADD CONSTRAINT listing_sync_state_agency_listing_uq UNIQUE (agency_description, listing_id);
@@ -1,95 +1,545 @@
+import enum
+import itertools
 import urllib.parse
 
+from asyncio import coroutine, get_event_loop, gather, ensure_future, run_coroutine_threadsafe, AbstractEventLoop, \
+    Future, Queue, Semaphore
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
 from io import BytesIO
+from threading import local
 from datetime import datetime
-from typing import Union, Optional
+from typing import Union, Optional, BinaryIO, Iterator, Dict, Callable, Iterable, List, Sequence, Set, Tuple, \
+    Generator
 from lxml import objectify
 from lxml import etree
 
+from configuration import AgencyConfiguration, ImageSize
+from .attachments import AttachmentDownloader
+from .fetch_remote import GIFetch, HttpValidators, ChunkPipe, iter_streamed_xml_files, DEFAULT_CHUNK_SIZE
 from .mapping.info_inserite import InfoInserita
+from .mapping.decode import InfoDecoder, decoder_for, decode_value
 from .mapping.dati_disponibili import DatoDisponibile
+from .records import AnnuncioRecord, InfoRecord, Flag, DATE_FORMAT, nullable, parse_date, parse_flag
+from .sync_state import ListingChange, SyncStateStore
+from .listing_ids import ExportIds, ListingIdIndex
+from .image_pool import ImageWorkerPool
+
+# records parsed ahead of the sync, the parsing thread waits beyond that
+DEFAULT_MAX_PENDING_RECORDS = 1024
+# listings whose photos are processed at once, the records wait beyond that
+DEFAULT_MAX_PHOTO_LISTINGS = 16
+
+
+class PhotoTasks:
+    """
+    The photo processing of the listings of a sync, at most max_listings at once.
+
+    Listings wait for a free slot before their processing starts: the records wait with them,
+    and so does the parsing behind the records, instead of piling up as pending tasks.
+    """
+
+    def __init__(self, max_listings: int = DEFAULT_MAX_PHOTO_LISTINGS):
+        self.slots = Semaphore(max_listings)
+        self.pending = set()  # type: Set[Future]
+        self.listings = 0
+        self.failed = []  # type: List[int]
+
+    @coroutine
+    def schedule(self, record: AnnuncioRecord, process: Callable[[AnnuncioRecord], Generator]) -> None:
+        """
+        Waits for a free slot, then starts processing the photos of a listing.
+
+        :param record: the listing
+        :param process: returns the coroutine processing the photos, telling whether all of them were processed
+        """
+        yield from self.slots.acquire()
+        self.listings += 1
+        task = ensure_future(self.track(record.info.id, process(record)))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    @coroutine
+    def track(self, listing_id: int, processing: Generator) -> None:
+        try:
+            if not (yield from processing):
+                self.failed.append(listing_id)
+        finally:
+            self.slots.release()
 
+    @coroutine
+    def wait(self) -> None:
+        yield from gather(*self.pending)
 
-SYNC_AGENZIA_FAKE_NS = 'http://gestionaleimmobiliare.it/export/sync_agenzia'
+    def cancel(self) -> None:
+        for task in self.pending:
+            task.cancel()
 
 
 class SyncAgenziaAgent:
 
-    def __init__(self, config: dict):
-
-        self.homepage = config['homepage']
-        self.description = config['description']
+    def __init__(self,
+                 config: AgencyConfiguration,
+                 connection_timeout: int = 10,
+                 validators: HttpValidators = None,
+                 parse_executor: Executor = None,
+                 sync_state: SyncStateStore = None,
+                 listing_index_path: str = None,
+                 image_pool: ImageWorkerPool = None,
+                 downloader: AttachmentDownloader = None,
+                 image_sizes: Sequence[ImageSize] = (),
+                 parse_threads: Executor = None):
+        """
+        :param config: the agency configuration
+        :param connection_timeout: seconds before giving up on the export server
+        :param validators: the validators of the previous downloads, to skip unchanged exports
+        :param parse_executor: a process pool parsing the xml files of the export after the first one in parallel,
+                               when None they are parsed one after the other in a thread
+        :param sync_state: what the last sync saw of the listings, when None every listing is new
+        :param listing_index_path: the file keeping the ids of the published listings between syncs,
+                                   when None nothing is ever unpublished
+        :param image_pool: where the photos of new and changed listings are processed, when None they are not
+        :param downloader: the downloader fetching the photos, it can be shared by the agents
+        :param image_sizes: the sizes rendered of every photo
+        :param parse_threads: the threads parsing the exports, one for each sync running at once,
+                              when None every sync starts its own. The parsing holds its thread for the
+                              whole download, which waits on the default executor: it cannot share it
+        """
+        self.homepage = config.homepage
+        self.description = config.description
+        self.connection_timeout = connection_timeout
+        self.validators = validators
+        self.parse_executor = parse_executor
+        self.sync_state = sync_state
+        self.listing_index_path = listing_index_path
+        self.image_pool = image_pool
+        self.downloader = downloader if downloader is not None or image_pool is None else AttachmentDownloader()
+        self.image_sizes = image_sizes
+        self.image_processing = config.image_processing
+        self.parse_threads = parse_threads
 
         # add optional parameters to connection url and rebuild de result
-        url_parts = list(urllib.parse.urlparse(config['export_url']))
+        url_parts = list(urllib.parse.urlparse(config.export_url))
         query_part = dict(urllib.parse.parse_qsl(url_parts[4]))
-        query_part.update({k: v for k, v in config['options'].items() if v})
+        query_part.update({k: int(v) for k, v in config.sync_options.items() if v})
         url_parts[4] = urllib.parse.urlencode(query_part)
 
         # save result
         self.connection_url = urllib.parse.urlunparse(url_parts)
 
+    @coroutine
     def synchronize_wordpress(self):
         print('starting connection to {}'.format(self.connection_url))
 
+        fetch = GIFetch(self.connection_url, self.connection_timeout, self.validators)
+        response = yield from fetch.request_export()
+
+        if response is None:
+            print('{} export not modified since last sync'.format(self.description))
+            return
+
+        loop = get_event_loop()
+        if self.sync_state is not None:
+            yield from loop.run_in_executor(None, self.sync_state.load)
 
+        # download, decompression and parsing overlap: listings come out as soon as their xml arrives
+        records = Queue(maxsize=DEFAULT_MAX_PENDING_RECORDS)
+        pipe = ChunkPipe()
+        export_ids = ExportIds()
+        photos = PhotoTasks()
+        parse_threads = self.parse_threads if self.parse_threads is not None else ThreadPoolExecutor(1)
+
+        try:
+            _, _, listings = yield from gather(
+                fetch.stream_remote_tarball(response, pipe),
+                loop.run_in_executor(parse_threads, SyncInterpreter.parse_stream, pipe,
+                                     self.blocking_put(records, loop), self.parse_executor, export_ids.skipped),
+                self.consume_records(records, export_ids, photos))
+            yield from photos.wait()
+        except BaseException:
+            photos.cancel()
+            raise
+        finally:
+            if parse_threads is not self.parse_threads:
+                parse_threads.shutdown(wait=False)
+
+        print('{} export holds {} listings'.format(self.description, listings))
+
+        # far more likely a failure of the export than an agency with nothing left to sell: nothing is committed,
+        # the export is downloaded again next time and nothing gets unpublished meanwhile
+        if listings == 0:
+            print('{} export is empty, keeping the state of the last sync'.format(self.description))
+            return
+
+        # listings whose photos failed are processed again next time, as changed
+        failed = photos.failed
+        if self.image_pool is not None:
+            print('{} photos of {} listings processed, {} failed'.format(self.description, photos.listings,
+                                                                         len(failed)))
+
+        if self.sync_state is not None:
+            for listing_id in failed:
+                self.sync_state.invalidate(listing_id)
+
+            counts = self.sync_state.counts()
+            print('{} listings: {}'.format(self.description,
+                                           ', '.join('{} {}'.format(counts[change], change.value)
+                                                     for change in ListingChange)))
+            yield from loop.run_in_executor(None, self.sync_state.commit)
+
+        if self.listing_index_path is not None and None in export_ids.skipped:
+            # a listing of unknown id could be any of the published ones: none can be told removed
+            print('{} export holds listings without a readable id, nothing gets unpublished'.format(self.description))
+        elif self.listing_index_path is not None:
+            index = ListingIdIndex.load(self.listing_index_path)
+            changes = index.diff(*export_ids.arrays(), skipped=export_ids.skipped_ids())
+            print('{} listings to unpublish: {} removed, {} deleted, {} archived'.format(
+                self.description, len(changes.removed), len(changes.deleted), len(changes.archived)))
+            ListingIdIndex(changes.published).save(self.listing_index_path)
+
+        # last: from here on the export is answered with 304, a failure above must leave it to be synced again,
+        # and so must photos that failed, or the listings invalidated above would wait for the export to change
+        if failed:
+            print('{} export to be synced again for the photos that failed'.format(self.description))
+        else:
+            fetch.commit_validators()
+
+    @staticmethod
+    def blocking_put(queue: Queue, loop: AbstractEventLoop) -> Callable[[Optional[AnnuncioRecord]], None]:
+        """
+        :return: a function putting items in the queue from another thread, waiting while the queue is full
+        """
+        return lambda item: run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    @coroutine
+    def consume_records(self, records: Queue, export_ids: ExportIds = None,
+                        photos: PhotoTasks = None) -> int:
+        """
+        :param records: the parsed listings, up to None
+        :param export_ids: collects the ids of the listings, when given
+        :param photos: where the photos of new and changed listings are processed, when given
+        :return: how many listings were consumed
+        """
+        listings = 0
+
+        try:
+            record = yield from records.get()
+            while record is not None:
+                listings += 1
+                if export_ids is not None:
+                    export_ids.add(record)
+                change = ListingChange.new if self.sync_state is None else self.sync_state.classify(record)
+                if photos is not None and self.image_pool is not None and change is not ListingChange.unchanged \
+                        and not (record.info.deleted or record.info.flag_storico) and record.file_allegati:
+                    yield from photos.schedule(record, self.process_photos)
+                record = yield from records.get()
+        except BaseException:
+            # the parsing thread would otherwise wait forever on the full queue
+            ensure_future(self.discard_records(records))
+            raise
+
+        return listings
+
+    @coroutine
+    def process_photos(self, record: AnnuncioRecord) -> bool:
+        """
+        Downloads the attachments of a listing and renders their variants, as many at once as the pool takes.
+
+        :return: whether every attachment was processed
+        """
+        results = yield from gather(*[self.image_pool.download_and_process(self.downloader, allegato.file_path,
+                                                                           self.image_processing, self.image_sizes,
+                                                                           blueprint=allegato.planimetria)
+                                      for allegato in record.file_allegati if allegato.file_path],
+                                    return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            print('{} listing {}: attachment not processed: {!r}'.format(self.description, record.info.id, error))
+
+        return not errors
+
+    @staticmethod
+    @coroutine
+    def discard_records(records: Queue) -> None:
+        record = yield from records.get()
+        while record is not None:
+            record = yield from records.get()
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return '<{} description="{}" url={}>'.format(self.__class__.__name__, self.description, self.connection_url)
+
+
+# files read ahead of the process pool workers, each one is held in memory as a whole
+DEFAULT_MAX_PENDING_FILES = 8
 
 
 class SyncInterpreter:
 
+    # parsers are not thread safe: each thread builds and keeps its own
+    thread_cache = local()
+
     def __init__(self, url: str, timeout: int = 10):
         self.url = url
         self.timeout = timeout
 
     @staticmethod
-    def enrich_xml(xml_string: str) -> str:
+    def build_lookup() -> etree.ElementNamespaceClassLookup:
+
+        lookup = etree.ElementNamespaceClassLookup(fallback=objectify.ObjectifyElementClassLookup())
+        namespace = lookup.get_namespace(None)  # export elements carry no namespace
 
-        doc = objectify.parse(BytesIO(bytearray(xml_string, 'UTF-8')))
-        dataset = doc.getroot()
-        dataset.set('xmlns', SYNC_AGENZIA_FAKE_NS)
+        for tag_name, value_type in FIELD_TYPES.items():
+            namespace[tag_name] = FIELD_ELEMENT_CLASSES[value_type]
 
-        for info_tag in dataset.xpath('//dataset/annuncio/info'):
-            info_tag.set('id', str(info_tag.id))
+        for element in (AnnuncioElement, ApeElement, AllegatoElement, IncaricoElement,
+                        InfoElement, DatoDisponibileElement, InfoInseriteElement, DatiDisponibiliElement):
+            namespace[element.tag_name] = element
 
-        return etree.tostring(doc)
+        return lookup
 
     @staticmethod
     def build_parser() -> etree.XMLParser:
 
         parser = objectify.makeparser(remove_blank_text=True)
-        lookup = etree.ElementNamespaceClassLookup(fallback=objectify.ObjectifyElementClassLookup())
-        parser.set_element_class_lookup(lookup)
+        parser.set_element_class_lookup(SyncInterpreter.build_lookup())
 
-        namespace = lookup.get_namespace(SYNC_AGENZIA_FAKE_NS)
+        return parser
 
-        for element in (ApeElement, AllegatoElement, IncaricoElement,
-                        InfoElement, DatoDisponibileElement, InfoInseriteElement, DatiDisponibiliElement):
-            namespace[element.tag_name] = element
+    @staticmethod
+    def get_lookup() -> etree.ElementNamespaceClassLookup:
 
-        return parser
+        cache = SyncInterpreter.thread_cache
+        if not hasattr(cache, 'lookup'):
+            cache.lookup = SyncInterpreter.build_lookup()
+
+        return cache.lookup
 
     @staticmethod
-    def parse_xml(xml_string: str) -> etree.ElementTree:
+    def get_parser() -> etree.XMLParser:
+
+        cache = SyncInterpreter.thread_cache
+        if not hasattr(cache, 'parser'):
+            cache.parser = objectify.makeparser(remove_blank_text=True)
+            cache.parser.set_element_class_lookup(SyncInterpreter.get_lookup())
 
-        objectify.PyType('date', DateElement.check_date, DateElement).register()
+        return cache.parser
 
-        doc = objectify.parse(BytesIO(SyncInterpreter.enrich_xml(xml_string)),
-                              parser=SyncInterpreter.build_parser())
+    @staticmethod
+    def parse_xml(xml_string: str) -> etree.ElementTree:
+
+        doc = objectify.parse(BytesIO(bytearray(xml_string, 'UTF-8')),
+                              parser=SyncInterpreter.get_parser())
 
         return doc
 
+    @staticmethod
+    def iter_annunci(source: Union[str, BinaryIO]) -> Iterator['AnnuncioElement']:
+        """
+        Streams the <annuncio> elements of an export one at a time, without building the whole tree.
+
+        Every yielded element is fully typed, but it is cleared and detached from the document as soon
+        as the consumer asks for the next one: copy out whatever is needed before moving on.
+
+        :param source: a file name or a binary file object holding the export
+        :return: an iterator of annuncio elements
+        """
+        context = etree.iterparse(source, events=('end',), tag=AnnuncioElement.tag_name, remove_blank_text=True)
+        context.set_element_class_lookup(SyncInterpreter.get_lookup())
+
+        for _, annuncio in context:
+            yield annuncio
+            SyncInterpreter.release_annuncio(annuncio)
+
+    @staticmethod
+    def feed_annunci(xml_file: BinaryIO, chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator['AnnuncioElement']:
+        """
+        Same as iter_annunci(), but the file is read and fed to the parser one chunk at a time,
+        so that annunci come out while the rest of the file is still to be received.
+
+        :param xml_file: a file object holding the export, it only needs to support read()
+        :param chunk_size: how many bytes get fed to the parser at once
+        :return: an iterator of annuncio elements
+        """
+        parser = etree.XMLPullParser(events=('end',), tag=AnnuncioElement.tag_name, remove_blank_text=True)
+        parser.set_element_class_lookup(SyncInterpreter.get_lookup())
+
+        chunk = xml_file.read(chunk_size)
+        while chunk:
+            parser.feed(chunk)
+            for _, annuncio in parser.read_events():
+                yield annuncio
+                SyncInterpreter.release_annuncio(annuncio)
+            chunk = xml_file.read(chunk_size)
+
+        parser.close()
+        for _, annuncio in parser.read_events():
+            yield annuncio
+            SyncInterpreter.release_annuncio(annuncio)
+
+    @staticmethod
+    def release_annuncio(annuncio: 'AnnuncioElement') -> None:
+
+        dataset = annuncio.getparent()
+        annuncio.clear()
+        while annuncio.getprevious() is not None:
+            dataset.remove(annuncio.getprevious())
+        if dataset is not None:
+            dataset.remove(annuncio)
+
+    @staticmethod
+    def to_records(annunci: Iterable['AnnuncioElement'],
+                   skipped: List[Optional[int]] = None) -> Iterator[AnnuncioRecord]:
+        """
+        Copies out annunci as records, skipping those missing a required value or holding a malformed one:
+        a single broken listing must not stop the sync of the whole export.
+
+        :param annunci: the annuncio elements, as returned by iter_annunci() or feed_annunci()
+        :param skipped: collects the ids of the skipped listings, None for those without a readable id
+        :return: an iterator of records
+        """
+        for annuncio in annunci:
+            try:
+                record = annuncio.to_record()
+            except (TypeError, ValueError) as e:
+                listing_id = annuncio.findtext('info/id')
+                print('skipping listing {}: {!r}'.format(listing_id, e))
+                if skipped is not None:
+                    skipped.append(int(listing_id) if listing_id and listing_id.strip().isdigit() else None)
+                continue
+            yield record
+
+    @staticmethod
+    def iter_records(source: Union[str, BinaryIO]) -> Iterator[AnnuncioRecord]:
+        return SyncInterpreter.to_records(SyncInterpreter.iter_annunci(source))
+
+    @staticmethod
+    def map_xml_files(xml_files: Iterable[Tuple[str, BinaryIO]],
+                      executor: Executor,
+                      max_pending: int = DEFAULT_MAX_PENDING_FILES,
+                      skipped: List[Optional[int]] = None) -> Iterator[List[AnnuncioRecord]]:
+        """
+        Parses xml files in parallel, each one as a whole in a worker of the executor.
+
+        Files are read here and shipped as bytes, records come back in the order of the files.
+        At most max_pending files are in flight, so that a huge archive is never read ahead in full.
+
+        :param xml_files: (name, file) pairs, as returned by TarFile.extract_xml_files()
+        :param executor: a process pool, threads would not parse any faster
+        :param max_pending: how many files can be waiting for a worker
+        :param skipped: collects the ids of the listings skipped by the workers, as to_records()
+        :return: an iterator of the records of every file
+        """
+        pending = deque()
+
+        def result() -> List[AnnuncioRecord]:
+            records, skipped_ids = pending.popleft().result()
+            if skipped is not None:
+                skipped.extend(skipped_ids)
+            return records
+
+        for _, xml_file in xml_files:
+            pending.append(executor.submit(parse_records, xml_file.read()))
+            if len(pending) >= max_pending:
+                yield result()
+
+        while pending:
+            yield result()
+
+    @staticmethod
+    def parse_stream(pipe: ChunkPipe,
+                     emit: Callable[[Optional[AnnuncioRecord]], None],
+                     executor: Executor = None,
+                     skipped: List[Optional[int]] = None) -> None:
+        """
+        Parses a tar.gz export while it is being downloaded, meant to run in a worker thread.
+
+        The first xml file is always streamed here: exports made of a single large file keep a flat
+        memory profile and their first listing early. Only the files after it go to the executor.
+
+        :param pipe: the pipe the download is written to
+        :param emit: called with every record, then with None once the archive is over, even on errors
+        :param executor: a process pool to parse the xml files after the first one in parallel
+        :param skipped: collects the ids of the skipped listings, as to_records()
+        """
+        try:
+            xml_files = iter_streamed_xml_files(pipe)
+
+            for _, xml_file in (xml_files if executor is None else itertools.islice(xml_files, 1)):
+                for record in SyncInterpreter.to_records(SyncInterpreter.feed_annunci(xml_file), skipped):
+                    emit(record)
+
+            if executor is not None:
+                for records in SyncInterpreter.map_xml_files(xml_files, executor, skipped=skipped):
+                    for record in records:
+                        emit(record)
+        finally:
+            pipe.close_reader()
+            emit(None)
+
+
+def parse_records(xml_content: bytes) -> Tuple[List[AnnuncioRecord], List[Optional[int]]]:
+    """
+    Process pool entry point: parses a whole export file, with the element class lookup cached by the worker.
+
+    :param xml_content: the content of the xml file
+    :return: the records of its listings, which unlike elements can be pickled back, and the ids of those skipped
+    """
+    skipped = []
+    records = list(SyncInterpreter.to_records(SyncInterpreter.iter_annunci(BytesIO(xml_content)), skipped))
+
+    return records, skipped
+
 
 class DateElement(objectify.ObjectifiedDataElement):
 
-    date_format = '%Y-%m-%d %H:%M:%S'
+    date_format = DATE_FORMAT
 
     @property
-    def pyval(self):
-        return datetime.strptime(self.text, DateElement.date_format)
+    def pyval(self) -> Optional[datetime]:
+        return parse_date(self.text)
 
-    @staticmethod
-    def check_date(string_date):
-        datetime.strptime(string_date, DateElement.date_format)
+
+class NullableIntElement(objectify.IntElement):
+
+    def _init(self):
+        self._setValueParser(nullable(int))
+
+
+class FlagElement(objectify.IntElement):
+
+    def _init(self):
+        self._setValueParser(parse_flag)
+
+
+class NullableFloatElement(objectify.FloatElement):
+
+    def _init(self):
+        self._setValueParser(nullable(float))
+
+
+# Python types of the export leaves, applied by tag name so that objectify never has to guess them.
+# Optional numbers and flags may come as empty tags and pay a small per-element cost to map those to None or 0.
+FIELD_TYPES = dict(InfoRecord.__annotations__, file_path=str, valore_assegnato=int)
+
+FIELD_ELEMENT_CLASSES = {
+    int: objectify.IntElement,
+    Optional[int]: NullableIntElement,
+    Flag: FlagElement,
+    Optional[float]: NullableFloatElement,
+    str: objectify.StringElement,
+    datetime: DateElement,
+}
+
+
+class AnnuncioElement(objectify.ObjectifiedElement):
+
+    tag_name = 'annuncio'
+
+    def to_record(self) -> AnnuncioRecord:
+        return AnnuncioRecord.from_element(self)
 
 
 class ApeElement(objectify.StringElement):
@@ -152,47 +602,67 @@ class InfoElement(objectify.ObjectifiedElement):
 
     @property
     def id(self) -> Optional[int]:
+        # info_inserite entries carry the id as an attribute, the annuncio info block as an <id> child
         try:
-            return int(self.get('id'))
+            return int(self.get('id') or self.findtext('id'))
         except TypeError:
             return None
 
+    @property
+    def decoder(self) -> Optional[InfoDecoder]:
+        return decoder_for(self.id)
+
     @property
     def information_type(self) -> Optional[InfoInserita]:
-        try:
-            return InfoInserita(self.id)
-        except ValueError:
-            return None
+        decoder = self.decoder
+        return None if decoder is None else decoder.info_inserita
 
     @property
     def mapped_value(self) -> Union[InfoInserita, int, bool, None]:
-        try:
-            return self.information_type.mapped_value(self.valore_assegnato)
-        except ValueError:
-            return None
+        decoder = self.decoder
+        return None if decoder is None else decode_value(decoder, self.valore_assegnato.pyval)
 
     @property
     def keep_in_list(self) -> Optional[bool]:
-        try:
-            return self.information_type.keep_in_list(self.valore_assegnato)
-        except ValueError:
-            return None
+        decoder = self.decoder
+        return None if decoder is None else decoder.keep_in_list(self.valore_assegnato.pyval)
 
 
-class InfoInseriteElement(objectify.ObjectifiedElement):
+class IndexedElement(objectify.ObjectifiedElement):
 
-    tag_name = 'info_inserite'
+    key_type = enum.Enum
 
     def __getitem__(self, *args, **kwargs):
-        if len(args) == 1 and type(args[0]) == InfoInserita:
+        if len(args) == 1 and type(args[0]) == self.key_type:
             return self.by_information_type(args[0])
         else:
-            return super(InfoInseriteElement, self).__getitem__(*args, **kwargs)
+            return super(IndexedElement, self).__getitem__(*args, **kwargs)
+
+    def id_index(self) -> Dict[int, objectify.ObjectifiedElement]:
+        """
+        Maps the id attribute of every child to the child itself.
 
-    def by_information_type(self, info_inserita: InfoInserita) -> Optional[InfoElement]:
-        for info in self.iterchildren():
-            if info.id == info_inserita.value:
-                return info
+        The index is built anew on every call: lxml drops and recreates element proxies at will,
+        so nothing can be kept on them. Build it once when looking up many children.
+
+        :return: an id to child dictionary
+        """
+        return {int(child.get('id')): child for child in self.iterchildren() if child.get('id') is not None}
+
+    def as_dict(self) -> Dict[enum.Enum, objectify.ObjectifiedElement]:
+        members = self.key_type.__members__.values()
+        index = self.id_index()
+        return {member: index[member.value] for member in members if member.value in index}
+
+    def by_information_type(self, key: enum.Enum) -> Optional[objectify.ObjectifiedElement]:
+        # lxml walks the children itself and stops at the first match
+        return self.find('*[@id="{:d}"]'.format(key.value))
+
+
+class InfoInseriteElement(IndexedElement):
+
+    tag_name = 'info_inserite'
+    key_type = InfoInserita
 
 
 class DatoDisponibileElement(objectify.IntElement):
@@ -209,17 +679,7 @@ class DatoDisponibileElement(objectify.IntElement):
         return DatoDisponibile(self.id)
 
 
-class DatiDisponibiliElement(objectify.ObjectifiedElement):
+class DatiDisponibiliElement(IndexedElement):
 
     tag_name = 'dati_inseriti'
-
-    def __getitem__(self, *args, **kwargs):
-        if len(args) == 1 and type(args[0]) == DatoDisponibile:
-            return self.by_information_type(args[0])
-        else:
-            return super(DatiDisponibiliElement, self).__getitem__(*args, **kwargs)
-
-    def by_information_type(self, dato_disponibile: DatoDisponibile) -> Optional[DatoDisponibileElement]:
-        for dato in self.iterchildren():
-            if dato.id == dato_disponibile.value:
-                return dato
+    key_type = DatoDisponibile
@@ -0,0 +1,298 @@
+import asyncio
+import os
+import random
+import time
+import urllib.parse
+
+from asyncio import coroutine, get_event_loop
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from aiohttp import ClientConnectionError, ClientPayloadError, Timeout, hdrs
+
+from .fetch_remote import get_session, DEFAULT_CHUNK_SIZE, DEFAULT_CONNECTION_LIMIT_PER_HOST
+from .media_cache import MediaCache
+
+DEFAULT_INITIAL_PER_HOST = 2
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_RETRY_BASE_DELAY = 0.5
+DEFAULT_RETRY_MAX_DELAY = 30.0
+
+# answers meaning that the server is overloaded, rather than that the file is wrong
+CONGESTION_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+class DownloadedFile(NamedTuple):
+    size: int
+    validators: Dict[str, Optional[str]]
+
+
+class CongestionError(Exception):
+
+    def __init__(self, url: str, status: int, retry_after: Optional[float] = None):
+        super(CongestionError, self).__init__('{} answered {}'.format(url, status))
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdaptiveLimit:
+    """
+    Concurrency limit of a host, adjusted AIMD style as in TCP congestion control: every success
+    raises it by 1 / limit, about one more request per round trip, congestion halves it.
+
+    Requests already in flight when the limit gets cut are likely to fail as well: only congestion
+    signals from requests started after the last cut cut it again.
+    """
+
+    def __init__(self,
+                 initial: int = DEFAULT_INITIAL_PER_HOST,
+                 maximum: int = DEFAULT_CONNECTION_LIMIT_PER_HOST,
+                 minimum: int = 1,
+                 backoff: float = 0.5):
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.minimum = minimum
+        self.backoff = backoff
+        self.in_flight = 0
+        self.decreases = 0
+        self.condition = asyncio.Condition()
+
+    @coroutine
+    def acquire(self) -> int:
+        """
+        Waits for a free slot.
+
+        :return: the ticket to release the slot with
+        """
+        with (yield from self.condition):
+            yield from self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+            return self.decreases
+
+    @coroutine
+    def release(self, ticket: int, congested: bool = False) -> None:
+        """
+        :param ticket: as returned by acquire()
+        :param congested: whether the server showed signs of overload
+        """
+        with (yield from self.condition):
+            self.in_flight -= 1
+
+            if not congested:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            elif ticket == self.decreases:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self.decreases += 1
+
+            self.condition.notify_all()
+
+
+class DownloadStats:
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+        self.failures = 0
+        self.not_modified = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def files_per_second(self) -> float:
+        return self.files / max(self.elapsed, 1e-9)
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / max(self.elapsed, 1e-9)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def __str__(self):
+        return '<{} files={} not_modified={} bytes={} retries={} failures={} files/s={:.1f} KiB/s={:.1f}>'.format(
+            self.__class__.__name__, self.files, self.not_modified, self.bytes, self.retries, self.failures,
+            self.files_per_second, self.bytes_per_second / 1024)
+
+
+class AttachmentDownloader:
+    """
+    Downloads the attachments of the listings through the shared session, as many at once
+    as every host tolerates.
+    """
+
+    def __init__(self,
+                 connection_timeout: int = 30,
+                 initial_per_host: int = DEFAULT_INITIAL_PER_HOST,
+                 max_per_host: int = DEFAULT_CONNECTION_LIMIT_PER_HOST,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 retry_base_delay: float = DEFAULT_RETRY_BASE_DELAY,
+                 retry_max_delay: float = DEFAULT_RETRY_MAX_DELAY,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        :param connection_timeout: seconds a single attempt may last
+        :param initial_per_host: concurrent downloads per host to start with
+        :param max_per_host: concurrent downloads per host never exceeded
+        :param max_attempts: attempts per file, when the server is overloaded or unreachable
+        :param retry_base_delay: the retry delay cap after the first failure, doubled at every failure
+        :param retry_max_delay: the cap the retry delay never exceeds
+        :param chunk_size: how many bytes are read from the socket at once
+        """
+        self.session = get_session()
+        self.connection_timeout = connection_timeout
+        self.initial_per_host = initial_per_host
+        self.max_per_host = max_per_host
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.chunk_size = chunk_size
+        self.limits = {}  # type: Dict[str, AdaptiveLimit]
+        self.stats = DownloadStats()
+
+    def limit_for(self, url: str) -> AdaptiveLimit:
+        host = urllib.parse.urlparse(url).netloc
+
+        if host not in self.limits:
+            self.limits[host] = AdaptiveLimit(self.initial_per_host, self.max_per_host)
+
+        return self.limits[host]
+
+    def retry_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """
+        Full jitter: a random delay up to an exponentially growing cap, so that retries of files
+        failed together do not hit the server together again.
+
+        :param attempt: how many attempts failed so far
+        :param retry_after: the delay asked by the server, if any, honoured up to retry_max_delay
+        """
+        delay = random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** (attempt - 1)))
+        return delay if retry_after is None else min(self.retry_max_delay, max(delay, retry_after))
+
+    @coroutine
+    def download(self, url: str, file_path: str, headers: Dict[str, str] = None) -> Optional[DownloadedFile]:
+        """
+        Downloads a file, retrying while the server is overloaded or unreachable.
+
+        The file is written aside and moved in place once complete.
+
+        :param url: the url of the attachment
+        :param file_path: where to save it
+        :param headers: additional request headers, such as validators
+        :return: the size and the validators of the file, None when the server answered 304 Not Modified
+        """
+        limit = self.limit_for(url)
+        attempt = 0
+
+        while True:
+            attempt += 1
+            ticket = yield from limit.acquire()
+            congested = False
+            retry_after = None
+
+            try:
+                downloaded = yield from self.__fetch(url, file_path, headers)
+                if downloaded is None:
+                    self.stats.not_modified += 1
+                else:
+                    self.stats.files += 1
+                    self.stats.bytes += downloaded.size
+                return downloaded
+
+            except CongestionError as e:
+                congested, retry_after, error = True, e.retry_after, e
+            except (asyncio.TimeoutError, ClientConnectionError, ClientPayloadError) as e:
+                congested, error = True, e
+            except Exception:
+                self.stats.failures += 1
+                raise
+            finally:
+                yield from limit.release(ticket, congested)
+
+            if attempt >= self.max_attempts:
+                self.stats.failures += 1
+                raise error
+
+            self.stats.retries += 1
+            yield from asyncio.sleep(self.retry_delay(attempt, retry_after))
+
+    @coroutine
+    def download_to_cache(self, url: str, cache: MediaCache) -> str:
+        """
+        Downloads a file into a cache, unless the cache holds it already and the server confirms
+        it did not change.
+
+        :param url: the url of the attachment
+        :param cache: the cache to check and fill
+        :return: the digest of the file in the cache
+        """
+        digest = cache.lookup(url)
+        temporary_path = cache.temporary_path()
+
+        try:
+            downloaded = yield from self.download(url, temporary_path,
+                                                  cache.request_headers(url) if digest is not None else None)
+            if downloaded is None:
+                return digest
+
+            return cache.store_blob(url, temporary_path, downloaded.validators)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    @coroutine
+    def download_all(self, downloads: Iterable[Tuple[str, str]]) -> List[Optional[BaseException]]:
+        """
+        :param downloads: (url, file path) pairs
+        :return: None for every file downloaded, the error of every other one
+        """
+        results = yield from asyncio.gather(*[self.download(url, file_path) for url, file_path in downloads],
+                                            return_exceptions=True)
+        return [result if isinstance(result, BaseException) else None for result in results]
+
+    @coroutine
+    def __fetch(self, url: str, file_path: str, headers: Optional[Dict[str, str]]) -> Optional[DownloadedFile]:
+
+        temporary_path = '{}.part'.format(file_path)
+
+        with Timeout(self.connection_timeout):
+            response = yield from self.session.get(url, headers=headers)
+            try:
+                if response.status == 304:
+                    return None
+                if response.status in CONGESTION_STATUSES:
+                    raise CongestionError(url, response.status, parse_retry_after(response.headers))
+                response.raise_for_status()
+
+                # a slow disk must not hold up the other downloads
+                loop = get_event_loop()
+                size = 0
+                attachment = yield from loop.run_in_executor(None, open, temporary_path, 'wb')
+                try:
+                    chunk = yield from response.content.read(self.chunk_size)
+                    while chunk:
+                        yield from loop.run_in_executor(None, attachment.write, chunk)
+                        size += len(chunk)
+                        chunk = yield from response.content.read(self.chunk_size)
+                finally:
+                    yield from loop.run_in_executor(None, attachment.close)
+
+                os.replace(temporary_path, file_path)
+                return DownloadedFile(size, {name: response.headers.get(name)
+                                             for name in (hdrs.ETAG, hdrs.LAST_MODIFIED)})
+
+            except BaseException:
+                response.close()
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                raise
+            finally:
+                response.release()
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    try:
+        return float(headers[hdrs.RETRY_AFTER])
+    except (KeyError, ValueError):  # missing, or given as an http date
+        return None
@@ -0,0 +1,111 @@
+import enum
+from typing import Dict, Iterable, Optional, Union, BinaryIO
+
+import numpy as np
+
+from .agent import SyncInterpreter
+from .mapping.info_inserite import InfoInserita, Tag
+from .records import AnnuncioRecord
+
+
+class FeatureMatrix:
+    """
+    The info_inserite of a whole catalog, one row per listing.
+
+    Boolean infos are packed eight per byte in `flags`, every other info (counters and enums) is an
+    int16 column of `values`. Missing flags read as False, missing values as MISSING: 0 is a value
+    in its own right for enums such as EnergyLabel.da_definire.
+    """
+
+    MISSING = -1
+
+    flag_members = tuple(info for info in InfoInserita if info.value_type is bool)
+    value_members = tuple(info for info in InfoInserita if info.value_type is not bool)
+
+    flag_columns = {info: column for column, info in enumerate(flag_members)}
+    value_columns = {info: column for column, info in enumerate(value_members)}
+
+    def __init__(self, listing_ids: np.ndarray, flags: np.ndarray, values: np.ndarray):
+        self.listing_ids = listing_ids
+        self.flags = flags
+        self.values = values
+
+    @staticmethod
+    def from_records(records: Iterable[AnnuncioRecord]) -> 'FeatureMatrix':
+
+        listing_ids = []
+        rows = []
+
+        for record in records:
+            listing_ids.append(record.info.id)
+            rows.append(record.info_inserite)
+
+        # None becomes nan in a float array, which is the cheapest way to get the missing infos out in bulk
+        raw = np.array(rows, dtype=np.float64).reshape(len(rows), len(InfoInserita))
+        raw = np.where(np.isnan(raw), FeatureMatrix.MISSING, raw).astype(np.int16)
+
+        flag_indexes = [info.value - 1 for info in FeatureMatrix.flag_members]
+        value_indexes = [info.value - 1 for info in FeatureMatrix.value_members]
+
+        return FeatureMatrix(np.array(listing_ids, dtype=np.int64),
+                             np.packbits(raw[:, flag_indexes] > 0, axis=1),
+                             np.ascontiguousarray(raw[:, value_indexes]))
+
+    @staticmethod
+    def from_export(source: Union[str, BinaryIO]) -> 'FeatureMatrix':
+        return FeatureMatrix.from_records(SyncInterpreter.iter_records(source))
+
+    def __len__(self):
+        return len(self.listing_ids)
+
+    def flag(self, info_inserita: InfoInserita) -> np.ndarray:
+        column = FeatureMatrix.flag_columns[info_inserita]
+        return ((self.flags[:, column >> 3] >> (7 - (column & 7))) & 1).astype(bool)
+
+    def column(self, info_inserita: InfoInserita) -> np.ndarray:
+        if info_inserita in FeatureMatrix.flag_columns:
+            return self.flag(info_inserita).astype(np.int16)
+        return self.values[:, FeatureMatrix.value_columns[info_inserita]]
+
+    def has(self, *infos: InfoInserita) -> np.ndarray:
+        mask = np.ones(len(self), dtype=bool)
+        for info_inserita in infos:
+            mask &= self.column(info_inserita) > 0
+        return mask
+
+    def has_any(self, *infos: InfoInserita) -> np.ndarray:
+        mask = np.zeros(len(self), dtype=bool)
+        for info_inserita in infos:
+            mask |= self.column(info_inserita) > 0
+        return mask
+
+    def isin(self, info_inserita: InfoInserita, *values: Union[int, enum.Enum]) -> np.ndarray:
+        accepted = [value.value if isinstance(value, enum.Enum) else value for value in values]
+        return np.isin(self.column(info_inserita), accepted)
+
+    def select(self, mask: np.ndarray) -> np.ndarray:
+        return self.listing_ids[mask]
+
+    def count_by_tag(self, tag: Tag, mask: Optional[np.ndarray] = None) -> Dict[InfoInserita, int]:
+        """
+        Counts, for every info carrying the given tag, the listings where it is set.
+
+        :param tag: the tag to aggregate on
+        :param mask: restricts the count to the selected listings
+        :return: the count of listings by info
+        """
+        infos = [info for info in InfoInserita if tag in info.tags]
+        flags = self.flags if mask is None else self.flags[mask]
+        values = self.values if mask is None else self.values[mask]
+
+        flag_infos = [info for info in infos if info in FeatureMatrix.flag_columns]
+        value_infos = [info for info in infos if info in FeatureMatrix.value_columns]
+
+        flag_counts = np.unpackbits(flags, axis=1)[:, [FeatureMatrix.flag_columns[info] for info in flag_infos]] \
+            .sum(axis=0)
+        value_counts = (values[:, [FeatureMatrix.value_columns[info] for info in value_infos]] > 0).sum(axis=0)
+
+        counts = dict(zip(flag_infos, flag_counts.tolist()))
+        counts.update(zip(value_infos, np.atleast_1d(value_counts).tolist()))
+
+        return counts
@@ -1,45 +1,117 @@
+import json
+import mmap
+import os
 import sys
 import tarfile
-from asyncio import coroutine
+from asyncio import coroutine, get_event_loop
+from collections import deque
 from io import BytesIO
+from tempfile import SpooledTemporaryFile
+from threading import Condition
+from typing import BinaryIO, Dict, Iterator, Optional, Tuple, Union
 
-from aiohttp import ClientSession, Timeout
+from aiohttp import ClientResponse, ClientSession, TCPConnector, Timeout, hdrs
 
 
 class TarFile:
 
-    def __init__(self, bytes_in: bytes, archive_name: str=None):
-        self.bytes_in = bytes_in
+    def __init__(self, source: Union[bytes, str, BinaryIO], archive_name: str=None, owns_source: bool=False):
+        """
+        :param source: the archive content, the path of the archive or a binary file object reading it
+        :param archive_name: a name for the archive, used in its representation only
+        :param owns_source: close the source file object when the archive is disposed of
+        """
+        self.source = source
         self.compression_mode = 'r:'
         self.archive_name = archive_name
         self.archive_buffer = None
+        self.owns_source = owns_source
+        self.opened_resources = []
 
     @property
     def closed(self):
         return self.archive_buffer is None or self.archive_buffer.closed
 
     def open(self):
-        self.archive_buffer = tarfile.open(fileobj=BytesIO(self.bytes_in), mode=self.compression_mode)
+        self.archive_buffer = tarfile.open(fileobj=self.open_source(), mode=self.compression_mode)
         return self.archive_buffer
 
+    def open_source(self) -> BinaryIO:
+
+        if isinstance(self.source, (bytes, bytearray)):
+            return BytesIO(self.source)
+
+        if isinstance(self.source, str):
+            archive_file = open(self.source, 'rb')
+            self.opened_resources.append(archive_file)
+
+            if self.compression_mode != 'r:':
+                return archive_file
+
+            # uncompressed archives are mapped: seeking from member to member costs no read calls,
+            # tarfile still copies out whatever it reads
+            archive_map = mmap.mmap(archive_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.opened_resources.append(archive_map)
+            return archive_map
+
+        self.source.seek(0)
+        return self.source
+
     def close(self):
         if self.archive_buffer is None:
             raise IOError('Archive already closed')
         else:
             self.archive_buffer.close()
+            self.release_resources()
+
+    def release_resources(self):
+        while self.opened_resources:
+            self.opened_resources.pop().close()
+
+    def dispose(self):
+        """
+        Closes the archive, when open, and the source file object, when owned: an owned source
+        cannot be opened again afterwards.
+        """
+        if not self.closed:
+            self.close()
+
+        if self.owns_source and not isinstance(self.source, (bytes, bytearray, str)):
+            self.source.close()
+
+    def extract_xml_files(self) -> Iterator[Tuple[str, BinaryIO]]:
+        """
+        Lazily yields the xml files of the archive, walking its members only once.
 
-    def extract_xml_files(self):
+        The archive is opened when needed and stays open for the files to be read: close it,
+        or use the archive as a context manager.
+
+        :return: an iterator of (member name, member file) pairs
+        """
         tar = self.open() if self.closed else self.archive_buffer
-        return [tar.extractfile(file_name)
-                for file_name in tar.getnames()
-                if file_name.endswith('.xml')]
+        for member in tar:
+            if member.isfile() and member.name.endswith('.xml'):
+                yield member.name, tar.extractfile(member)
 
     def list_content(self):
-        tar = self.open() if self.closed else self.archive_buffer
+        """
+        :return: the names of all the members, the archive is closed afterwards only when it was not open before
+        """
+        was_closed = self.closed
+        tar = self.open() if was_closed else self.archive_buffer
         file_names = tar.getnames()
-        tar.close()
+        if was_closed:
+            self.close()
         return file_names
 
+    def __enter__(self):
+        if self.closed:
+            self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.dispose()
+
     def __repr__(self):
         if self.archive_name is None:
             return '<{}>'.format(self.__class__.__name__)
@@ -49,29 +121,295 @@ class TarFile:
 
 class TarGzFile(TarFile):
 
-    def __init__(self, bytes_in: bytes, archive_name: str=None):
-        super(TarGzFile, self).__init__(bytes_in, archive_name)
+    def __init__(self, source: Union[bytes, str, BinaryIO], archive_name: str=None, owns_source: bool=False):
+        super(TarGzFile, self).__init__(source, archive_name, owns_source)
         self.compression_mode = 'r:gz'
 
 
+def iter_streamed_xml_files(stream: BinaryIO, compression_mode: str = 'r|gz') -> Iterator[Tuple[str, BinaryIO]]:
+    """
+    Walks an archive in stream mode, one member after the other, without ever seeking backwards.
+
+    Every xml file must be consumed before asking for the next one: once the archive moves on,
+    its content is gone.
+
+    :param stream: a file object reading the archive, it only needs to support read()
+    :param compression_mode: a tarfile stream mode
+    :return: an iterator of (member name, member file) pairs
+    """
+    with tarfile.open(fileobj=stream, mode=compression_mode) as archive:
+        for member in archive:
+            if member.isfile() and member.name.endswith('.xml'):
+                yield member.name, archive.extractfile(member)
+
+
+class ChunkPipe:
+    """
+    Bounded buffer handing the chunks of a download over from the event loop to a reading thread.
+
+    The writer is the event loop, which must never block: write() should only be called directly
+    while the pipe is not full, otherwise from an executor. The reader is a plain blocking file object.
+    """
+
+    def __init__(self, max_chunks: int = 16):
+        self.max_chunks = max_chunks
+        self.chunks = deque()
+        self.buffer = bytearray()
+        self.offset = 0  # bytes at the start of buffer already read
+        self.condition = Condition()
+        self.eof = False
+        self.error = None
+        self.reader_closed = False
+
+    def full(self) -> bool:
+        return len(self.chunks) >= self.max_chunks
+
+    def write(self, chunk: bytes) -> None:
+        with self.condition:
+            while self.full() and not self.reader_closed:
+                self.condition.wait()
+            if self.reader_closed:
+                raise BrokenPipeError('The reader of the pipe went away')
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def close(self, error: Optional[BaseException] = None) -> None:
+        """
+        Ends the stream, the reader gets the end of file or, when given, the error.
+
+        :param error: the reason the stream got interrupted
+        """
+        with self.condition:
+            self.eof = True
+            self.error = error
+            self.condition.notify_all()
+
+    def close_reader(self) -> None:
+        with self.condition:
+            self.reader_closed = True
+            self.chunks.clear()
+            self.condition.notify_all()
+
+    def available(self) -> int:
+        return len(self.buffer) - self.offset
+
+    def read(self, size: int = -1) -> bytes:
+        with self.condition:
+            while (size < 0 or self.available() < size) and not self.eof:
+                if self.chunks:
+                    self.buffer += self.chunks.popleft()
+                    self.condition.notify_all()
+                else:
+                    self.condition.wait()
+
+            while self.chunks and (size < 0 or self.available() < size):
+                self.buffer += self.chunks.popleft()
+
+            if self.error is not None and not self.available():
+                raise IOError('Download interrupted') from self.error
+
+            end = len(self.buffer) if size < 0 else min(len(self.buffer), self.offset + size)
+            data = bytes(self.buffer[self.offset:end])
+            self.offset = end
+
+            # the read part is dropped once it outweighs the rest, every byte gets moved a bounded number of times
+            if self.offset > len(self.buffer) // 2:
+                del self.buffer[:self.offset]
+                self.offset = 0
+
+            return data
+
+
+class HttpValidators:
+    """
+    ETag and Last-Modified of the last complete download of every url, so that the next request can be
+    conditional. When a file path is given the validators survive across runs.
+    """
+
+    def __init__(self, file_path: Optional[str] = None):
+        self.file_path = file_path
+        self.validators = {}
+
+        if file_path is not None and os.path.exists(file_path):
+            with open(file_path) as validators_file:
+                self.validators = json.load(validators_file)
+
+    def request_headers(self, url: str) -> Dict[str, str]:
+        validators = self.validators.get(url, {})
+        headers = {}
+
+        if validators.get(hdrs.ETAG):
+            headers[hdrs.IF_NONE_MATCH] = validators[hdrs.ETAG]
+        if validators.get(hdrs.LAST_MODIFIED):
+            headers[hdrs.IF_MODIFIED_SINCE] = validators[hdrs.LAST_MODIFIED]
+
+        return headers
+
+    def update(self, url: str, response_headers) -> None:
+        validators = {name: response_headers.get(name) for name in (hdrs.ETAG, hdrs.LAST_MODIFIED)}
+
+        if any(validators.values()):
+            self.validators[url] = validators
+        else:
+            self.validators.pop(url, None)
+
+    def save(self) -> None:
+        if self.file_path is None:
+            return
+
+        # write aside and swap, a crash must never leave half a file behind
+        temporary_path = '{}.tmp'.format(self.file_path)
+        with open(temporary_path, 'w') as validators_file:
+            json.dump(self.validators, validators_file)
+        os.replace(temporary_path, self.file_path)
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_SPOOL_SIZE = 1024 * 1024
+DEFAULT_CONNECTION_LIMIT = 100
+DEFAULT_CONNECTION_LIMIT_PER_HOST = 8
+
+__session = None
+
+
+def get_session(limit: int = DEFAULT_CONNECTION_LIMIT,
+                limit_per_host: int = DEFAULT_CONNECTION_LIMIT_PER_HOST) -> ClientSession:
+    """
+    Returns the process wide HTTP session, creating it on first use.
+
+    Connections are pooled and kept alive across every request of the process; the limits only apply
+    when the session gets created.
+
+    :param limit: maximum number of simultaneous connections
+    :param limit_per_host: maximum number of simultaneous connections to the same host
+    :return: the shared session
+    """
+    global __session
+
+    if __session is None or __session.closed:
+        __session = ClientSession(connector=TCPConnector(limit=limit, limit_per_host=limit_per_host))
+
+    return __session
+
+
+def close_session() -> None:
+    global __session
+
+    if __session is not None and not __session.closed:
+        __session.close()
+    __session = None
+
+
 class GIFetch:
 
-    def __init__(self, endpoint_url: str, connection_timeout:int = 10):
-        self.session = ClientSession()
+    def __init__(self,
+                 endpoint_url: str,
+                 connection_timeout: int = 10,
+                 validators: HttpValidators = None,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 spool_size: int = DEFAULT_SPOOL_SIZE):
+        self.session = get_session()
         self.endpoint_url = endpoint_url
         self.connection_timeout = connection_timeout
+        self.chunk_size = chunk_size
+        self.spool_size = spool_size
+        self.validators = HttpValidators() if validators is None else validators
+        self.response_headers = {}
 
     @coroutine
-    def fetch_all(self,):
-        tarball = TarGzFile
-        pass
+    def fetch_all(self) -> Optional[TarGzFile]:
+        tarball = yield from self.get_remote_tarball()
+        return None if tarball is None else TarGzFile(tarball, archive_name=self.endpoint_url, owns_source=True)
+
+    def commit_validators(self) -> None:
+        """
+        Records the validators of the last download, once its content has been fully processed:
+        from then on the same export is answered with 304 Not Modified.
+        """
+        self.validators.update(self.endpoint_url, self.response_headers)
+
+    @coroutine
+    def request_export(self) -> Optional[ClientResponse]:
+        """
+        Sends the request for the export, unless it did not change since the last committed download.
+
+        :return: the response, with its body still to be read, None when the server answered 304 Not Modified
+        """
+        with Timeout(self.connection_timeout):
+            response = yield from self.session.get(self.endpoint_url,
+                                                   headers=self.validators.request_headers(self.endpoint_url))
+
+        if response.status == 304:
+            response.release()
+            return None
+
+        try:
+            response.raise_for_status()
+        except Exception:
+            response.close()
+            raise
+
+        self.response_headers = response.headers
+        return response
 
     @coroutine
-    def get_remote_tarball(self):
-        with Timeout(self.timeout):
-            response = yield from self.session.get(self.url)
+    def stream_remote_tarball(self, response: ClientResponse, pipe: ChunkPipe) -> None:
+        """
+        Pushes the body of the export into a pipe as it comes from the socket.
+
+        The connection timeout applies to every single chunk rather than to the whole download,
+        which lasts as long as the reader of the pipe needs to keep up.
+
+        :param response: the response returned by request_export()
+        :param pipe: the pipe feeding the reader, always closed on return
+        """
+        loop = get_event_loop()
+        try:
+            while True:
+                with Timeout(self.connection_timeout):
+                    chunk = yield from response.content.read(self.chunk_size)
+                if not chunk:
+                    break
+
+                if pipe.full():
+                    yield from loop.run_in_executor(None, pipe.write, chunk)
+                else:
+                    pipe.write(chunk)
+        except BaseException as e:
+            response.close()
+            pipe.close(e)
+            raise
+        else:
+            response.release()
+            pipe.close()
+
+    @coroutine
+    def get_remote_tarball(self) -> Optional[BinaryIO]:
+        """
+        Downloads the export, unless it did not change since the last committed download.
+
+        The body is streamed chunk by chunk into a temporary file, which only stays in memory while small.
+
+        :return: the tarball file, rewound, None when the server answered 304 Not Modified
+        """
+        with Timeout(self.connection_timeout):
+            response = yield from self.request_export()
+            if response is None:
+                return None
+
             try:
-                return response.read()  # returns binary data
+                tarball = SpooledTemporaryFile(max_size=self.spool_size)
+                try:
+                    chunk = yield from response.content.read(self.chunk_size)
+                    while chunk:
+                        tarball.write(chunk)
+                        chunk = yield from response.content.read(self.chunk_size)
+                except BaseException:
+                    tarball.close()
+                    raise
+
+                tarball.seek(0)
+                return tarball
             finally:
                 if sys.exc_info()[0] is not None:
                     response.close()
@@ -0,0 +1,91 @@
+import asyncio
+
+from asyncio import coroutine, get_event_loop
+from concurrent.futures import Executor
+from typing import Dict, Sequence
+
+from configuration import ImageProcessingConfiguration, ImageSize
+from image_processing.dedupe import signature
+from .attachments import AttachmentDownloader
+from .media_cache import MediaCache
+
+# caches opened by the current worker process, by directory
+__worker_caches = {}
+
+
+def process_cached(directory: str, digest: str, options: ImageProcessingConfiguration,
+                   sizes: Sequence[ImageSize], clip: int = 0, blueprint: bool = False) -> Dict[str, str]:
+    """
+    Process pool entry point: renders the variants of a cached photo into the cache.
+
+    :return: the paths of the variants, as MediaCache.process()
+    """
+    if directory not in __worker_caches:
+        __worker_caches[directory] = MediaCache(directory)
+
+    return __worker_caches[directory].process(digest, options, sizes, clip, blueprint)
+
+
+class ImageWorkerPool:
+    """
+    Processes photos in a process pool, away from the event loop.
+
+    Photos travel by digest only: workers decode them from the cache and write their variants
+    back to it, so that no pixel is ever pickled. At most max_in_flight photos are downloaded
+    or processed at once, downloads wait for the workers to keep up.
+
+    Photos perceptually identical to one already seen are processed as that one, their variants
+    are shared.
+    """
+
+    def __init__(self, cache: MediaCache, executor: Executor, max_in_flight: int, deduplicate: bool = True):
+        """
+        :param cache: where photos are downloaded to and variants written to
+        :param executor: a process pool, it can be shared with the parsing of the exports
+        :param max_in_flight: photos downloading or waiting for a worker, twice the workers keeps them busy
+        :param deduplicate: whether duplicates share the variants of the first copy seen
+        """
+        self.cache = cache
+        self.executor = executor
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.deduplicate = deduplicate
+
+    @coroutine
+    def canonical(self, digest: str) -> str:
+        """
+        :param digest: the digest of a cached photo
+        :return: the digest of the photo to process in its place
+        """
+        canonical = self.cache.canonical(digest)
+        if canonical is None:
+            photo = yield from get_event_loop().run_in_executor(self.executor, signature, self.cache.blob_path(digest))
+            canonical = self.cache.link(digest, photo)
+
+        return canonical
+
+    @coroutine
+    def process(self, digest: str, options: ImageProcessingConfiguration,
+                sizes: Sequence[ImageSize], clip: int = 0, blueprint: bool = False) -> Dict[str, str]:
+
+        return (yield from get_event_loop().run_in_executor(self.executor, process_cached, self.cache.directory,
+                                                            digest, options, sizes, clip, blueprint))
+
+    @coroutine
+    def download_and_process(self, downloader: AttachmentDownloader, url: str,
+                             options: ImageProcessingConfiguration,
+                             sizes: Sequence[ImageSize], clip: int = 0,
+                             blueprint: bool = False) -> Dict[str, str]:
+        """
+        :param downloader: the downloader fetching the photo into the cache
+        :param url: the url of the photo
+        :param options: the image processing options of the agency
+        :param sizes: the configured sizes
+        :param clip: the levels clip
+        :param blueprint: whether the photo is a floor plan
+        :return: the paths of the variants, as MediaCache.process()
+        """
+        with (yield from self.slots):
+            digest = yield from downloader.download_to_cache(url, self.cache)
+            if self.deduplicate:
+                digest = yield from self.canonical(digest)
+            return (yield from self.process(digest, options, sizes, clip, blueprint))
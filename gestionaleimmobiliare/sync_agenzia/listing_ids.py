@@ -0,0 +1,128 @@
+import os
+import re
+import tempfile
+
+from typing import NamedTuple, Tuple, List, Optional
+
+import numpy as np
+
+from .records import AnnuncioRecord
+
+
+class IdChanges(NamedTuple):
+    """
+    What an export changes in the listings published for an agency, as sorted id arrays.
+    """
+    removed: np.ndarray  # published, missing from the export
+    deleted: np.ndarray  # published, flagged deleted
+    archived: np.ndarray  # published, moved to flag_storico
+    published: np.ndarray  # every listing of the export neither deleted nor archived, or published and unreadable
+
+
+class ExportIds:
+    """
+    Collects the id and the state of every listing of an export, as they are parsed.
+    """
+
+    def __init__(self):
+        self.rows = []
+        # the ids of the listings that could not be read, None when not even the id could
+        self.skipped = []  # type: List[Optional[int]]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def add(self, record: AnnuncioRecord) -> None:
+        self.rows.append((record.info.id, record.info.deleted, record.info.flag_storico))
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the ids, the deleted flags and the archived flags, sorted by id, first occurrence of duplicates
+        """
+        rows = np.array(self.rows, dtype=np.int64).reshape(len(self.rows), 3)
+        listing_ids, first = np.unique(rows[:, 0], return_index=True)
+        deleted = rows[first, 1] != 0
+
+        return listing_ids, deleted, (rows[first, 2] != 0) & ~deleted
+
+    def skipped_ids(self) -> np.ndarray:
+        """
+        :return: the sorted, unique ids of the listings that could not be read
+        """
+        return np.unique(np.array([listing_id for listing_id in self.skipped if listing_id is not None],
+                                  dtype=np.int64))
+
+
+class ListingIdIndex:
+    """
+    The sorted ids of the listings published for an agency, saved as a .npy file between syncs.
+
+    An export is compared with it in a single binary search of the published ids among the
+    exported ones: what has to be unpublished comes out without ever walking the catalog in python.
+    """
+
+    def __init__(self, listing_ids: np.ndarray = None):
+        self.listing_ids = np.empty(0, dtype=np.int64) if listing_ids is None else listing_ids
+
+    def __len__(self):
+        return len(self.listing_ids)
+
+    @staticmethod
+    def load(file_path: str) -> 'ListingIdIndex':
+        """
+        :param file_path: the file saved by the last sync, an empty index when missing
+        """
+        if not os.path.exists(file_path):
+            return ListingIdIndex()
+
+        return ListingIdIndex(np.load(file_path))
+
+    def save(self, file_path: str) -> None:
+
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir=os.path.dirname(file_path) or '.')
+        with os.fdopen(handle, 'wb') as index_file:
+            np.save(index_file, self.listing_ids)
+        os.replace(temporary_path, file_path)
+
+    def diff(self, listing_ids: np.ndarray, deleted: np.ndarray, archived: np.ndarray,
+             skipped: np.ndarray = None) -> IdChanges:
+        """
+        :param listing_ids: the sorted, unique ids of the export
+        :param deleted: whether each listing of the export is flagged deleted
+        :param archived: whether each listing of the export is archived and not deleted
+        :param skipped: the sorted ids of the listings of the export that could not be read,
+                        they stay published if they were and are never unpublished
+        :return: the changes to the published listings
+        """
+        exported = ListingIdIndex.contains(listing_ids, self.listing_ids)
+        kept = ~exported & ListingIdIndex.contains(self.listing_ids[:0] if skipped is None else skipped,
+                                                   self.listing_ids)
+
+        exported_ids = self.listing_ids[exported]
+        positions = np.searchsorted(listing_ids, exported_ids)
+        published = listing_ids[~(deleted | archived)]
+        if kept.any():
+            published = np.union1d(published, self.listing_ids[kept])
+
+        return IdChanges(self.listing_ids[~(exported | kept)],
+                         exported_ids[deleted[positions]],
+                         exported_ids[archived[positions]],
+                         published)
+
+    @staticmethod
+    def contains(sorted_ids: np.ndarray, listing_ids: np.ndarray) -> np.ndarray:
+        """
+        :return: whether each of listing_ids is among sorted_ids, in a single binary search
+        """
+        if len(sorted_ids) == 0:
+            return np.zeros(len(listing_ids), dtype=bool)
+
+        return sorted_ids[np.searchsorted(sorted_ids, listing_ids).clip(max=len(sorted_ids) - 1)] == listing_ids
+
+
+def index_path(directory: str, agency_description: str) -> str:
+    """
+    :return: where the index of an agency is kept under a directory
+    """
+    return os.path.join(directory, 'listing_ids', '{}.npy'.format(re.sub(r'[^\w.-]+', '_', agency_description)))
@@ -0,0 +1,61 @@
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+from .info_inserite import InfoInserita, Tag
+
+
+class InfoDecoder(NamedTuple):
+    info_inserita: InfoInserita
+    converter: Callable[[int], Any]
+    keep_in_list: Callable[[int], bool]
+    tags: Tuple[Tag, ...]
+
+
+def build_decode_table() -> Tuple[Optional[InfoDecoder], ...]:
+
+    table = [None] * (max(info_inserita.value for info_inserita in InfoInserita) + 1)
+
+    for info_inserita in InfoInserita:
+        value_type = info_inserita.value_type
+        table[info_inserita.value] = InfoDecoder(info_inserita,
+                                                 value_type,
+                                                 value_type.keep_in_list if info_inserita.is_enum else bool,
+                                                 info_inserita.tags)
+
+    return tuple(table)
+
+
+# info id -> decoder, None where the id is not a known InfoInserita
+INFO_DECODE_TABLE = build_decode_table()
+
+
+def decoder_for(info_id: Optional[int]) -> Optional[InfoDecoder]:
+    if info_id is None or not 0 <= info_id < len(INFO_DECODE_TABLE):
+        return None
+    return INFO_DECODE_TABLE[info_id]
+
+
+def decode_value(decoder: InfoDecoder, value: int) -> Any:
+    try:
+        return decoder.converter(value)
+    except ValueError:  # value outside of the enum range
+        return None
+
+
+def decode_info_inserite(info_inserite) -> Dict[InfoInserita, Any]:
+    """
+    Decodes a whole <info_inserite> block in a single pass over its children.
+
+    :param info_inserite: the <info_inserite> element
+    :return: the mapped value of every known InfoInserita found in the block
+    """
+    decoded = {}
+
+    # walking the values and going up to their <info> is much cheaper than ElementPath lookups per info
+    for value in info_inserite.iter('valore_assegnato'):
+        info = value.getparent()
+        info_id = info.get('id')
+        decoder = decoder_for(int(info_id) if info_id is not None else int(info.findtext('id')))
+        if decoder is not None and value.text is not None:
+            decoded[decoder.info_inserita] = decode_value(decoder, int(value.text))
+
+    return decoded
@@ -260,10 +260,11 @@ class InfoInserita(enum.Enum):
         return obj
 
     def __init__(self, *args):
-        try:
+        # members declared with tags only, like (Tag.room,), get the tags themselves as args
+        if len(args) > 1:
             self.tags = args[0]
-        except IndexError:
-            self.tags = ()
+        else:
+            self.tags = tuple(args)
         try:
             self.value_type = args[1]
         except IndexError:
@@ -0,0 +1,317 @@
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from collections import OrderedDict
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+from aiohttp import hdrs
+from PIL import Image
+
+from configuration import ImageProcessingConfiguration, ImageSize
+from image_processing.dedupe import DEFAULT_MAX_DISTANCE, PerceptualIndex, Signature, low_detail, same_photo
+from image_processing.pipeline import FULL_SIZE, process_attachment, resize_plan
+
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# formats variants are saved in, by image mode: anything with transparency goes to PNG
+VARIANT_FORMATS = OrderedDict([('.jpg', 'JPEG'), ('.png', 'PNG')])
+
+
+def file_digest(file_path: str) -> str:
+
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as content:
+        for block in iter(lambda: content.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """
+    Content addressed store of the attachments, under a directory:
+
+    - blobs/ holds the downloads, named after the sha256 of their content;
+    - variants/ holds the processed images, named after the hash of their source and of everything
+      the processing depends on, so that changing the options of an agency only misses its own variants;
+    - index.json maps every url to the validators and the digest of its last download;
+    - photos.json holds the signature of every distinct photo and links every other download
+      to the distinct photo it duplicates, so that photos reused across listings or agencies are
+      processed and stored once.
+
+    Files are written aside and moved in place, a crash never leaves a partial file under a valid name.
+    Reads refresh the modification time, which evict() uses to drop the least recently used files.
+    """
+
+    def __init__(self, directory: str, max_bytes: int = DEFAULT_MAX_BYTES, max_distance: int = DEFAULT_MAX_DISTANCE):
+        """
+        :param directory: the root of the cache, created when missing
+        :param max_bytes: the size evict() brings the cache back to
+        :param max_distance: differing bits of the perceptual hashes of two photos still considered duplicates
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        self.photos_path = os.path.join(directory, 'photos.json')
+        self.urls = {}  # type: Dict[str, Dict[str, str]]
+        self.photos = PerceptualIndex(max_distance)
+        self.signatures = {}  # type: Dict[str, Signature]
+        self.aliases = {}  # type: Dict[str, str]
+
+        for subdirectory in ('blobs', 'variants', 'tmp'):
+            os.makedirs(os.path.join(directory, subdirectory), exist_ok=True)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as index_file:
+                self.urls = json.load(index_file)
+
+        if os.path.exists(self.photos_path):
+            with open(self.photos_path) as photos_file:
+                photos = json.load(photos_file)
+            # earlier versions kept the hashes alone: their photos are hashed again
+            if 'signatures' in photos:
+                for digest, (fingerprint, width, height, proxy) in photos['signatures'].items():
+                    self.signatures[digest] = Signature(fingerprint, width, height, base64.b64decode(proxy))
+                    self.photos.add(digest, fingerprint)
+                self.aliases = photos['aliases']
+
+    def temporary_path(self) -> str:
+        """
+        :return: a new file name, on the same file system as the cache, for content to be moved in
+        """
+        handle, file_path = tempfile.mkstemp(dir=os.path.join(self.directory, 'tmp'))
+        os.close(handle)
+        return file_path
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.directory, 'blobs', digest[:2], digest)
+
+    def lookup(self, url: str) -> Optional[str]:
+        """
+        :param url: the url of an attachment
+        :return: the digest of its last download, None when unknown or evicted meanwhile
+        """
+        entry = self.urls.get(url)
+        if entry is None:
+            return None
+
+        if not self.__touch(self.blob_path(entry['digest'])):
+            del self.urls[url]
+            return None
+
+        return entry['digest']
+
+    def request_headers(self, url: str) -> Dict[str, str]:
+        """
+        :return: the headers making a request for the url conditional, empty unless its blob is cached
+        """
+        entry = self.urls.get(url, {})
+        headers = {}
+
+        if entry.get('etag'):
+            headers[hdrs.IF_NONE_MATCH] = entry['etag']
+        if entry.get('last_modified'):
+            headers[hdrs.IF_MODIFIED_SINCE] = entry['last_modified']
+
+        return headers
+
+    def store_blob(self, url: str, file_path: str, validators: Dict[str, Optional[str]]) -> str:
+        """
+        Moves a complete download in the cache.
+
+        :param url: where it comes from
+        :param file_path: the downloaded file, from temporary_path()
+        :param validators: the ETag and Last-Modified the server answered with
+        :return: the digest of the content
+        """
+        digest = file_digest(file_path)
+        blob_path = self.blob_path(digest)
+
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        os.replace(file_path, blob_path)
+
+        # header names are case insensitive
+        validators = {name.lower(): value for name, value in validators.items() if value}
+        self.urls[url] = {'digest': digest,
+                          'etag': validators.get(hdrs.ETAG.lower()),
+                          'last_modified': validators.get(hdrs.LAST_MODIFIED.lower())}
+
+        return digest
+
+    def canonical(self, digest: str) -> Optional[str]:
+        """
+        :param digest: the digest of a downloaded photo
+        :return: the digest of the photo processed in its place, None when not hashed yet
+        """
+        return self.aliases.get(digest)
+
+    def link(self, digest: str, signature: Signature) -> str:
+        """
+        Records a downloaded photo as a duplicate of a known one, or as a new distinct photo.
+
+        Photos of too little detail to be told apart by their hash are always distinct.
+
+        :param digest: the digest of the photo
+        :param signature: its signature, see image_processing.dedupe.signature()
+        :return: the digest of the photo to process in its place, digest itself when distinct
+        """
+        if low_detail(signature.fingerprint):
+            canonical = digest
+        else:
+            canonical = next((key for key in self.photos.matches(signature.fingerprint)
+                              if same_photo(self.signatures[key], signature)), None)
+            if canonical is None:
+                canonical = digest
+                self.photos.add(digest, signature.fingerprint)
+                self.signatures[digest] = signature
+
+        self.aliases[digest] = canonical
+        return canonical
+
+    @staticmethod
+    def variant_key(digest: str, options: ImageProcessingConfiguration, image_size: Optional[ImageSize],
+                    clip: int = 0) -> str:
+        """
+        :param digest: the digest of the source image
+        :param options: the processing options of the agency
+        :param image_size: the size of the variant, None for the full size image
+        :param clip: the levels clip
+        :return: the key of the processed image
+        """
+        watermark = None
+        if options.apply_watermark and options.watermark_path:
+            # a new watermark under the same name must not serve the old marked images
+            stat = os.stat(options.watermark_path)
+            watermark = (options.watermark_path, stat.st_size, stat.st_mtime_ns)
+
+        signature = (digest, options.resize, options.normalize, clip, watermark, image_size)
+        return hashlib.sha256(repr(signature).encode('utf-8')).hexdigest()
+
+    def variant_path(self, key: str) -> Optional[str]:
+        """
+        :return: the path of the processed image with the given key, None when not cached
+        """
+        for extension in VARIANT_FORMATS:
+            file_path = os.path.join(self.directory, 'variants', key[:2], key + extension)
+            if self.__touch(file_path):
+                return file_path
+
+        return None
+
+    def store_variant(self, key: str, image: Image.Image) -> str:
+        """
+        :param key: as returned by variant_key()
+        :param image: the processed image
+        :return: the path it is stored at
+        """
+        extension = '.jpg' if image.mode in ('L', 'RGB', 'CMYK') else '.png'
+        file_path = os.path.join(self.directory, 'variants', key[:2], key + extension)
+        temporary_path = self.temporary_path()
+
+        image.save(temporary_path, VARIANT_FORMATS[extension])
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(temporary_path, file_path)
+
+        return file_path
+
+    def process(self,
+                digest: str,
+                options: ImageProcessingConfiguration,
+                sizes: Sequence[ImageSize],
+                clip: int = 0,
+                blueprint: bool = False) -> Dict[str, str]:
+        """
+        Returns the processed images of a cached blob, decoding it only when any of them is missing.
+
+        :param digest: the digest of the source image
+        :param options: the processing options of the agency
+        :param sizes: the configured sizes
+        :param clip: the levels clip
+        :param blueprint: whether the image is a floor plan, see process_attachment()
+        :return: the path of every variant by size name, in the order of sizes after the full size image
+        """
+        blob_path = self.blob_path(digest)
+        keys = OrderedDict([(FULL_SIZE, self.variant_key(digest, options, None, clip))])
+
+        if options.resize:
+            with Image.open(blob_path) as header:  # only the header is read
+                source_size = header.size
+            keys.update((image_size.name, self.variant_key(digest, options, image_size, clip))
+                        for image_size in sizes if resize_plan(source_size, image_size) is not None)
+
+        paths = OrderedDict((name, self.variant_path(key)) for name, key in keys.items())
+        if all(paths.values()):
+            return paths
+
+        variants = process_attachment(blob_path, sizes, options.resize, options.normalize,
+                                      options.watermark_path if options.apply_watermark else None, clip, blueprint)
+
+        return OrderedDict((name, self.store_variant(key, variants[name])) for name, key in keys.items())
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.__cached_files())
+
+    def evict(self) -> int:
+        """
+        Removes the least recently used files until the cache fits max_bytes.
+
+        :return: how many bytes were freed
+        """
+        files = sorted(self.__cached_files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        freed = 0
+
+        for file_path, size, _ in files:
+            if total - freed <= self.max_bytes:
+                break
+            os.remove(file_path)
+            freed += size
+
+        # urls whose blob is gone are downloaded again in full
+        self.urls = {url: entry for url, entry in self.urls.items() if os.path.exists(self.blob_path(entry['digest']))}
+
+        # and photos whose blob is gone can no longer stand for their duplicates
+        for digest in [digest for digest in self.photos.hashes if not os.path.exists(self.blob_path(digest))]:
+            self.photos.remove(digest)
+            del self.signatures[digest]
+        self.aliases = {digest: canonical for digest, canonical in self.aliases.items()
+                        if (canonical == digest or canonical in self.photos)
+                        and os.path.exists(self.blob_path(digest))}
+
+        return freed
+
+    def save(self) -> None:
+
+        self.__dump(self.urls, self.index_path)
+        signatures = {digest: (signature.fingerprint, signature.width, signature.height,
+                               base64.b64encode(signature.proxy).decode('ascii'))
+                      for digest, signature in self.signatures.items()}
+        self.__dump({'signatures': signatures, 'aliases': self.aliases}, self.photos_path)
+
+    def __dump(self, content: dict, file_path: str) -> None:
+
+        temporary_path = self.temporary_path()
+        with open(temporary_path, 'w') as json_file:
+            json.dump(content, json_file)
+        os.replace(temporary_path, file_path)
+
+    def __cached_files(self) -> Iterator[Tuple[str, int, float]]:
+
+        for subdirectory in ('blobs', 'variants'):
+            for root, _, file_names in os.walk(os.path.join(self.directory, subdirectory)):
+                for file_name in file_names:
+                    stat = os.stat(os.path.join(root, file_name))
+                    yield os.path.join(root, file_name), stat.st_size, stat.st_mtime
+
+    @staticmethod
+    def __touch(file_path: str) -> bool:
+        try:
+            os.utime(file_path, (time.time(), time.time()))
+            return True
+        except FileNotFoundError:
+            return False
@@ -0,0 +1,156 @@
+from datetime import datetime
+from typing import NamedTuple, NewType, Optional, Tuple, Callable, Any
+
+from .mapping.info_inserite import InfoInserita
+from .mapping.dati_disponibili import DatoDisponibile
+
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# a 0/1 leaf the export may leave out, some of them only come with the matching export option
+Flag = NewType('Flag', int)
+
+
+def nullable(value_parser: Callable[[str], Any]) -> Callable[[Optional[str]], Any]:
+    return lambda text: None if text is None else value_parser(text)
+
+
+def parse_date(text: Optional[str]) -> Optional[datetime]:
+    return None if text is None else datetime.strptime(text, DATE_FORMAT)
+
+
+def parse_flag(text: Optional[str]) -> int:
+    return int(text) if text else 0
+
+
+VALUE_PARSERS = {
+    int: int,
+    Optional[int]: nullable(int),
+    Flag: parse_flag,
+    Optional[float]: nullable(float),
+    str: lambda text: text or '',
+    datetime: parse_date,
+}
+
+DATI_INSERITI_SIZE = max(dato.value for dato in DatoDisponibile) + 1
+
+
+class InfoRecord(NamedTuple):
+    id: int
+    agency_code: str
+    deleted: Flag
+    flag_storico: Flag
+    flag_vetrina: Flag
+    flag_carosello: Flag
+    mq: Optional[int]
+    price: Optional[int]
+    age: str
+    ipe: Optional[float]
+    ipe_unit: str
+    description: str
+    note: str
+    abstract: str
+    finiture: str
+    provincia: str
+    comune: str
+    zona: str
+    comune_istat: str
+    indirizzo: str
+    last_editor_time: datetime
+    categorie_id: Optional[int]
+    categorie_micro_id: Optional[int]
+    spese_condominiali: Optional[int]
+    cantiere_id: Optional[int]
+    consegna: str
+
+
+class ApeRecord(NamedTuple):
+    version: Optional[int]
+    epgl_ren: Optional[float]
+    epgl_nren: Optional[float]
+    flag_quasi_zero: bool
+    prestazione_estate: Optional[str]
+    prestazione_inverno: Optional[str]
+
+
+class AllegatoRecord(NamedTuple):
+    id: int
+    file_path: str
+    planimetria: bool
+
+
+class IncaricoRecord(NamedTuple):
+    inizio: Optional[str]
+    fine: Optional[str]
+
+
+class AnnuncioRecord(NamedTuple):
+    """
+    Immutable copy of an <annuncio> element that keeps no reference to the lxml tree.
+
+    info_inserite holds the valore_assegnato of every InfoInserita at position value - 1,
+    dati_inseriti the value of every DatoDisponibile at position value; missing entries are None.
+    """
+    info: InfoRecord
+    ape: Optional[ApeRecord]
+    file_allegati: Tuple[AllegatoRecord, ...]
+    incarico: Optional[IncaricoRecord]
+    info_inserite: Tuple[Optional[int], ...]
+    dati_inseriti: Tuple[Optional[int], ...]
+
+    def info_inserita(self, info_inserita: InfoInserita) -> Optional[int]:
+        return self.info_inserite[info_inserita.value - 1]
+
+    def dato_disponibile(self, dato_disponibile: DatoDisponibile) -> Optional[int]:
+        return self.dati_inseriti[dato_disponibile.value]
+
+    @staticmethod
+    def from_element(annuncio) -> 'AnnuncioRecord':
+        """
+        Copies out an annuncio element, reading raw text so that no objectify value is ever built.
+
+        :param annuncio: the <annuncio> element to convert
+        :return: the detached record
+        """
+        info_element = annuncio.find('info')
+        ape_element = info_element.find('ape') if info_element is not None else None
+        incarico_element = info_element.find('incarico') if info_element is not None else None
+
+        if ape_element is None:
+            ape_element = annuncio.find('ape')
+        if incarico_element is None:
+            incarico_element = annuncio.find('incarico')
+
+        info_texts = {} if info_element is None else {leaf.tag: leaf.text for leaf in info_element.iterchildren()}
+        info = InfoRecord(*[VALUE_PARSERS[value_type](info_texts.get(field))
+                            for field, value_type in InfoRecord.__annotations__.items()])
+
+        ape = None if ape_element is None else ApeRecord(
+            VALUE_PARSERS[Optional[int]](ape_element.get('version')),
+            VALUE_PARSERS[Optional[float]](ape_element.get('epgl_ren')),
+            VALUE_PARSERS[Optional[float]](ape_element.get('epgl_nren')),
+            bool(int(ape_element.get('flag_quasi_zero', 0))),
+            ape_element.get('prestazione_estate'),
+            ape_element.get('prestazione_inverno'))
+
+        incarico = None if incarico_element is None else IncaricoRecord(incarico_element.get('inizio'),
+                                                                         incarico_element.get('fine'))
+
+        file_allegati = tuple(AllegatoRecord(int(allegato.get('id') or allegato.findtext('id')),
+                                             allegato.findtext('file_path') or '',
+                                             bool(int(allegato.get('planimetria', 0))))
+                              for allegato in annuncio.iterfind('file_allegati/allegato'))
+
+        info_inserite = [None] * len(InfoInserita)
+        for info_inserita in annuncio.iterfind('info_inserite/info'):
+            position = int(info_inserita.get('id') or info_inserita.findtext('id')) - 1
+            if 0 <= position < len(info_inserite):
+                info_inserite[position] = VALUE_PARSERS[Optional[int]](info_inserita.findtext('valore_assegnato'))
+
+        dati_inseriti = [None] * DATI_INSERITI_SIZE
+        for dato in annuncio.iterfind('dati_inseriti/dati'):
+            position = int(dato.get('id'))
+            if 0 <= position < len(dati_inseriti):
+                dati_inseriti[position] = VALUE_PARSERS[Optional[int]](dato.text)
+
+        return AnnuncioRecord(info, ape, file_allegati, incarico, tuple(info_inserite), tuple(dati_inseriti))
@@ -0,0 +1,126 @@
+import enum
+import hashlib
+
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple, Type
+
+from configuration.db_access import ListingSyncState
+from .records import AnnuncioRecord
+
+# rows written per statement: SQLite binds at most 999 variables
+WRITE_BATCH_SIZE = 100
+
+
+class ListingChange(enum.Enum):
+    new = 'new'
+    changed = 'changed'
+    unchanged = 'unchanged'
+
+
+def content_hash(record: AnnuncioRecord) -> str:
+    """
+    :return: a fingerprint of everything the export says about a listing
+    """
+    return hashlib.sha1(repr(record).encode('utf-8')).hexdigest()
+
+
+class SyncStateStore:
+    """
+    Compares the listings of an export with those of the last successful sync of the agency,
+    so that only the difference has to be acted upon.
+
+    What is published, and so what has to be unpublished, is up to the listing id index alone:
+    the store only tells whether the content of the exported listings changed.
+
+    Nothing is written until commit(): a sync failing halfway finds the same state again next time.
+    load() and commit() query the database: run them in an executor from the event loop.
+    """
+
+    def __init__(self, agency_description: str, model: Type[ListingSyncState] = ListingSyncState):
+        """
+        :param agency_description: the agency whose listings are compared
+        :param model: where the state is kept, LocalListingSyncState when it is a SQLite file of its own
+        """
+        self.agency_description = agency_description
+        self.model = model
+        self.known = {}  # type: Dict[int, Tuple[Optional[datetime], str]]
+        self.seen = {}  # type: Dict[int, Tuple[Optional[datetime], str, ListingChange]]
+
+    def load(self) -> None:
+        """
+        Reads the state left by the last sync, forgetting any listing classified meanwhile.
+        """
+        query = self.model.select(self.model.listing_id,
+                                  self.model.last_editor_time,
+                                  self.model.content_hash) \
+            .where(self.model.agency_description == self.agency_description)
+
+        self.known = {state.listing_id: (state.last_editor_time, state.content_hash) for state in query}
+        self.seen = {}
+
+    def classify(self, record: AnnuncioRecord) -> ListingChange:
+        """
+        :param record: a listing of the export
+        :return: how the listing compares with the last sync
+        """
+        fingerprint = content_hash(record)
+        known = self.known.get(record.info.id)
+
+        if known is None:
+            change = ListingChange.new
+        elif known == (record.info.last_editor_time, fingerprint):
+            change = ListingChange.unchanged
+        else:
+            change = ListingChange.changed
+
+        self.seen[record.info.id] = (record.info.last_editor_time, fingerprint, change)
+        return change
+
+    def invalidate(self, listing_id: int) -> None:
+        """
+        Makes a listing classified by this sync changed for the next one, as when it could not be fully processed.
+        """
+        last_editor_time, _, change = self.seen[listing_id]
+        self.seen[listing_id] = (last_editor_time, '',
+                                 ListingChange.changed if change is ListingChange.unchanged else change)
+
+    def missing(self) -> List[int]:
+        """
+        :return: the listings of the last sync missing from the export, once every listing was classified,
+                 whose state commit() drops
+        """
+        return sorted(listing_id for listing_id in self.known if listing_id not in self.seen)
+
+    def counts(self) -> Counter:
+        return Counter(change for _, _, change in self.seen.values())
+
+    def commit(self) -> None:
+        """
+        Makes the listings classified so far the state of the agency, in a single transaction.
+        """
+        changes = {change: [] for change in ListingChange}
+        for listing_id, (last_editor_time, fingerprint, change) in self.seen.items():
+            changes[change].append((listing_id, last_editor_time, fingerprint))
+        missing = self.missing()
+
+        with self.model._meta.database.atomic():
+            for start in range(0, len(missing), WRITE_BATCH_SIZE):
+                self.model.delete().where(
+                    (self.model.agency_description == self.agency_description)
+                    & (self.model.listing_id << missing[start:start + WRITE_BATCH_SIZE])).execute()
+
+            for listing_id, last_editor_time, fingerprint in changes[ListingChange.changed]:
+                self.model.update(last_editor_time=last_editor_time, content_hash=fingerprint).where(
+                    (self.model.agency_description == self.agency_description)
+                    & (self.model.listing_id == listing_id)).execute()
+
+            new = [{'agency_description': self.agency_description, 'listing_id': listing_id,
+                    'last_editor_time': last_editor_time, 'content_hash': fingerprint}
+                   for listing_id, last_editor_time, fingerprint in changes[ListingChange.new]]
+            for start in range(0, len(new), WRITE_BATCH_SIZE):
+                self.model.insert_many(new[start:start + WRITE_BATCH_SIZE]).execute()
+
+        self.known = {listing_id: (last_editor_time, fingerprint)
+                      for listing_id, (last_editor_time, fingerprint, _) in self.seen.items()}
+        self.seen = {}
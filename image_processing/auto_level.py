@@ -0,0 +1,55 @@
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from . import LEVELS_MODES, make_lut
+
+DEFAULT_TILE_SIZE = 512
+
+
+def iter_tiles(size: Tuple[int, int], tile_size: int = DEFAULT_TILE_SIZE) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    :param size: width and height of the image
+    :param tile_size: the side of the tiles, the last row and column are cut to the image
+    :return: the boxes of the tiles, row by row
+    """
+    width, height = size
+
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            yield left, top, min(left + tile_size, width), min(top + tile_size, height)
+
+
+def tiled_histogram(data: Image, tile_size: int = DEFAULT_TILE_SIZE) -> List[int]:
+
+    histogram = np.zeros(256 * len(data.getbands()), dtype=np.int64)
+
+    for box in iter_tiles(data.size, tile_size):
+        histogram += data.crop(box).histogram()
+
+    return histogram.tolist()
+
+
+def auto_level(data: Image, all_same: int = 0, clip: int = 0, tile_size: int = DEFAULT_TILE_SIZE) -> Image:
+    """
+    Same as image_processing.levels(), but the image is read and written one tile at a time.
+
+    The table is applied in place, so that on top of the image itself only a tile is ever allocated,
+    where levels() makes a whole levelled copy. Meant for huge scans, such as floor plans.
+
+    :param data: the image to level, modified in place
+    :param all_same: see levels()
+    :param clip: see levels()
+    :param tile_size: the side of the tiles
+    :return: the levelled image, that is data itself
+    """
+    if data.mode not in LEVELS_MODES:
+        return data
+
+    lut = make_lut(tiled_histogram(data, tile_size), data.mode, all_same, clip)
+
+    for box in iter_tiles(data.size, tile_size):
+        data.paste(data.crop(box).point(lut), box)
+
+    return data
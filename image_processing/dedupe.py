@@ -0,0 +1,169 @@
+from collections import defaultdict
+from typing import BinaryIO, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+# side of the grid of brightness differences: 8 makes 64 bit hashes
+DEFAULT_HASH_SIZE = 8
+# differing bits still considered the same photo: survives recompression and resizing, not cropping
+DEFAULT_MAX_DISTANCE = 4
+# bits a hash needs both set and clear to tell photos apart: flat images and plain gradients all hash alike
+DEFAULT_MIN_DETAIL = 8
+# side of the greyscale thumbnail confirming that photos with close hashes are the same
+PROXY_SIZE = 16
+# difference of any pixel of the thumbnails, out of 255, still considered the same photo:
+# copies stay within a few levels, floor plans with close hashes differ by 40 and more
+DEFAULT_MAX_PROXY_DIFFERENCE = 16
+# difference of the aspect ratios still considered the same photo, relative
+DEFAULT_MAX_ASPECT_DIFFERENCE = 0.02
+
+
+class Signature(NamedTuple):
+    """
+    What tells whether two photos are the same: the hash finds the candidates, the rest confirms them.
+    """
+    fingerprint: int  # see dhash()
+    width: int
+    height: int
+    proxy: bytes  # PROXY_SIZE x PROXY_SIZE greyscale thumbnail
+
+
+def dhash(source: Union[str, BinaryIO, Image.Image], hash_size: int = DEFAULT_HASH_SIZE) -> int:
+    """
+    Difference hash: whether every cell of a tiny greyscale copy is brighter than its right neighbour.
+
+    JPEG files are decoded at reduced scale, the hash never needs more than a thumbnail.
+
+    :param source: a file name, a binary file object or an image
+    :param hash_size: the side of the grid, the hash has hash_size ** 2 bits
+    :return: the hash, as an integer
+    """
+    return signature(source, hash_size).fingerprint
+
+
+def signature(source: Union[str, BinaryIO, Image.Image], hash_size: int = DEFAULT_HASH_SIZE) -> Signature:
+    """
+    :param source: a file name, a binary file object or an image
+    :param hash_size: the side of the grid of the hash
+    :return: the signature of the image, decoded at reduced scale as in dhash()
+    """
+    if isinstance(source, Image.Image):
+        return image_signature(source, source.size, hash_size)
+
+    with Image.open(source) as image:
+        size = image.size
+        image.draft('L', (hash_size * 8, hash_size * 8))
+        return image_signature(image, size, hash_size)
+
+
+def image_signature(image: Image.Image, size: Tuple[int, int], hash_size: int = DEFAULT_HASH_SIZE) -> Signature:
+
+    grey = image.convert('L')
+    pixels = np.asarray(grey.resize((hash_size + 1, hash_size), Image.BOX), dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+
+    return Signature(int(''.join('1' if bit else '0' for bit in bits), 2), size[0], size[1],
+                     grey.resize((PROXY_SIZE, PROXY_SIZE), Image.BOX).tobytes())
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def low_detail(fingerprint: int, bits: int = DEFAULT_HASH_SIZE ** 2, min_detail: int = DEFAULT_MIN_DETAIL) -> bool:
+    """
+    :return: whether a hash has too few bits set, or clear, to stand for a single photo
+    """
+    ones = bin(fingerprint).count('1')
+    return min(ones, bits - ones) < min_detail
+
+
+def same_photo(a: Signature, b: Signature,
+               max_proxy_difference: int = DEFAULT_MAX_PROXY_DIFFERENCE,
+               max_aspect_difference: float = DEFAULT_MAX_ASPECT_DIFFERENCE) -> bool:
+    """
+    Confirms a match of the hashes: near identical hashes are common among floor plans, or among
+    pictures of white walls, which share the same layout of brightness with none of the detail.
+
+    :return: whether two photos of close hashes have the same shape and the same thumbnail
+    """
+    aspect_a, aspect_b = a.width / a.height, b.width / b.height
+    if abs(aspect_a - aspect_b) > max_aspect_difference * max(aspect_a, aspect_b):
+        return False
+
+    difference = np.abs(np.frombuffer(a.proxy, dtype=np.uint8).astype(np.int16)
+                        - np.frombuffer(b.proxy, dtype=np.uint8))
+    return int(difference.max()) <= max_proxy_difference
+
+
+class PerceptualIndex:
+    """
+    Hashes by key, searchable by Hamming distance.
+
+    Hashes are split in max_distance + 1 bands: two hashes differing by at most max_distance bits
+    have at least one band in common, so only the keys sharing a band are ever compared.
+    """
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE, bits: int = DEFAULT_HASH_SIZE ** 2):
+        """
+        :param max_distance: differing bits still considered a match
+        :param bits: the length of the hashes
+        """
+        self.max_distance = max_distance
+        self.hashes = {}  # type: Dict[str, int]
+
+        width, extra = divmod(bits, max_distance + 1)
+        self.bands = []  # type: List[Tuple[int, int]]
+        shift = 0
+        for band in range(max_distance + 1):
+            band_width = width + (1 if band < extra else 0)
+            self.bands.append((shift, (1 << band_width) - 1))
+            shift += band_width
+
+        self.buckets = [defaultdict(set) for _ in self.bands]  # type: List[Dict[int, Set[str]]]
+
+    def __len__(self) -> int:
+        return len(self.hashes)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.hashes
+
+    def add(self, key: str, fingerprint: int) -> None:
+
+        self.remove(key)
+        self.hashes[key] = fingerprint
+        for bucket, value in zip(self.buckets, self.__band_values(fingerprint)):
+            bucket[value].add(key)
+
+    def remove(self, key: str) -> None:
+
+        fingerprint = self.hashes.pop(key, None)
+        if fingerprint is None:
+            return
+
+        for bucket, value in zip(self.buckets, self.__band_values(fingerprint)):
+            bucket[value].discard(key)
+            if not bucket[value]:
+                del bucket[value]
+
+    def find(self, fingerprint: int) -> Optional[str]:
+        """
+        :return: the key of the closest hash within max_distance, None when there is none
+        """
+        return next(iter(self.matches(fingerprint)), None)
+
+    def matches(self, fingerprint: int) -> List[str]:
+        """
+        :return: the keys of the hashes within max_distance, closest first
+        """
+        candidates = set()
+        for bucket, value in zip(self.buckets, self.__band_values(fingerprint)):
+            candidates.update(bucket.get(value, ()))
+
+        distances = sorted((hamming(fingerprint, self.hashes[key]), key) for key in candidates)
+
+        return [key for distance, key in distances if distance <= self.max_distance]
+
+    def __band_values(self, fingerprint: int) -> Iterator[int]:
+        return ((fingerprint >> shift) & mask for shift, mask in self.bands)
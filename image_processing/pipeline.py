@@ -0,0 +1,129 @@
+from collections import OrderedDict
+from typing import BinaryIO, Dict, Optional, Sequence, Tuple, Union
+
+from PIL import Image
+
+from . import open_levelled
+from .auto_level import auto_level
+from .watermark import get_watermark
+
+# key of the variant holding the image at its original size, as WordPress names it
+FULL_SIZE = 'full'
+
+# images larger than this are levelled in place one tile at a time, as floor plans always are
+TILED_LEVELS_PIXELS = 6000 * 4000
+
+# name, width, height and whether to crop, as WordPress sizes are registered: 0 leaves a side unbounded
+ImageSize = Tuple[str, int, int, bool]
+
+
+def resize_plan(source_size: Tuple[int, int],
+                image_size: ImageSize) -> Optional[Tuple[Tuple[int, int], Optional[Tuple[int, int, int, int]]]]:
+    """
+    Works out how an image is brought to a WordPress size, which never enlarges images.
+
+    :param source_size: width and height of the original image
+    :param image_size: the size to produce
+    :return: the size to resize to and the box to crop afterwards, if any, None when the image is small enough
+    """
+    width, height = source_size
+    _, target_width, target_height, crop = image_size
+
+    if crop and target_width and target_height:
+        scale = max(target_width / width, target_height / height)
+        if scale >= 1:
+            return None
+
+        resized = (max(target_width, round(width * scale)), max(target_height, round(height * scale)))
+        left = (resized[0] - target_width) // 2
+        top = (resized[1] - target_height) // 2
+
+        return resized, (left, top, left + target_width, top + target_height)
+
+    scales = [limit / side for limit, side in ((target_width, width), (target_height, height)) if limit]
+    scale = min(scales, default=1)
+    if scale >= 1:
+        return None
+
+    return (max(1, round(width * scale)), max(1, round(height * scale))), None
+
+
+def render_variants(data: Image.Image, sizes: Sequence[ImageSize]) -> Dict[str, Image.Image]:
+    """
+    Produces every size of an image, largest first, each one resized from the smallest
+    uncropped variant already made that is still large enough.
+
+    :param data: the decoded image at its original size
+    :param sizes: the sizes to produce
+    :return: the variants by size name, sizes the image is too small for are skipped
+    """
+    plans = [(image_size, plan) for image_size in sizes for plan in [resize_plan(data.size, image_size)] if plan]
+    plans.sort(key=lambda p: p[1][0][0] * p[1][0][1], reverse=True)
+
+    sources = [data]
+    variants = OrderedDict()
+
+    for image_size, (resized, box) in plans:
+        source = min((s for s in sources if s.width >= resized[0] and s.height >= resized[1]),
+                     key=lambda s: s.width * s.height)
+        variant = source if source.size == resized else source.resize(resized, Image.LANCZOS)
+
+        if box is None:
+            sources.append(variant)
+        else:
+            variant = variant.crop(box)
+
+        variants[image_size[0]] = variant
+
+    return variants
+
+
+def process_attachment(source: Union[str, BinaryIO],
+                       sizes: Sequence[ImageSize],
+                       resize: bool = True,
+                       normalize: bool = True,
+                       watermark_path: Optional[str] = None,
+                       clip: int = 0,
+                       blueprint: bool = False) -> Dict[str, Image.Image]:
+    """
+    Decodes a downloaded photo once and derives every variant WordPress needs from it.
+
+    :param source: a file name or a binary file object
+    :param sizes: the sizes to produce, when resizing
+    :param resize: whether to produce the sizes
+    :param normalize: whether to apply auto levels
+    :param watermark_path: the watermark to apply on every variant, None for none
+    :param clip: see image_processing.levels(), used when normalizing
+    :param blueprint: whether the image is a floor plan, huge scans that are levelled in place
+    :return: the full size image, under FULL_SIZE, followed by the resized variants
+    """
+    data = Image.open(source)
+
+    if normalize and (blueprint or data.width * data.height > TILED_LEVELS_PIXELS):
+        # no levelled copy of the whole image is ever made, only of a tile at a time
+        data.load()
+        data = auto_level(data, clip=clip)
+    elif normalize:
+        # only the header was read, open_levelled() decodes on its own terms
+        if isinstance(source, str):
+            data.close()
+        else:
+            source.seek(0)
+        data = open_levelled(source, clip=clip)
+    else:
+        data.load()
+
+    variants = OrderedDict([(FULL_SIZE, data)])
+    if resize:
+        variants.update(render_variants(data, sizes))
+
+    # marked last, each variant on its own: resizing a marked image would shrink its watermark too
+    if watermark_path:
+        watermark = get_watermark(watermark_path)
+        marked = {}
+        for name, variant in variants.items():
+            if id(variant) not in marked:
+                marked[id(variant)] = watermark.apply(variant)
+            variants[name] = marked[id(variant)]
+
+    return variants
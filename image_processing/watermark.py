@@ -0,0 +1,84 @@
+from functools import lru_cache
+from typing import BinaryIO, Tuple, Union
+
+from PIL import Image
+
+# width of the watermark, relative to the width of the photo
+DEFAULT_RELATIVE_WIDTH = 0.25
+# space left between the watermark and the borders of the photo, relative to the width of the photo
+DEFAULT_RELATIVE_MARGIN = 0.02
+# scaled watermarks kept around: one per output width and mode in use
+DEFAULT_CACHE_SIZE = 64
+# modes a watermark is pasted on as they are: palettes would map its colours to the nearest entries
+COMPOSITED_MODES = ('L', 'LA', 'RGB', 'RGBA', 'CMYK')
+
+
+class Watermark:
+    """
+    A watermark, loaded once and kept premultiplied by its alpha, so that scaling never bleeds
+    the colour of transparent pixels into the visible ones.
+
+    Scaled copies are cached by output width: a catalog only ever asks for a handful of sizes.
+    """
+
+    def __init__(self,
+                 source: Union[str, BinaryIO],
+                 relative_width: float = DEFAULT_RELATIVE_WIDTH,
+                 relative_margin: float = DEFAULT_RELATIVE_MARGIN,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        """
+        :param source: a file name or a binary file object holding the watermark, transparency is preserved
+        :param relative_width: width of the watermark, relative to the width of the photo
+        :param relative_margin: distance from the bottom right corner, relative to the width of the photo
+        :param cache_size: how many scaled copies are kept
+        """
+        with Image.open(source) as image:
+            self.premultiplied = image.convert('RGBA').convert('RGBa')
+
+        self.relative_width = relative_width
+        self.relative_margin = relative_margin
+        self.scaled = lru_cache(maxsize=cache_size)(self.scale)
+
+    def scale(self, width: int, mode: str) -> Tuple[Image.Image, Image.Image]:
+        """
+        :param width: the width of the scaled watermark
+        :param mode: the mode of the photos it is applied on
+        :return: the colour, in the given mode, and the alpha of the scaled watermark
+        """
+        height = max(1, round(self.premultiplied.height * width / self.premultiplied.width))
+        scaled = self.premultiplied.resize((width, height), Image.LANCZOS).convert('RGBA')
+
+        return scaled.convert(mode), scaled.getchannel('A')
+
+    def apply(self, photo: Image.Image) -> Image.Image:
+        """
+        Composites the watermark in the bottom right corner of a photo.
+
+        Photos of any mode but COMPOSITED_MODES, such as GIF palettes, are converted to RGB,
+        or to RGBA when transparent, and marked as a copy.
+
+        :param photo: the photo, modified in place when of one of COMPOSITED_MODES
+        :return: the marked photo
+        """
+        if photo.mode not in COMPOSITED_MODES:
+            transparent = 'A' in photo.getbands() or 'transparency' in photo.info
+            photo = photo.convert('RGBA' if transparent else 'RGB')
+
+        width = max(1, round(photo.width * self.relative_width))
+        colour, alpha = self.scaled(width, photo.mode)
+
+        margin = round(photo.width * self.relative_margin)
+        left = max(0, photo.width - colour.width - margin)
+        top = max(0, photo.height - colour.height - margin)
+        photo.paste(colour, (left, top), alpha)
+
+        return photo
+
+
+@lru_cache(maxsize=None)
+def get_watermark(file_path: str) -> Watermark:
+    """
+    :param file_path: the path of the watermark file of an agency
+    :return: the watermark, loaded once per process
+    """
+    return Watermark(file_path)
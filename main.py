@@ -1,20 +1,117 @@
-import yaml
+import os
+import sys
+import time
+import traceback
 
-from asyncio import get_event_loop, coroutine
+from asyncio import get_event_loop, coroutine, gather, Semaphore
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
 
 import configuration
+from configuration import db_access
 from gestionaleimmobiliare.sync_agenzia.agent import SyncAgenziaAgent
+from gestionaleimmobiliare.sync_agenzia.attachments import AttachmentDownloader
+from gestionaleimmobiliare.sync_agenzia.fetch_remote import HttpValidators, close_session
+from gestionaleimmobiliare.sync_agenzia.image_pool import ImageWorkerPool
+from gestionaleimmobiliare.sync_agenzia.media_cache import MediaCache
+from gestionaleimmobiliare.sync_agenzia.sync_state import SyncStateStore
+from gestionaleimmobiliare.sync_agenzia.listing_ids import index_path
+
+
+class SyncOutcome(NamedTuple):
+    description: str
+    elapsed: float
+    error: Optional[BaseException]
+
+
+@coroutine
+def synchronize_agency(agent: SyncAgenziaAgent, semaphore: Semaphore) -> SyncOutcome:
+
+    with (yield from semaphore):
+        started = time.monotonic()
+        try:
+            yield from agent.synchronize_wordpress()
+            error = None
+        except Exception as e:  # one agency failing must not stop the others
+            traceback.print_exc()
+            error = e
+
+        return SyncOutcome(agent.description, time.monotonic() - started, error)
+
+
+def print_summary(outcomes: List[SyncOutcome], elapsed: float) -> None:
+
+    print('{:<40} {:>10}  {}'.format('agency', 'seconds', 'outcome'))
+    for outcome in outcomes:
+        print('{:<40} {:>10.2f}  {}'.format(outcome.description,
+                                            outcome.elapsed,
+                                            'ok' if outcome.error is None else 'failed: {!r}'.format(outcome.error)))
+    print('{} agencies synchronized in {:.2f} seconds'.format(len(outcomes), elapsed))
 
 
 @coroutine
 def main():
 
-    verona_agent = SyncAgenziaAgent(configuration.get().agencies_configuration[0])
+    conf = configuration.get()
+    if conf.cache_directory is not None:
+        os.makedirs(conf.cache_directory, exist_ok=True)
+
+    # the sync state lives next to the configuration, or in the cache when that is a file
+    state_model = None
+    if db_access.db_proxy.obj is not None:
+        state_model = db_access.ListingSyncState
+    elif conf.cache_directory is not None:
+        db_access.sync_state_initialize(os.path.join(conf.cache_directory, 'sync_state.sqlite'))
+        state_model = db_access.LocalListingSyncState
+    if state_model is not None:
+        state_model.create_table(fail_silently=True)
+
+    semaphore = Semaphore(conf.max_concurrent_syncs)
+    validators = HttpValidators(None if conf.cache_directory is None
+                                else os.path.join(conf.cache_directory, 'export_validators.json'))
+    # a single core is better used by the parsing thread alone than by a pool of one
+    parse_executor = ProcessPoolExecutor(conf.parse_workers) if conf.parse_workers > 1 else None
+    # one parsing thread per sync running at once, apart from the default executor the downloads wait on
+    parse_threads = ThreadPoolExecutor(conf.max_concurrent_syncs)
+
+    # photos are kept in the cache: without one they are left alone
+    image_executor, image_pool, downloader = None, None, None
+    if conf.cache_directory is not None:
+        # rendering photos on the event loop would stall every download, a pool is needed even on a single core
+        image_workers = conf.parse_workers if parse_executor is not None else os.cpu_count() or 1
+        image_executor = parse_executor if parse_executor is not None else ProcessPoolExecutor(image_workers)
+        image_pool = ImageWorkerPool(MediaCache(os.path.join(conf.cache_directory, 'media')),
+                                     image_executor, 2 * image_workers)
+        downloader = AttachmentDownloader()
+
+    agents = [SyncAgenziaAgent(agency_conf, conf.connection_timeout, validators, parse_executor,
+                               None if state_model is None else SyncStateStore(agency_conf.description, state_model),
+                               None if conf.cache_directory is None
+                               else index_path(conf.cache_directory, agency_conf.description),
+                               image_pool, downloader, conf.image_sizes, parse_threads)
+              for agency_conf in conf.agencies_configuration]
+
+    started = time.monotonic()
+    try:
+        outcomes = yield from gather(*[synchronize_agency(agent, semaphore) for agent in agents])
+    finally:
+        close_session()
+        parse_threads.shutdown()
+        if parse_executor is not None:
+            parse_executor.shutdown()
+        if image_executor is not None and image_executor is not parse_executor:
+            image_executor.shutdown()
+    validators.save()
+    if image_pool is not None:
+        print('attachments: {}, {} bytes evicted from the cache'.format(downloader.stats, image_pool.cache.evict()))
+        image_pool.cache.save()
+    print_summary(outcomes, time.monotonic() - started)
 
-    verona_agent.synchronize_wordpress()
-    print(verona_agent)
+    return all(outcome.error is None for outcome in outcomes)
 
 
 if __name__ == '__main__':
     loop = get_event_loop()
-    loop.run_until_complete(main())
+    succeeded = loop.run_until_complete(main())
+    loop.close()
+    sys.exit(0 if succeeded else 1)
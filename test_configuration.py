@@ -1,3 +1,4 @@
+import json
 import unittest
 import os
 import inspect
@@ -155,3 +156,33 @@ class YamlFileConfigurationTests(unittest.TestCase):
 
     def test_get_configuration(self):
         self.assertEqual(configuration.get(), mock_result())
+
+
+class LocalConfigurationTests(unittest.TestCase):
+
+    def test_max_concurrent_syncs(self):
+        self.assertEqual(configuration.LocalConfiguration({'max_concurrent_syncs': 8}).max_concurrent_syncs, 8)
+        self.assertEqual(configuration.LocalConfiguration({'max_concurrent_syncs': '0'}).max_concurrent_syncs, 1)
+        self.assertEqual(configuration.LocalConfiguration({'max_concurrent_syncs': 'many'}).max_concurrent_syncs,
+                         configuration.LocalConfiguration.DEFAULT_MAX_CONCURRENT_SYNCS)
+        self.assertEqual(configuration.LocalConfiguration({}).max_concurrent_syncs,
+                         configuration.LocalConfiguration.DEFAULT_MAX_CONCURRENT_SYNCS)
+
+    def test_image_sizes(self):
+        sizes = {'thumbnail': {'width': 150, 'height': 150, 'crop': 1}, 'wide': {'width': 1920}}
+
+        self.assertEqual(configuration.LocalConfiguration({'image_sizes': sizes}).image_sizes,
+                         [configuration.ImageSize('thumbnail', 150, 150, True),
+                          configuration.ImageSize('wide', 1920, 0, False)])
+        self.assertEqual(configuration.LocalConfiguration({'image_sizes': json.dumps(sizes)}).image_sizes,
+                         configuration.LocalConfiguration({'image_sizes': sizes}).image_sizes,
+                         'Sizes stored as json should be decoded')
+        self.assertEqual(configuration.LocalConfiguration({'image_sizes': 'small'}).image_sizes,
+                         list(configuration.DEFAULT_IMAGE_SIZES))
+        self.assertEqual(configuration.LocalConfiguration({}).image_sizes, list(configuration.DEFAULT_IMAGE_SIZES))
+
+    def test_parse_workers(self):
+        self.assertEqual(configuration.LocalConfiguration({'parse_workers': '16'}).parse_workers, 16)
+        self.assertEqual(configuration.LocalConfiguration({'parse_workers': -2}).parse_workers, 1)
+        self.assertEqual(configuration.LocalConfiguration({}).parse_workers,
+                         configuration.LocalConfiguration.DEFAULT_PARSE_WORKERS)
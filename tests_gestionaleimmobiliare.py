@@ -1,12 +1,38 @@
+import asyncio
+import os
+import pickle
 import tarfile
+import tempfile
+import threading
 import unittest
-from io import BufferedReader
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from io import BufferedReader, BytesIO
 from os.path import join
+from unittest import mock
 
-from gestionaleimmobiliare.sync_agenzia.fetch_remote import TarFile, TarGzFile
-from gestionaleimmobiliare.sync_agenzia.agent import SyncInterpreter
-from gestionaleimmobiliare.sync_agenzia.mapping.info_inserite import InfoInserita, EnergyLabel
+from aiohttp import web
+from aiohttp import test_utils
+import numpy as np
+from PIL import Image
+
+from gestionaleimmobiliare.sync_agenzia.fetch_remote import TarFile, TarGzFile, GIFetch, HttpValidators, ChunkPipe, \
+    close_session
+from configuration import AgencyConfiguration, ImageProcessingConfiguration, DEFAULT_IMAGE_SIZES
+from gestionaleimmobiliare.sync_agenzia.attachments import AttachmentDownloader, AdaptiveLimit
+from gestionaleimmobiliare.sync_agenzia.media_cache import MediaCache
+from gestionaleimmobiliare.sync_agenzia.image_pool import ImageWorkerPool
+from image_processing.dedupe import signature
+from gestionaleimmobiliare.sync_agenzia.agent import SyncAgenziaAgent, SyncInterpreter, PhotoTasks, parse_records, InfoElement, AllegatoElement, ApeElement
+from gestionaleimmobiliare.sync_agenzia.mapping.info_inserite import InfoInserita, EnergyLabel, ManteinanceLevel, Tag
+from gestionaleimmobiliare.sync_agenzia.mapping.decode import INFO_DECODE_TABLE, decode_info_inserite
 from gestionaleimmobiliare.sync_agenzia.mapping.dati_disponibili import DatoDisponibile
+from gestionaleimmobiliare.sync_agenzia.records import AnnuncioRecord
+from gestionaleimmobiliare.sync_agenzia.feature_matrix import FeatureMatrix
+from gestionaleimmobiliare.sync_agenzia.sync_state import ListingChange, SyncStateStore
+from gestionaleimmobiliare.sync_agenzia.listing_ids import ExportIds, ListingIdIndex, index_path
+from configuration.db_access import sync_state_initialize, sync_state_proxy, LocalListingSyncState
+from peewee import SqliteDatabase
 
 relative_path = ['tests', 'resources']
 test_archive_content = ['test-tar-archive',
@@ -44,17 +70,46 @@ class TarFileTests(unittest.TestCase):
                               'Test archive and expected files in it do not match')
 
     def test_open_xmls(self) -> None:
-        archive = self.mock_archive('test-tar-archive.tar')
-        xml_files = archive.extract_xml_files()
+        with self.mock_archive('test-tar-archive.tar') as archive:
+            xml_files = dict(archive.extract_xml_files())
+
+            self.assertEqual(len(xml_files), 2)
+
+            for xml_buf in xml_files.values():
+                self.assertIsInstance(xml_buf, BufferedReader,
+                                      'Every returned file object should be a buffer')
+
+            self.assertEqual(xml_files['test-tar-archive/test-file.xml'].read().decode('utf-8'), xml_note)
+
+        self.assertTrue(archive.closed, 'Leaving the context should close the archive')
+
+    def test_lazy_extraction(self) -> None:
+        with self.mock_archive('test-tar-archive.tar') as archive:
+            xml_files = archive.extract_xml_files()
+            next(xml_files)
+
+            self.assertCountEqual(archive.list_content(), test_archive_content)
+            self.assertFalse(archive.closed, 'Listing an open archive should leave it open')
 
-        self.assertEqual(len(xml_files), 2)
+            name, xml_file = next(xml_files)
+            self.assertEqual(name, 'test-tar-archive/test-file.xml')
+            self.assertEqual(xml_file.read().decode('utf-8'), xml_note)
+            self.assertEqual(list(xml_files), [])
 
-        for xml_buf in archive.extract_xml_files():
-            self.assertIsInstance(xml_buf, BufferedReader,
-                                  'Every returned file object should be a buffer')
+    def test_path_source(self) -> None:
+        archive = TarFile(join(*relative_path, 'test-tar-archive.tar'))
+        xml_files = dict(archive.extract_xml_files())
 
-        self.assertEqual(xml_files[1].read().decode('utf-8'), xml_note)
+        self.assertEqual(xml_files['test-tar-archive/test-file.xml'].read().decode('utf-8'), xml_note)
         archive.close()
+        self.assertEqual(archive.opened_resources, [], 'Archive file and memory map should be released')
+
+    def test_file_source(self) -> None:
+        with open(join(*relative_path, 'test-tar-archive.tar'), 'rb') as f:
+            archive = TarFile(f)
+            self.assertCountEqual(archive.list_content(), test_archive_content)
+            self.assertCountEqual(archive.list_content(), test_archive_content, 'Archives should be reopened')
+            self.assertFalse(f.closed, 'Sources not owned by the archive should be left open')
 
     def mock_archive(self, archive_name: str) -> TarFile:
         with open(join(*relative_path, archive_name), 'rb') as f:
@@ -75,23 +130,693 @@ class TarGzFileTests(unittest.TestCase):
                               'Test archive and expected files in it do not match')
 
     def test_open_xmls(self) -> None:
-        archive = self.mock_archive('test-tar-archive.tar.gz')
-        xml_files = archive.extract_xml_files()
+        with self.mock_archive('test-tar-archive.tar.gz') as archive:
+            xml_files = dict(archive.extract_xml_files())
 
-        self.assertEqual(len(xml_files), 2)
+            self.assertEqual(len(xml_files), 2)
 
-        for xml_buf in archive.extract_xml_files():
-            self.assertIsInstance(xml_buf, BufferedReader,
-                                  'Every returned file object should be a buffer')
+            for xml_buf in xml_files.values():
+                self.assertIsInstance(xml_buf, BufferedReader,
+                                      'Every returned file object should be a buffer')
 
-        self.assertEqual(xml_files[1].read().decode('utf-8'), xml_note)
-        archive.close()
+            self.assertEqual(xml_files['test-tar-archive/test-file.xml'].read().decode('utf-8'), xml_note)
+
+        self.assertTrue(archive.closed, 'Leaving the context should close the archive')
+
+    def test_lazy_extraction(self) -> None:
+        with self.mock_archive('test-tar-archive.tar.gz') as archive:
+            xml_files = archive.extract_xml_files()
+            next(xml_files)
+
+            self.assertCountEqual(archive.list_content(), test_archive_content)
+            self.assertFalse(archive.closed, 'Listing an open archive should leave it open')
+
+            name, xml_file = next(xml_files)
+            self.assertEqual(name, 'test-tar-archive/test-file.xml')
+            self.assertEqual(xml_file.read().decode('utf-8'), xml_note)
+            self.assertEqual(list(xml_files), [])
+
+    def test_path_source(self) -> None:
+        archive = TarGzFile(join(*relative_path, 'test-tar-archive.tar.gz'))
+        self.assertCountEqual(archive.list_content(), test_archive_content)
 
     def mock_archive(self, archive_name: str) -> TarGzFile:
         with open(join(*relative_path, archive_name), 'rb') as f:
             return TarGzFile(f.read(), archive_name=archive_name)
 
 
+class GIFetchTests(unittest.TestCase):
+
+    etag = '"export-v1"'
+
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.requests = []
+
+        with open(join(*relative_path, 'test-tar-archive.tar.gz'), 'rb') as f:
+            self.tarball = f.read()
+
+        app = web.Application()
+        app.router.add_get('/export', self.export_handler)
+        self.server = test_utils.TestServer(app)
+        self.loop.run_until_complete(self.server.start_server(loop=self.loop))
+
+    def tearDown(self) -> None:
+        close_session()
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+
+    @asyncio.coroutine
+    def export_handler(self, request: web.Request) -> web.Response:
+        self.requests.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == self.etag:
+            return web.Response(status=304)
+        return web.Response(body=self.tarball, headers={'ETag': self.etag})
+
+    def fetch(self, validators: HttpValidators) -> GIFetch:
+        return GIFetch(str(self.server.make_url('/export')), validators=validators)
+
+    def test_conditional_get(self) -> None:
+        with tempfile.TemporaryDirectory() as cache_directory:
+            validators_path = os.path.join(cache_directory, 'validators.json')
+            validators = HttpValidators(validators_path)
+
+            fetch = self.fetch(validators)
+            with self.loop.run_until_complete(fetch.get_remote_tarball()) as tarball:
+                self.assertEqual(tarball.read(), self.tarball)
+
+            fetch = self.fetch(validators)
+            tarball = self.loop.run_until_complete(fetch.get_remote_tarball())
+            self.assertIsNotNone(tarball, 'Downloads should not be skipped until they have been committed')
+            tarball.close()
+            fetch.commit_validators()
+            validators.save()
+
+            fetch = self.fetch(HttpValidators(validators_path))
+            self.assertIsNone(self.loop.run_until_complete(fetch.get_remote_tarball()))
+            self.assertEqual(self.requests, [None, None, self.etag])
+
+    def test_streamed_download(self) -> None:
+        fetch = GIFetch(str(self.server.make_url('/export')), chunk_size=64, spool_size=256)
+        archive = self.loop.run_until_complete(fetch.fetch_all())
+
+        self.assertCountEqual(archive.list_content(), test_archive_content)
+        self.assertFalse(archive.source.closed, 'Owned sources should outlive close()')
+
+        with archive:
+            self.assertCountEqual([name for name, _ in archive.extract_xml_files()],
+                                  [name for name in test_archive_content if name.endswith('.xml')])
+        self.assertTrue(archive.source.closed, 'The downloaded file should be released along with the archive')
+
+    def test_sync_state_off_loop(self) -> None:
+        agency = AgencyConfiguration({'description': 'Rome agency', 'export_url': str(self.server.make_url('/export')),
+                                      'options': {}, 'image': {}})
+        threads = []
+
+        export = BytesIO()
+        with tarfile.open(fileobj=export, mode='w:gz') as archive:
+            archive.add(join(*relative_path, 'annuncio.xml'), 'export/annunci.xml')
+        self.tarball = export.getvalue()
+
+        class TracedStore(SyncStateStore):
+
+            def load(self) -> None:
+                threads.append(threading.current_thread())
+                super(TracedStore, self).load()
+
+            def commit(self) -> None:
+                threads.append(threading.current_thread())
+                super(TracedStore, self).commit()
+
+        with tempfile.TemporaryDirectory() as directory:
+            database = sync_state_initialize(join(directory, 'sync_state.sqlite'))
+            database.create_tables([LocalListingSyncState])
+            agent = SyncAgenziaAgent(agency, sync_state=TracedStore('Rome agency', LocalListingSyncState))
+            self.loop.run_until_complete(agent.synchronize_wordpress())
+
+            self.assertEqual(LocalListingSyncState.select().count(), 1)
+            database.close()
+
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads, 'The database should never be queried on the event loop')
+
+    def test_parse_threads(self) -> None:
+        agency = AgencyConfiguration({'description': 'Rome agency', 'export_url': str(self.server.make_url('/export')),
+                                      'options': {}, 'image': {}})
+        threads = []
+
+        def parse_stream(*args) -> None:
+            threads.append(threading.current_thread().name)
+            parse(*args)
+
+        parse = SyncInterpreter.parse_stream
+        # a parse holding the only default thread would leave the download nowhere to wait
+        self.loop.set_default_executor(ThreadPoolExecutor(1))
+        with ThreadPoolExecutor(1, thread_name_prefix='parse') as parse_threads, \
+                mock.patch.object(SyncInterpreter, 'parse_stream', parse_stream), mock.patch('builtins.print'):
+            agent = SyncAgenziaAgent(agency, parse_threads=parse_threads)
+            self.loop.run_until_complete(asyncio.wait_for(agent.synchronize_wordpress(), 10))
+
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('parse'), 'Exports should be parsed apart from the default executor')
+
+    def test_empty_export(self) -> None:
+        agency = AgencyConfiguration({'description': 'Rome agency', 'export_url': str(self.server.make_url('/export')),
+                                      'options': {}, 'image': {}})
+        validators = HttpValidators()
+
+        def serve(xml_path: str = None) -> None:
+            export = BytesIO()
+            with tarfile.open(fileobj=export, mode='w:gz') as archive:
+                if xml_path is None:
+                    member = tarfile.TarInfo('export/annunci.xml')
+                    member.size = len(b'<dataset></dataset>')
+                    archive.addfile(member, BytesIO(b'<dataset></dataset>'))
+                else:
+                    archive.add(xml_path, 'export/annunci.xml')
+            self.tarball = export.getvalue()
+
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = index_path(directory, 'Rome agency')
+            ListingIdIndex(np.array([1, 2], dtype=np.int64)).save(file_path)
+            agent = SyncAgenziaAgent(agency, validators=validators, listing_index_path=file_path)
+
+            serve()
+            self.loop.run_until_complete(agent.synchronize_wordpress())
+            self.assertEqual(ListingIdIndex.load(file_path).listing_ids.tolist(), [1, 2],
+                             'Empty exports should never unpublish the catalog')
+            self.assertEqual(validators.validators, {}, 'Empty exports should be downloaded again')
+
+            serve(join(*relative_path, 'annuncio.xml'))
+            self.loop.run_until_complete(agent.synchronize_wordpress())
+            self.assertEqual(ListingIdIndex.load(file_path).listing_ids.tolist(), [14503])
+            self.assertNotEqual(validators.validators, {})
+
+    def test_failed_commit(self) -> None:
+        agency = AgencyConfiguration({'description': 'Rome agency', 'export_url': str(self.server.make_url('/export')),
+                                      'options': {}, 'image': {}})
+        validators = HttpValidators()
+
+        export = BytesIO()
+        with tarfile.open(fileobj=export, mode='w:gz') as archive:
+            archive.add(join(*relative_path, 'annuncio.xml'), 'export/annunci.xml')
+        self.tarball = export.getvalue()
+
+        with tempfile.TemporaryDirectory() as directory:
+            agent = SyncAgenziaAgent(agency, validators=validators,
+                                     listing_index_path=index_path(directory, 'Rome agency'))
+
+            with mock.patch.object(ListingIdIndex, 'save', side_effect=OSError('disk full')):
+                with self.assertRaises(OSError):
+                    self.loop.run_until_complete(agent.synchronize_wordpress())
+            self.assertEqual(validators.validators, {}, 'A sync that failed should be run again next time')
+
+            self.loop.run_until_complete(agent.synchronize_wordpress())
+            self.assertNotEqual(validators.validators, {})
+
+    def test_failed_photos(self) -> None:
+        agency = AgencyConfiguration({'description': 'Rome agency', 'export_url': str(self.server.make_url('/export')),
+                                      'options': {}, 'image': {}})
+        validators = HttpValidators()
+
+        export = BytesIO()
+        with tarfile.open(fileobj=export, mode='w:gz') as archive:
+            archive.add(join(*relative_path, 'annuncio.xml'), 'export/annunci.xml')
+        self.tarball = export.getvalue()
+
+        blueprints = {}
+
+        @asyncio.coroutine
+        def download_and_process(downloader, url: str, *args, blueprint: bool = False) -> None:
+            blueprints[url] = blueprint
+            raise FileNotFoundError(url)
+
+        agent = SyncAgenziaAgent(agency, validators=validators, downloader=mock.Mock(),
+                                 image_pool=mock.Mock(download_and_process=download_and_process))
+        with mock.patch('builtins.print'):
+            self.loop.run_until_complete(agent.synchronize_wordpress())
+        self.assertEqual(validators.validators, {}, 'Photos that failed should be tried again on the next run')
+        self.assertEqual(sorted(blueprints.values()), [False, True], 'Floor plans should be processed as such')
+        self.assertTrue(blueprints['http://www.gestionaleimmobiliare.it/url_della_foto23.gif'])
+
+    def test_skipped_listings(self) -> None:
+        agency = AgencyConfiguration({'description': 'Rome agency', 'export_url': str(self.server.make_url('/export')),
+                                      'options': {}, 'image': {}})
+
+        with open(join(*relative_path, 'annuncio.xml')) as f:
+            xml_content = f.read()
+        annuncio = xml_content[xml_content.index('<annuncio>'):xml_content.index('</annuncio>') + len('</annuncio>')]
+        malformed = annuncio.replace('<mq>121</mq>', '<mq>121 m2</mq>')
+
+        def serve(*annunci: str) -> None:
+            content = xml_content.replace(annuncio, '\n'.join(annunci)).encode('utf-8')
+            export = BytesIO()
+            with tarfile.open(fileobj=export, mode='w:gz') as archive:
+                member = tarfile.TarInfo('export/annunci.xml')
+                member.size = len(content)
+                archive.addfile(member, BytesIO(content))
+            self.tarball = export.getvalue()
+
+        with tempfile.TemporaryDirectory() as directory, mock.patch('builtins.print'):
+            file_path = index_path(directory, 'Rome agency')
+            ListingIdIndex(np.array([5, 99, 14503], dtype=np.int64)).save(file_path)
+            agent = SyncAgenziaAgent(agency, listing_index_path=file_path)
+
+            serve(annuncio, malformed.replace('14503', '99'))
+            self.loop.run_until_complete(agent.synchronize_wordpress())
+            self.assertEqual(ListingIdIndex.load(file_path).listing_ids.tolist(), [99, 14503],
+                             'A listing that cannot be read should stay published')
+
+            serve(annuncio.replace('14503', '6'), malformed.replace('<id>14503</id>', '<id>x</id>'))
+            self.loop.run_until_complete(agent.synchronize_wordpress())
+            self.assertEqual(ListingIdIndex.load(file_path).listing_ids.tolist(), [99, 14503],
+                             'Nothing should be unpublished while a listing has no readable id')
+
+    def test_pipelined_parse(self) -> None:
+        with open(join(*relative_path, 'annuncio.xml'), 'rb') as f:
+            xml_content = f.read()
+
+        export = BytesIO()
+        with tarfile.open(fileobj=export, mode='w:gz') as archive:
+            for name in ('export/first.xml', 'export/second.xml'):
+                member = tarfile.TarInfo(name)
+                member.size = len(xml_content)
+                archive.addfile(member, BytesIO(xml_content))
+        self.tarball = export.getvalue()
+
+        fetch = GIFetch(str(self.server.make_url('/export')), chunk_size=128)
+        pipe = ChunkPipe(max_chunks=2)
+        records = []
+
+        @asyncio.coroutine
+        def pipeline():
+            response = yield from fetch.request_export()
+            yield from asyncio.gather(fetch.stream_remote_tarball(response, pipe),
+                                      self.loop.run_in_executor(None, SyncInterpreter.parse_stream,
+                                                                pipe, records.append))
+
+        self.loop.run_until_complete(pipeline())
+
+        self.assertEqual(records[-1], None, 'The end of the stream should be signalled')
+        self.assertEqual([record.info.id for record in records[:-1]], [14503, 14503])
+
+    def test_pooled_stream(self) -> None:
+        with open(join(*relative_path, 'annuncio.xml'), 'rb') as f:
+            xml_content = f.read()
+
+        export = BytesIO()
+        with tarfile.open(fileobj=export, mode='w:gz') as archive:
+            for listing_id in (1, 2, 3):
+                content = xml_content.replace(b'<id>14503</id>', '<id>{}</id>'.format(listing_id).encode('utf-8'))
+                member = tarfile.TarInfo('export/{}.xml'.format(listing_id))
+                member.size = len(content)
+                archive.addfile(member, BytesIO(content))
+
+        pipe = ChunkPipe(max_chunks=1024)
+        for start in range(0, len(export.getvalue()), 256):
+            pipe.write(export.getvalue()[start:start + 256])
+        pipe.close()
+
+        records = []
+        with mock.patch('gestionaleimmobiliare.sync_agenzia.agent.parse_records', wraps=parse_records) as pooled, \
+                ThreadPoolExecutor(max_workers=2) as executor:
+            SyncInterpreter.parse_stream(pipe, records.append, executor)
+
+        self.assertEqual([record.info.id for record in records[:-1]], [1, 2, 3])
+        self.assertIsNone(records[-1])
+        self.assertEqual(pooled.call_count, 2, 'The first file should be streamed, only the others pooled')
+
+    def test_record_backpressure(self) -> None:
+        records = asyncio.Queue(maxsize=2, loop=self.loop)
+        put = SyncAgenziaAgent.blocking_put(records, self.loop)
+        queued = []
+
+        def parse():
+            for record in list(range(10)) + [None]:
+                put(record)
+
+        @asyncio.coroutine
+        def consume():
+            received = []
+            record = yield from records.get()
+            while record is not None:
+                queued.append(records.qsize())
+                received.append(record)
+                yield from asyncio.sleep(0.001)
+                record = yield from records.get()
+            return received
+
+        parsed, received = self.loop.run_until_complete(asyncio.gather(
+            self.loop.run_in_executor(None, parse), consume()))
+
+        self.assertEqual(received, list(range(10)))
+        self.assertLessEqual(max(queued), 2, 'The parsing thread should wait for the consumer')
+
+    def test_pipe_reads(self) -> None:
+        pipe = ChunkPipe(max_chunks=64)
+        for chunk in (b'abc', b'defg', b'h', b'ijklmnop'):
+            pipe.write(chunk)
+        pipe.close()
+
+        self.assertEqual(pipe.read(2), b'ab')
+        self.assertEqual(pipe.read(5), b'cdefg')
+        self.assertEqual(pipe.read(4), b'hijk')
+        self.assertEqual(pipe.read(), b'lmnop')
+        self.assertEqual(pipe.read(), b'')
+
+    def test_interrupted_pipe(self) -> None:
+        pipe = ChunkPipe(max_chunks=1)
+        pipe.write(b'partial')
+        pipe.close(ConnectionResetError())
+
+        self.assertEqual(pipe.read(4), b'part')
+        self.assertEqual(pipe.read(), b'ial')
+        with self.assertRaises(IOError):
+            pipe.read()
+
+        pipe.close_reader()
+        with self.assertRaises(BrokenPipeError):
+            pipe.write(b'more')
+
+
+
+class AttachmentDownloaderTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.requests = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+        app = web.Application()
+        app.router.add_get('/photos/{name}', self.photo_handler)
+        self.server = test_utils.TestServer(app)
+        self.loop.run_until_complete(self.server.start_server(loop=self.loop))
+
+    def tearDown(self) -> None:
+        close_session()
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+
+    @asyncio.coroutine
+    def photo_handler(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        self.requests.append(name)
+        self.concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        try:
+            yield from asyncio.sleep(0.01)
+            if name == 'missing.jpg':
+                return web.Response(status=404)
+            if name == 'tagged.jpg':
+                if request.headers.get('If-None-Match') == '"v1"':
+                    return web.Response(status=304)
+                return web.Response(body=b'tagged', headers={'ETag': '"v1"'})
+            if name.startswith('busy') and self.requests.count(name) == 1:
+                return web.Response(status=503)
+            return web.Response(body=name.encode('utf-8') * 100)
+        finally:
+            self.concurrent -= 1
+
+    def test_adaptive_limit(self) -> None:
+        limit = AdaptiveLimit(initial=4, maximum=8)
+
+        @asyncio.coroutine
+        def round_trip(congested):
+            ticket = yield from limit.acquire()
+            return ticket, congested
+
+        tickets = [self.loop.run_until_complete(round_trip(True)) for _ in range(3)]
+        for ticket, congested in tickets:
+            self.loop.run_until_complete(limit.release(ticket, congested))
+
+        self.assertEqual(limit.limit, 2, 'Failures of requests sent together should back off once')
+
+        for _ in range(40):
+            ticket = self.loop.run_until_complete(limit.acquire())
+            self.loop.run_until_complete(limit.release(ticket))
+
+        self.assertEqual(limit.limit, 8, 'Successes should raise the limit up to its maximum')
+
+    def test_retry_delay(self) -> None:
+        downloader = AttachmentDownloader(retry_base_delay=1, retry_max_delay=10)
+
+        self.assertTrue(all(0 <= downloader.retry_delay(attempt) <= min(10, 2 ** (attempt - 1))
+                            for attempt in range(1, 8)))
+        self.assertGreaterEqual(downloader.retry_delay(1, retry_after=5), 5, 'Retry-After should be honoured')
+        self.assertEqual(downloader.retry_delay(1, retry_after=3600), 10,
+                         'Retry-After should never exceed the maximum delay')
+
+    def test_download_all(self) -> None:
+        downloader = AttachmentDownloader(initial_per_host=2, max_per_host=3, retry_base_delay=0.01)
+        names = ['photo-{}.jpg'.format(i) for i in range(12)] + ['busy.jpg', 'missing.jpg']
+
+        with tempfile.TemporaryDirectory() as directory:
+            downloads = [(str(self.server.make_url('/photos/{}'.format(name))), os.path.join(directory, name))
+                         for name in names]
+            errors = self.loop.run_until_complete(downloader.download_all(downloads))
+
+            with open(os.path.join(directory, 'busy.jpg'), 'rb') as photo:
+                self.assertEqual(photo.read(), b'busy.jpg' * 100)
+            self.assertCountEqual(os.listdir(directory), names[:-1], 'No partial file should be left behind')
+
+        self.assertEqual([error is None for error in errors], [True] * 13 + [False])
+        self.assertLessEqual(self.max_concurrent, 3, 'The per host limit should never be exceeded')
+        self.assertEqual(self.requests.count('busy.jpg'), 2, 'Overloaded servers should be retried')
+        self.assertEqual(self.requests.count('missing.jpg'), 1, 'Missing files should not be retried')
+        self.assertEqual((downloader.stats.files, downloader.stats.retries, downloader.stats.failures), (13, 1, 1))
+        self.assertEqual(downloader.stats.bytes, sum(len(name) * 100 for name in names[:-1]))
+
+    def test_download_to_cache(self) -> None:
+        url = str(self.server.make_url('/photos/tagged.jpg'))
+        downloader = AttachmentDownloader()
+
+        with tempfile.TemporaryDirectory() as directory:
+            cache = MediaCache(directory)
+            digest = self.loop.run_until_complete(downloader.download_to_cache(url, cache))
+            with open(cache.blob_path(digest), 'rb') as blob:
+                self.assertEqual(blob.read(), b'tagged')
+            cache.save()
+
+            cache = MediaCache(directory)
+            self.assertEqual(self.loop.run_until_complete(downloader.download_to_cache(url, cache)), digest)
+            self.assertEqual(os.listdir(os.path.join(directory, 'tmp')), [], 'No temporary file should be left')
+
+        self.assertEqual((downloader.stats.files, downloader.stats.not_modified), (1, 1),
+                         'Cached files should not be downloaded again')
+
+
+class MediaCacheTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = MediaCache(self.directory.name)
+
+        photo = self.cache.temporary_path()
+        Image.new('RGB', (1600, 1200), (90, 120, 150)).save(photo, 'JPEG')
+        self.digest = self.cache.store_blob('http://photos/1.jpg', photo, {'ETag': '"1"', 'Last-Modified': None})
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def test_blobs(self) -> None:
+        self.assertEqual(self.cache.lookup('http://photos/1.jpg'), self.digest)
+        self.assertEqual(self.cache.request_headers('http://photos/1.jpg'), {'If-None-Match': '"1"'})
+        self.assertIsNone(self.cache.lookup('http://photos/2.jpg'))
+
+        os.remove(self.cache.blob_path(self.digest))
+        self.assertIsNone(self.cache.lookup('http://photos/1.jpg'), 'Evicted blobs should be downloaded again')
+
+    def test_process(self) -> None:
+        rome = ImageProcessingConfiguration({'normalize': True})
+        milan = ImageProcessingConfiguration({'normalize': False})
+
+        variants = self.cache.process(self.digest, rome, DEFAULT_IMAGE_SIZES)
+        self.assertEqual(list(variants), ['full', 'thumbnail', 'medium', 'medium_large', 'large'])
+        with Image.open(variants['thumbnail']) as thumbnail:
+            self.assertEqual(thumbnail.size, (150, 150))
+
+        with mock.patch('gestionaleimmobiliare.sync_agenzia.media_cache.process_attachment') as process:
+            self.assertEqual(self.cache.process(self.digest, rome, DEFAULT_IMAGE_SIZES), variants)
+            process.assert_not_called()
+
+        milan_variants = self.cache.process(self.digest, milan, DEFAULT_IMAGE_SIZES)
+        self.assertFalse(set(milan_variants.values()) & set(variants.values()),
+                         'Other processing options should not share variants')
+        self.assertTrue(all(os.path.exists(file_path) for file_path in variants.values()))
+
+    def test_evict(self) -> None:
+        variant = self.cache.process(self.digest, ImageProcessingConfiguration({'resize': False}), ())['full']
+        os.utime(variant, (1, 1))
+        variant_size = os.path.getsize(variant)
+
+        self.cache.max_bytes = self.cache.size() - 1
+        self.assertEqual(self.cache.evict(), variant_size, 'The least recently used file should go first')
+        self.assertFalse(os.path.exists(variant))
+        self.assertEqual(self.cache.lookup('http://photos/1.jpg'), self.digest)
+
+        self.cache.max_bytes = 0
+        self.cache.evict()
+        self.assertEqual(self.cache.urls, {}, 'Urls of evicted blobs should be forgotten')
+
+    def test_link(self) -> None:
+        photo = signature(textured_photo(5))
+        copy = signature(textured_photo(5, (320, 240)))
+        self.assertIsNone(self.cache.canonical(self.digest))
+        self.assertEqual(self.cache.link(self.digest, photo), self.digest)
+
+        self.assertEqual(self.cache.link('copy', copy), self.digest, 'Near duplicates should be linked')
+        self.assertEqual(self.cache.link('other', signature(textured_photo(8))), 'other')
+        self.assertEqual(self.cache.link('cropped', signature(textured_photo(5).crop((0, 0, 640, 360)))), 'cropped')
+        self.assertEqual(self.cache.link('flat', signature(Image.new('L', (640, 480), 230))), 'flat')
+        self.cache.save()
+
+        cache = MediaCache(self.directory.name)
+        self.assertEqual(cache.canonical('copy'), self.digest)
+        self.assertEqual(cache.canonical('flat'), 'flat')
+        self.assertEqual(cache.link('second copy', copy), self.digest)
+        self.assertEqual(cache.link('second flat', signature(Image.new('L', (640, 480), 20))), 'second flat',
+                         'Photos of no detail should never be linked')
+
+        os.remove(cache.blob_path(self.digest))
+        cache.evict()
+        self.assertEqual(cache.aliases, {}, 'Links to evicted photos should be forgotten')
+        self.assertEqual(cache.link('third copy', copy), 'third copy')
+
+
+
+def textured_photo(period: float, size=(640, 480)) -> Image:
+    # drawn relative to the width: every size of the same period is the same photo
+    y, x = np.mgrid[0:size[1], 0:size[0]] / size[0]
+    shade = 128 + 60 * np.sin(x * period) * np.cos(y * period * 0.7) + 40 * np.sin((x + 2 * y) * 9)
+    return Image.fromarray(shade.clip(0, 255).astype(np.uint8), 'L').convert('RGB')
+
+
+class ImageWorkerPoolTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = MediaCache(self.directory.name)
+        self.downloading = 0
+        self.max_downloading = 0
+        self.photos = {}
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+        self.loop.close()
+
+    @asyncio.coroutine
+    def download_to_cache(self, url: str, cache: MediaCache) -> str:
+        # stands in for AttachmentDownloader: every url is a different photo, unless set in self.photos
+        if 'missing' in url:
+            raise FileNotFoundError(url)
+        self.downloading += 1
+        self.max_downloading = max(self.max_downloading, self.downloading)
+        yield from asyncio.sleep(0.01)
+
+        photo = cache.temporary_path()
+        self.photos.get(url, textured_photo(3 + len(url))).save(photo, 'JPEG')
+        self.downloading -= 1
+        return cache.store_blob(url, photo, {})
+
+    def test_download_and_process(self) -> None:
+        options = ImageProcessingConfiguration({})
+        urls = ['http://photos/{}.jpg'.format('x' * i) for i in range(6)]
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            pool = ImageWorkerPool(self.cache, executor, max_in_flight=2, deduplicate=False)
+            results = self.loop.run_until_complete(asyncio.gather(
+                *[pool.download_and_process(self, url, options, DEFAULT_IMAGE_SIZES) for url in urls]))
+
+        self.assertLessEqual(self.max_downloading, 2, 'Downloads should wait for the workers')
+        self.assertEqual(len({variants['medium'] for variants in results}), 6)
+        for variants in results:
+            self.assertEqual(list(variants), ['full', 'thumbnail', 'medium'])
+            with Image.open(variants['medium']) as medium:
+                self.assertEqual(medium.size, (300, 225))
+
+    def test_deduplicate(self) -> None:
+        options = ImageProcessingConfiguration({})
+        widths = (640, 800, 1024, 320)
+        copies = ['http://photos/copy-{}.jpg'.format(width) for width in widths]
+        self.photos = {url: textured_photo(5, (width, width * 3 // 4)) for url, width in zip(copies, widths)}
+        # flat photos all hash alike, yet they are not the same
+        self.photos.update({'http://photos/light.jpg': Image.new('RGB', (640, 480), (230, 230, 230)),
+                            'http://photos/dark.jpg': Image.new('RGB', (640, 480), (20, 20, 20))})
+        urls = copies + ['http://photos/light.jpg', 'http://photos/dark.jpg', 'http://photos/other.jpg']
+
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            pool = ImageWorkerPool(self.cache, executor, max_in_flight=2)
+            results = self.loop.run_until_complete(asyncio.gather(
+                *[pool.download_and_process(self, url, options, DEFAULT_IMAGE_SIZES) for url in urls]))
+
+        self.assertEqual(len({variants['medium'] for variants in results[:4]}), 1, 'Duplicates should share variants')
+        self.assertEqual(len({variants['medium'] for variants in results}), 4)
+        self.assertEqual(len(self.cache.photos), 2, 'Flat photos should never stand for others')
+        self.assertEqual(len(self.cache.aliases), 7)
+
+
+    def test_agent_photos(self) -> None:
+        agency = AgencyConfiguration({'description': 'Rome agency', 'export_url': 'http://export',
+                                      'options': {}, 'image': {}})
+        record = SyncInterpreter.iter_records(join(*relative_path, 'annuncio.xml')).__next__()
+        failing = record._replace(info=record.info._replace(id=2),
+                                  file_allegati=record.file_allegati[:1] + (
+                                      record.file_allegati[1]._replace(file_path='http://photos/missing.jpg'),))
+        deleted = record._replace(info=record.info._replace(id=3, deleted=1))
+
+        records = asyncio.Queue(loop=self.loop)
+        for item in (record, failing, deleted, None):
+            records.put_nowait(item)
+
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            agent = SyncAgenziaAgent(agency, image_pool=ImageWorkerPool(self.cache, executor, max_in_flight=2),
+                                     downloader=self, image_sizes=DEFAULT_IMAGE_SIZES)
+            photos = PhotoTasks()
+            self.loop.run_until_complete(agent.consume_records(records, photos=photos))
+            self.loop.run_until_complete(photos.wait())
+
+        self.assertEqual(photos.listings, 2, 'Deleted listings need no photos')
+        self.assertEqual(photos.failed, [2])
+        self.assertEqual(len(self.cache.urls), 2)
+
+    def test_photo_backpressure(self) -> None:
+        agency = AgencyConfiguration({'description': 'Rome agency', 'export_url': 'http://export',
+                                      'options': {}, 'image': {}})
+        record = SyncInterpreter.iter_records(join(*relative_path, 'annuncio.xml')).__next__()
+        running = []
+        pending_records = []
+
+        records = asyncio.Queue(loop=self.loop)
+        for listing_id in range(8):
+            records.put_nowait(record._replace(info=record.info._replace(id=listing_id)))
+        records.put_nowait(None)
+
+        @asyncio.coroutine
+        def process_photos(listing: AnnuncioRecord) -> bool:
+            running.append(listing.info.id)
+            pending_records.append(records.qsize())
+            yield from asyncio.sleep(0.01)
+            running.remove(listing.info.id)
+            return listing.info.id != 5
+
+        agent = SyncAgenziaAgent(agency, image_pool=mock.Mock())
+        agent.process_photos = process_photos
+        photos = PhotoTasks(max_listings=2)
+        with mock.patch('builtins.print'):
+            self.loop.run_until_complete(agent.consume_records(records, photos=photos))
+            self.assertLessEqual(len(photos.pending), 2, 'Listings should wait for a free slot')
+            self.loop.run_until_complete(photos.wait())
+
+        self.assertEqual(photos.listings, 8)
+        self.assertEqual(photos.failed, [5])
+        self.assertEqual(pending_records[:2], [6, 6], 'Records should be held back while the slots are taken')
+
+
 class GISyncInterpreterTests(unittest.TestCase):
 
     @staticmethod
@@ -113,6 +838,127 @@ class GISyncInterpreterTests(unittest.TestCase):
         self.assertFalse(annuncio.file_allegati.allegato[0].planimetria)
         self.assertTrue(annuncio.file_allegati.allegato[1].planimetria)
 
+    def test_field_types(self) -> None:
+        xml_content = self.mock_response('annuncio.xml').replace('<mq>121</mq>', '<mq></mq>')
+        info = SyncInterpreter.parse_xml(xml_content).getroot().annuncio.info
+
+        self.assertEqual(info.last_editor_time.pyval, datetime(2011, 10, 22, 18, 23, 12))
+        self.assertEqual(info.price, 100000000)
+        self.assertEqual(info.ipe, 67.5)
+        self.assertEqual(info.comune_istat, '144435')
+        self.assertIsNone(info.mq.pyval, 'Empty optional numbers should map to None')
+
+    def test_parser_cache(self) -> None:
+        parser = SyncInterpreter.get_parser()
+
+        self.assertIs(SyncInterpreter.get_parser(), parser, 'Parser should be built once per thread')
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            other_parser = executor.submit(SyncInterpreter.get_parser).result()
+
+        self.assertIsNot(other_parser, parser, 'Threads should not share a parser')
+
+    def test_iter_annunci(self) -> None:
+        xml_content = self.mock_response('annuncio.xml')
+        annuncio_start = xml_content.index('<annuncio>')
+        annuncio_end = xml_content.index('</dataset>')
+        xml_content = xml_content[:annuncio_end] + xml_content[annuncio_start:annuncio_end] * 2 + '</dataset>'
+
+        previous = None
+        count = 0
+
+        for annuncio in SyncInterpreter.iter_annunci(BytesIO(xml_content.encode('utf-8'))):
+            self.assertIsInstance(annuncio.info, InfoElement)
+            self.assertIsInstance(annuncio.info.ape, ApeElement)
+            self.assertIsInstance(annuncio.file_allegati.allegato[1], AllegatoElement)
+            self.assertEqual(annuncio.info.id, 14503)
+            self.assertEqual(annuncio.info.ape.version, 2015)
+            self.assertTrue(annuncio.file_allegati.allegato[1].planimetria)
+            self.assertEqual(annuncio.info_inserite[InfoInserita.classe_energetica].mapped_value, EnergyLabel.B)
+
+            if previous is not None:
+                self.assertEqual(previous.countchildren(), 0, 'Consumed annunci should be cleared')
+                self.assertIsNone(annuncio.getprevious(), 'Consumed annunci should be detached')
+
+            previous = annuncio
+            count += 1
+
+        self.assertEqual(count, 3)
+
+    def test_records(self) -> None:
+        xml_content = self.mock_response('annuncio.xml')
+        records = list(SyncInterpreter.iter_records(BytesIO(xml_content.encode('utf-8'))))
+
+        self.assertEqual(len(records), 1)
+
+        record = records[0]
+
+        self.assertIsInstance(record, AnnuncioRecord)
+        self.assertEqual(record.info.id, 14503)
+        self.assertEqual(record.info.agency_code, 'AP56')
+        self.assertEqual(record.info.price, 100000000)
+        self.assertEqual(record.info.ipe, 67.5)
+        self.assertEqual(record.info.last_editor_time, datetime(2011, 10, 22, 18, 23, 12))
+        self.assertEqual(record.ape.version, 2015)
+        self.assertEqual(record.ape.prestazione_estate, 'medio')
+        self.assertIsNone(record.incarico)
+        self.assertEqual([allegato.planimetria for allegato in record.file_allegati], [False, True])
+        self.assertEqual(record.file_allegati[0].file_path, 'http://www.gestionaleimmobiliare.it/url_della_foto1.jpg')
+        self.assertEqual(record.info_inserita(InfoInserita.classe_energetica), EnergyLabel.B.value)
+        self.assertEqual(record.info_inserita(InfoInserita.cantina), 1)
+        self.assertEqual(record.dato_disponibile(DatoDisponibile.numero_chiavi), 1)
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+
+    def test_malformed_records(self) -> None:
+        xml_content = self.mock_response('annuncio.xml')
+        annuncio = xml_content[xml_content.index('<annuncio>'):xml_content.index('</annuncio>') + len('</annuncio>')]
+        missing = annuncio.replace('<id>14503</id>', '')
+        malformed = annuncio.replace('<mq>121</mq>', '<mq>121 m2</mq>').replace('14503', '2')
+        export = xml_content.replace(annuncio, '\n'.join([missing, annuncio, malformed]))
+
+        with mock.patch('builtins.print'):
+            records = list(SyncInterpreter.iter_records(BytesIO(export.encode('utf-8'))))
+        self.assertEqual([record.info.id for record in records], [14503], 'Broken listings should be skipped')
+
+    def test_optional_leaves(self) -> None:
+        xml_content = self.mock_response('annuncio.xml')
+        for leaf in ('<deleted>0</deleted>', '<flag_storico>0</flag_storico>', '<flag_vetrina>0</flag_vetrina>',
+                     '<flag_carosello>0</flag_carosello>', '<categorie_id>10</categorie_id>'):
+            xml_content = xml_content.replace(leaf, '')
+        xml_content = xml_content.replace('<categorie_micro_id>10</categorie_micro_id>',
+                                          '<categorie_micro_id></categorie_micro_id>')
+
+        records = list(SyncInterpreter.iter_records(BytesIO(xml_content.encode('utf-8'))))
+
+        self.assertEqual(len(records), 1, 'Only the id should be required')
+        info = records[0].info
+        self.assertEqual((info.deleted, info.flag_storico, info.flag_vetrina, info.flag_carosello), (0, 0, 0, 0))
+        self.assertIsNone(info.categorie_id)
+        self.assertIsNone(info.categorie_micro_id)
+
+        annuncio = SyncInterpreter.parse_xml(xml_content.replace('<mq>121</mq>', '<deleted></deleted>'))
+        self.assertEqual(annuncio.getroot().annuncio.info.deleted.pyval, 0)
+
+    def test_parallel_parse(self) -> None:
+        xml_content = self.mock_response('annuncio.xml').encode('utf-8')
+        other_content = xml_content.replace(b'<id>14503</id>', b'<id>14504</id>')
+
+        export = BytesIO()
+        with tarfile.open(fileobj=export, mode='w') as archive:
+            for name, content in (('first.xml', xml_content),
+                                  ('second.xml', other_content),
+                                  ('third.xml', xml_content)):
+                member = tarfile.TarInfo(name)
+                member.size = len(content)
+                archive.addfile(member, BytesIO(content))
+
+        with TarFile(export.getvalue()) as archive, ProcessPoolExecutor(max_workers=2) as executor:
+            parsed = list(SyncInterpreter.map_xml_files(archive.extract_xml_files(), executor, max_pending=1))
+
+        self.assertEqual([[record.info.id for record in records] for records in parsed], [[14503], [14504], [14503]],
+                         'Records should come back in the order of the files')
+        self.assertEqual(parsed[0], list(SyncInterpreter.iter_records(BytesIO(xml_content))))
+
     def test_info_inserite(self) -> None:
         xml_content = self.mock_response('annuncio.xml')
         sync_agent = SyncInterpreter('http://domain.com')
@@ -134,6 +980,28 @@ class GISyncInterpreterTests(unittest.TestCase):
         self.assertEqual(info_classe_energetica.mapped_value, EnergyLabel.B)
         self.assertEqual(info_classe_energetica, info_inserite[InfoInserita.classe_energetica])
 
+        info_by_type = info_inserite.as_dict()
+
+        self.assertEqual(len(info_by_type), len(InfoInserita))
+        self.assertEqual(info_by_type[InfoInserita.cantina], info_cantina)
+        self.assertEqual(info_inserite.id_index()[InfoInserita.cantina.value], info_cantina)
+
+    def test_decode_info_inserite(self) -> None:
+        xml_content = self.mock_response('annuncio.xml')
+        info_inserite = SyncInterpreter.parse_xml(xml_content).getroot().annuncio[0].info_inserite
+
+        decoded = decode_info_inserite(info_inserite)
+
+        self.assertEqual(len(decoded), len(InfoInserita))
+        self.assertIs(decoded[InfoInserita.cantina], True)
+        self.assertEqual(decoded[InfoInserita.camere], 2)
+        self.assertEqual(decoded[InfoInserita.classe_energetica], EnergyLabel.B)
+        self.assertEqual(decoded[InfoInserita.stato_manutenzione], ManteinanceLevel.ottimo)
+
+        for info in info_inserite.iterchildren():
+            self.assertEqual(info.mapped_value, decoded[info.information_type])
+            self.assertEqual(info.keep_in_list, info.information_type.keep_in_list(info.valore_assegnato.pyval))
+
     def test_dati_disponibili(self) -> None:
         xml_content = self.mock_response('annuncio.xml')
         sync_agent = SyncInterpreter('http://domain.com')
@@ -152,6 +1020,57 @@ class GISyncInterpreterTests(unittest.TestCase):
         self.assertEqual(info_altezza, 0)
         self.assertEqual(info_altezza, dati_disponibili[DatoDisponibile.altezza])
 
+        dati_by_type = dati_disponibili.as_dict()
+
+        self.assertEqual(len(dati_by_type), len(DatoDisponibile))
+        self.assertEqual(dati_by_type[DatoDisponibile.numero_chiavi], 1)
+        self.assertNotIn(12, [dato.value for dato in dati_by_type], 'Unknown ids should be left out')
+
+
+class FeatureMatrixTests(unittest.TestCase):
+
+    @staticmethod
+    def mock_catalog() -> FeatureMatrix:
+        record = SyncInterpreter.iter_records(join(*relative_path, 'annuncio.xml')).__next__()
+
+        def variant(listing_id: int, **infos) -> AnnuncioRecord:
+            info_inserite = list(record.info_inserite)
+            for name, value in infos.items():
+                info_inserite[InfoInserita[name].value - 1] = value
+            return record._replace(info=record.info._replace(id=listing_id), info_inserite=tuple(info_inserite))
+
+        return FeatureMatrix.from_records([
+            record,
+            variant(2, garage=0),
+            variant(3, giardino=1, classe_energetica=EnergyLabel.G.value),
+            variant(4, garage=None, camere=None),
+            variant(5, classe_energetica=None),
+            variant(6, classe_energetica=EnergyLabel.da_definire.value),
+        ])
+
+    def test_masks(self) -> None:
+        catalog = self.mock_catalog()
+
+        self.assertEqual(len(catalog), 6)
+        self.assertEqual(catalog.select(catalog.has(InfoInserita.garage)).tolist(), [14503, 3, 5, 6])
+        self.assertEqual(catalog.select(catalog.has(InfoInserita.garage, InfoInserita.giardino)).tolist(), [3])
+        self.assertEqual(catalog.column(InfoInserita.camere).tolist(), [2, 2, 2, FeatureMatrix.MISSING, 2, 2])
+
+        good_energy_label = catalog.isin(InfoInserita.classe_energetica, EnergyLabel.A, EnergyLabel.B, EnergyLabel.C)
+        self.assertEqual(catalog.select(good_energy_label).tolist(), [14503, 2, 4])
+
+        undefined = catalog.isin(InfoInserita.classe_energetica, EnergyLabel.da_definire)
+        self.assertEqual(catalog.select(undefined).tolist(), [6], 'Missing infos should match no value')
+
+    def test_count_by_tag(self) -> None:
+        catalog = self.mock_catalog()
+        rooms = catalog.count_by_tag(Tag.room)
+
+        self.assertEqual(set(rooms), {info for info in InfoInserita if Tag.room in info.tags})
+        self.assertEqual(rooms[InfoInserita.garage], 4)
+        self.assertEqual(rooms[InfoInserita.camere], 5)
+        self.assertEqual(catalog.count_by_tag(Tag.room, catalog.has(InfoInserita.giardino))[InfoInserita.garage], 1)
+
 
 class InfoInseriteTests(unittest.TestCase):
 
@@ -160,3 +1079,132 @@ class InfoInseriteTests(unittest.TestCase):
         self.assertEqual(InfoInserita(80), InfoInserita.forno)
 
         self.assertEqual(InfoInserita.classe_energetica.value_type, EnergyLabel)
+        self.assertEqual(InfoInserita.bagni.tags, (Tag.room,))
+        self.assertEqual(InfoInserita.ripostigli.tags, ())
+
+    def test_decode_table(self):
+        self.assertIsNone(INFO_DECODE_TABLE[0])
+
+        for info_inserita in InfoInserita:
+            decoder = INFO_DECODE_TABLE[info_inserita.value]
+
+            self.assertIs(decoder.info_inserita, info_inserita)
+            self.assertEqual(decoder.tags, info_inserita.tags)
+
+        self.assertEqual(INFO_DECODE_TABLE[InfoInserita.garage.value].tags, (Tag.room,))
+
+
+class SyncStateStoreTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.database = SqliteDatabase(':memory:')
+        sync_state_proxy.initialize(self.database)
+        self.database.create_tables([LocalListingSyncState])
+
+        self.record = SyncInterpreter.iter_records(join(*relative_path, 'annuncio.xml')).__next__()
+
+    def tearDown(self) -> None:
+        self.database.close()
+
+    def listing(self, listing_id: int, **infos) -> AnnuncioRecord:
+        return self.record._replace(info=self.record.info._replace(id=listing_id, **infos))
+
+    def sync(self, agency: str, *records: AnnuncioRecord) -> SyncStateStore:
+        store = SyncStateStore(agency, LocalListingSyncState)
+        store.load()
+        self.changes = [store.classify(record) for record in records]
+        return store
+
+    def test_classify(self) -> None:
+        self.sync('Rome agency', self.listing(1), self.listing(2), self.listing(3)).commit()
+        self.assertEqual(self.changes, [ListingChange.new] * 3)
+
+        store = self.sync('Rome agency', self.listing(1), self.listing(2, price=90000000), self.listing(4))
+        self.assertEqual(self.changes, [ListingChange.unchanged, ListingChange.changed, ListingChange.new])
+        self.assertEqual(store.missing(), [3])
+        self.assertEqual(store.counts(), {ListingChange.new: 1, ListingChange.changed: 1, ListingChange.unchanged: 1})
+        store.commit()
+
+        self.sync('Rome agency', self.listing(1), self.listing(2, price=90000000), self.listing(4))
+        self.assertEqual(self.changes, [ListingChange.unchanged] * 3)
+        self.assertEqual(LocalListingSyncState.select().count(), 3)
+
+        self.sync('Milan agency', self.listing(1))
+        self.assertEqual(self.changes, [ListingChange.new], 'Agencies should not share their state')
+
+    def test_uncommitted(self) -> None:
+        self.sync('Rome agency', self.listing(1))
+        self.sync('Rome agency', self.listing(1))
+        self.assertEqual(self.changes, [ListingChange.new], 'A sync not committed should leave no state behind')
+
+        edited = self.listing(1, last_editor_time=datetime(2018, 1, 1))
+        self.sync('Rome agency', self.listing(1)).commit()
+        self.sync('Rome agency', edited)
+        self.assertEqual(self.changes, [ListingChange.changed])
+
+    def test_invalidate(self) -> None:
+        self.sync('Rome agency', self.listing(1), self.listing(2)).commit()
+
+        store = self.sync('Rome agency', self.listing(1), self.listing(2))
+        store.invalidate(2)
+        store.commit()
+
+        self.sync('Rome agency', self.listing(1), self.listing(2))
+        self.assertEqual(self.changes, [ListingChange.unchanged, ListingChange.changed],
+                         'Listings not fully processed should be processed again')
+
+
+class ListingIdIndexTests(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.record = SyncInterpreter.iter_records(join(*relative_path, 'annuncio.xml')).__next__()
+
+    def export(self, *listings) -> ExportIds:
+        export_ids = ExportIds()
+        for listing_id, deleted, flag_storico in listings:
+            export_ids.add(self.record._replace(info=self.record.info._replace(
+                id=listing_id, deleted=deleted, flag_storico=flag_storico)))
+        return export_ids
+
+    def test_diff(self) -> None:
+        index = ListingIdIndex(np.array([1, 3, 5, 7, 9, 11], dtype=np.int64))
+        export_ids = self.export((12, 0, 0), (9, 0, 1), (1, 0, 0), (5, 1, 0), (7, 1, 1), (2, 1, 0), (3, 0, 0), (1, 1, 0))
+
+        changes = index.diff(*export_ids.arrays())
+        self.assertEqual(changes.removed.tolist(), [11])
+        self.assertEqual(changes.deleted.tolist(), [5, 7], 'Deleted should win over archived')
+        self.assertEqual(changes.archived.tolist(), [9])
+        self.assertEqual(changes.published.tolist(), [1, 3, 12], 'The first of duplicate ids should count')
+
+        changes = index.diff(*self.export().arrays())
+        self.assertEqual(changes.removed.tolist(), index.listing_ids.tolist())
+        self.assertEqual(changes.published.tolist(), [])
+
+        changes = ListingIdIndex().diff(*export_ids.arrays())
+        self.assertEqual((len(changes.removed), len(changes.deleted), len(changes.archived)), (0, 0, 0))
+
+    def test_skipped(self) -> None:
+        index = ListingIdIndex(np.array([1, 3, 5, 7], dtype=np.int64))
+        export_ids = self.export((1, 0, 0), (7, 1, 0), (9, 0, 0))
+        export_ids.skipped.extend([5, 8, 7])
+
+        changes = index.diff(*export_ids.arrays(), skipped=export_ids.skipped_ids())
+        self.assertEqual(changes.removed.tolist(), [3], 'Listings that could not be read should not be removed')
+        self.assertEqual(changes.deleted.tolist(), [7], 'Listings read elsewhere in the export should count')
+        self.assertEqual(changes.published.tolist(), [1, 5, 9], 'Only published listings should stay published')
+
+        changes = index.diff(*self.export().arrays(), skipped=np.array([3], dtype=np.int64))
+        self.assertEqual(changes.removed.tolist(), [1, 5, 7])
+        self.assertEqual(changes.published.tolist(), [3])
+
+    def test_persistence(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            file_path = index_path(directory, 'Rome agency / centre')
+            self.assertEqual(os.path.dirname(file_path), join(directory, 'listing_ids'))
+            self.assertEqual(len(ListingIdIndex.load(file_path)), 0)
+
+            ListingIdIndex(np.array([2, 4, 8], dtype=np.int64)).save(file_path)
+            index = ListingIdIndex.load(file_path)
+
+        self.assertEqual(index.listing_ids.tolist(), [2, 4, 8])
+        self.assertEqual(index.listing_ids.dtype, np.int64)
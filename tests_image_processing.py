@@ -0,0 +1,321 @@
+import os
+import tempfile
+import unittest
+from io import BytesIO
+from unittest import mock
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import image_processing
+from image_processing import auto_level, dedupe, pipeline, watermark
+
+
+# as WordPress registers them by default
+SIZES = [('thumbnail', 150, 150, True), ('medium', 300, 300, False),
+         ('medium_large', 768, 0, False), ('large', 1024, 1024, False)]
+
+
+def photo(size=(1600, 1200)) -> Image:
+    # smooth shapes and a little grain, as in a real picture: block averages keep the same statistics
+    y, x = np.mgrid[0:size[1], 0:size[0]]
+    shapes = 125 + 45 * np.sin(x / 97.0) * np.cos(y / 61.0) + 40 * np.sin((x + y) / 211.0)
+    grain = np.random.RandomState(0).normal(0, 3, (size[1], size[0], 3))
+    return Image.fromarray((shapes[:, :, np.newaxis] + grain).clip(0, 255).astype(np.uint8), 'RGB')
+
+
+def gradient(mode: str, low: int, high: int, size=(64, 4)) -> Image:
+    row = np.linspace(low, high, size[0]).round().astype(np.uint8)
+    band = Image.fromarray(np.tile(row, (size[1], 1)), 'L')
+    return Image.merge(mode, [band] * len(mode))
+
+
+class LevelsTests(unittest.TestCase):
+
+    def test_stretch(self) -> None:
+        for mode in ('L', 'RGB', 'CMYK'):
+            image = image_processing.levels(gradient(mode, 50, 200))
+            for band in image.split():
+                self.assertEqual(band.getextrema(), (0, 255), '{} bands should be stretched'.format(mode))
+
+    def test_scale(self) -> None:
+        lut = image_processing.make_lut(gradient('RGB', 50, 200).histogram(), 'RGB')
+
+        self.assertEqual(len(lut), 3 * 256)
+        self.assertEqual(lut[:256], [min(255, max(0, int((value - 50) * (255.0 / 150)))) for value in range(256)])
+        self.assertEqual(lut[256:512], lut[:256])
+
+    def test_clip(self) -> None:
+        image = gradient('L', 50, 200)
+        image.putpixel((0, 0), 0)
+
+        self.assertEqual(image_processing.make_lut(image.histogram(), 'L')[50], 50 * 255 // 200)
+        self.assertEqual(image_processing.make_lut(image.histogram(), 'L', clip=1)[50], 0,
+                         'Values held by no more than clip pixels should be ignored')
+
+    def test_alpha(self) -> None:
+        image = gradient('RGBA', 50, 200)
+        levelled = image_processing.levels(image)
+
+        self.assertEqual(levelled.split()[0].getextrema(), (0, 255))
+        self.assertEqual(list(levelled.split()[3].getdata()), list(image.split()[3].getdata()),
+                         'Alpha should never be levelled')
+
+    def test_flat_bands(self) -> None:
+        identity = list(range(256))
+
+        self.assertEqual(image_processing.make_lut(Image.new('L', (8, 8), 100).histogram(), 'L'), identity)
+        self.assertEqual(image_processing.make_lut(gradient('L', 50, 200).histogram(), 'L', clip=1000), identity)
+
+    def test_all_same(self) -> None:
+        red = Image.fromarray(np.array([[10, 100]], dtype=np.uint8), 'L')
+        green = Image.fromarray(np.array([[50, 200]], dtype=np.uint8), 'L')
+        lut = image_processing.make_lut(Image.merge('RGB', [red, green, green]).histogram(), 'RGB', all_same=1)
+
+        self.assertEqual(lut[:256], lut[256:512], 'Bands should share the same scale')
+        self.assertEqual((lut[10], lut[200]), (0, 255))
+
+    def test_unsupported_mode(self) -> None:
+        image = Image.new('P', (8, 8))
+        self.assertIs(image_processing.levels(image), image)
+
+    def test_proxy(self) -> None:
+        image = photo()
+        levelled = np.asarray(image_processing.levels(image, clip=100), dtype=int)
+        approximated = np.asarray(image_processing.levels(image, clip=100, proxy_pixels=100 * 100), dtype=int)
+
+        self.assertLessEqual(np.abs(levelled - approximated).max(), 8)
+        self.assertLess(np.abs(levelled - approximated).mean(), 2)
+
+    def test_small_image_proxy(self) -> None:
+        image = gradient('RGB', 50, 200)
+        self.assertEqual(image_processing.levels(image, proxy_pixels=10 ** 6).tobytes(),
+                         image_processing.levels(image).tobytes(), 'Small images should not use a proxy')
+
+    def test_open_levelled(self) -> None:
+        jpeg = BytesIO()
+        photo().save(jpeg, 'JPEG', quality=95)
+
+        jpeg.seek(0)
+        levelled = np.asarray(image_processing.levels(Image.open(jpeg), clip=100), dtype=int)
+        jpeg.seek(0)
+        approximated = image_processing.open_levelled(jpeg, clip=100, proxy_pixels=200 * 150)
+
+        self.assertEqual(approximated.size, (1600, 1200))
+        self.assertLessEqual(np.abs(levelled - np.asarray(approximated, dtype=int)).max(), 8)
+        self.assertLess(np.abs(levelled - np.asarray(approximated, dtype=int)).mean(), 2)
+
+
+class AutoLevelTests(unittest.TestCase):
+
+    def test_tiles(self) -> None:
+        boxes = list(auto_level.iter_tiles((5, 3), tile_size=2))
+
+        self.assertEqual(boxes[0], (0, 0, 2, 2))
+        self.assertEqual(boxes[-1], (4, 2, 5, 3))
+        self.assertEqual(sum((right - left) * (bottom - top) for left, top, right, bottom in boxes), 15)
+
+    def test_histogram(self) -> None:
+        image = photo((300, 200))
+        self.assertEqual(auto_level.tiled_histogram(image, tile_size=64), image.histogram())
+
+    def test_matches_levels(self) -> None:
+        for mode in ('L', 'RGBA'):
+            image = photo((300, 200)).convert(mode)
+            expected = image_processing.levels(image, clip=20).tobytes()
+
+            levelled = auto_level.auto_level(image, clip=20, tile_size=64)
+
+            self.assertIs(levelled, image, 'Images should be levelled in place')
+            self.assertEqual(levelled.tobytes(), expected)
+
+    def test_unsupported_mode(self) -> None:
+        image = Image.new('1', (8, 8))
+        self.assertIs(auto_level.auto_level(image), image)
+
+
+class PipelineTests(unittest.TestCase):
+
+    def test_resize_plan(self) -> None:
+        self.assertEqual(pipeline.resize_plan((1600, 1200), ('medium', 300, 300, False)), ((300, 225), None))
+        self.assertEqual(pipeline.resize_plan((1600, 1200), ('wide', 768, 0, False)), ((768, 576), None))
+        self.assertEqual(pipeline.resize_plan((1600, 1200), ('thumbnail', 150, 150, True)),
+                         ((200, 150), (25, 0, 175, 150)))
+        self.assertIsNone(pipeline.resize_plan((200, 100), ('large', 1024, 1024, False)),
+                          'Images should never be enlarged')
+
+    def test_variants(self) -> None:
+        image = photo()
+        variants = pipeline.render_variants(image, SIZES)
+
+        self.assertEqual(list(variants), ['large', 'medium_large', 'medium', 'thumbnail'])
+        self.assertEqual({name: variant.size for name, variant in variants.items()},
+                         {'large': (1024, 768), 'medium_large': (768, 576),
+                          'medium': (300, 225), 'thumbnail': (150, 150)})
+
+        direct = np.asarray(image.resize((300, 225), Image.LANCZOS), dtype=int)
+        self.assertLess(np.abs(direct - np.asarray(variants['medium'], dtype=int)).mean(), 2,
+                        'Chained resizes should look like direct ones')
+
+    def test_process_attachment(self) -> None:
+        jpeg = BytesIO()
+        photo().save(jpeg, 'JPEG')
+        jpeg.seek(0)
+
+        variants = pipeline.process_attachment(jpeg, SIZES)
+
+        self.assertEqual(list(variants), [pipeline.FULL_SIZE, 'large', 'medium_large', 'medium', 'thumbnail'])
+        self.assertEqual(variants[pipeline.FULL_SIZE].getextrema()[0], (0, 255), 'Photos should be normalized')
+
+        jpeg.seek(0)
+        variants = pipeline.process_attachment(jpeg, SIZES, resize=False)
+        self.assertEqual(list(variants), [pipeline.FULL_SIZE])
+
+
+    def test_tiled_levels(self) -> None:
+        png = BytesIO()
+        photo((300, 200)).save(png, 'PNG')
+        expected = image_processing.levels(photo((300, 200)), clip=20).tobytes()
+
+        for blueprint, pixels in ((True, pipeline.TILED_LEVELS_PIXELS), (False, 300 * 200 - 1)):
+            png.seek(0)
+            with mock.patch.object(pipeline, 'TILED_LEVELS_PIXELS', pixels), \
+                    mock.patch.object(pipeline, 'auto_level', wraps=auto_level.auto_level) as tiled, \
+                    mock.patch.object(pipeline, 'open_levelled') as open_levelled:
+                variants = pipeline.process_attachment(png, SIZES, clip=20, blueprint=blueprint)
+
+            self.assertEqual(tiled.call_count, 1, 'Floor plans and huge scans should be levelled one tile at a time')
+            open_levelled.assert_not_called()
+            self.assertEqual(variants[pipeline.FULL_SIZE].tobytes(), expected)
+
+
+class WatermarkTests(unittest.TestCase):
+
+    @staticmethod
+    def mock_watermark() -> BytesIO:
+        # opaque white text box on a transparent, red background: red must never show through
+        mark = Image.new('RGBA', (200, 100), (255, 0, 0, 0))
+        mark.paste((255, 255, 255, 255), (20, 20, 180, 80))
+        source = BytesIO()
+        mark.save(source, 'PNG')
+        source.seek(0)
+        return source
+
+    def test_apply(self) -> None:
+        mark = watermark.Watermark(self.mock_watermark(), relative_width=0.5, relative_margin=0)
+        photo = Image.new('RGB', (400, 300), (0, 0, 0))
+
+        self.assertIs(mark.apply(photo), photo, 'Photos should be marked in place')
+        self.assertEqual(photo.getpixel((300, 250)), (255, 255, 255))
+        self.assertEqual(photo.getpixel((10, 10)), (0, 0, 0))
+        self.assertTrue(all(red <= green for red, green, _ in photo.getdata()),
+                        'Transparent pixels should not bleed into the photo')
+
+    def test_palette(self) -> None:
+        mark = watermark.Watermark(self.mock_watermark(), relative_width=0.5, relative_margin=0)
+        # as decoded from a GIF: a palette without white
+        photo = Image.new('RGB', (400, 300), (0, 0, 0)).convert('P', palette=Image.ADAPTIVE, colors=2)
+
+        marked = mark.apply(photo)
+
+        self.assertEqual(marked.mode, 'RGB')
+        self.assertEqual(marked.getpixel((300, 250)), (255, 255, 255), 'Palettes should not alter the watermark')
+        self.assertEqual(marked.getpixel((10, 10)), (0, 0, 0))
+
+        photo.info['transparency'] = 0
+        self.assertEqual(mark.apply(photo).mode, 'RGBA')
+
+    def test_scale_cache(self) -> None:
+        mark = watermark.Watermark(self.mock_watermark())
+
+        for _ in range(3):
+            mark.apply(Image.new('RGB', (800, 600)))
+            mark.apply(Image.new('L', (800, 600)))
+        mark.apply(Image.new('RGB', (400, 300)))
+
+        self.assertEqual(mark.scaled.cache_info().misses, 3, 'Watermarks should be scaled once per width and mode')
+
+    def test_pipeline(self) -> None:
+        with tempfile.TemporaryDirectory() as directory:
+            watermark_path = os.path.join(directory, 'watermark.png')
+            with open(watermark_path, 'wb') as watermark_file:
+                watermark_file.write(self.mock_watermark().read())
+
+            jpeg = BytesIO()
+            Image.new('RGB', (1600, 1200), (0, 0, 0)).save(jpeg, 'JPEG')
+            jpeg.seek(0)
+
+            variants = pipeline.process_attachment(jpeg, SIZES, normalize=False, watermark_path=watermark_path)
+
+        # a quarter of the width, half as high, 48% of it white
+        for name, variant in variants.items():
+            marked = np.asarray(variant.convert('L')) > 128
+            self.assertAlmostEqual(marked.mean(), 0.25 * 0.125 * 0.48 * variant.width / variant.height, delta=0.002,
+                                   msg='{} should carry a watermark scaled to its own width'.format(name))
+
+
+class DedupeTests(unittest.TestCase):
+
+    def test_dhash(self) -> None:
+        original = photo()
+        fingerprint = dedupe.dhash(original)
+
+        jpeg = BytesIO()
+        original.resize((800, 600), Image.LANCZOS).save(jpeg, 'JPEG', quality=50)
+        jpeg.seek(0)
+        self.assertLessEqual(dedupe.hamming(dedupe.dhash(jpeg), fingerprint), dedupe.DEFAULT_MAX_DISTANCE,
+                             'Resized and recompressed copies should hash alike')
+
+        mirrored = dedupe.dhash(original.transpose(Image.FLIP_LEFT_RIGHT))
+        self.assertGreater(dedupe.hamming(mirrored, fingerprint), dedupe.DEFAULT_MAX_DISTANCE)
+        self.assertLess(fingerprint, 2 ** 64)
+
+    def test_confirmation(self) -> None:
+
+        def floor_plan(*walls) -> Image:
+            plan = Image.new('L', (1200, 900), 255)
+            draw = ImageDraw.Draw(plan)
+            draw.rectangle((40, 40, 1160, 860), outline=0)
+            for wall in walls:
+                draw.line(wall, fill=0, width=6)
+            return plan
+
+        plan = dedupe.signature(floor_plan((400, 40, 400, 860), (40, 500, 400, 500)))
+        other = dedupe.signature(floor_plan((430, 40, 430, 860), (430, 300, 1160, 300)))
+        self.assertLessEqual(dedupe.hamming(plan.fingerprint, other.fingerprint), dedupe.DEFAULT_MAX_DISTANCE)
+        self.assertFalse(dedupe.same_photo(plan, other), 'Floor plans of close hashes should be told apart')
+
+        jpeg = BytesIO()
+        photo().resize((800, 600), Image.LANCZOS).save(jpeg, 'JPEG', quality=50)
+        jpeg.seek(0)
+        copy = dedupe.signature(jpeg)
+        self.assertEqual((copy.width, copy.height), (800, 600), 'The size should be the one of the file')
+        self.assertTrue(dedupe.same_photo(dedupe.signature(photo()), copy))
+        self.assertFalse(dedupe.same_photo(dedupe.signature(photo().crop((0, 0, 1600, 900))), copy))
+
+    def test_low_detail(self) -> None:
+        self.assertTrue(dedupe.low_detail(dedupe.dhash(Image.new('L', (640, 480), 230))))
+        self.assertTrue(dedupe.low_detail(dedupe.dhash(gradient('L', 0, 255, (640, 480)))))
+        self.assertFalse(dedupe.low_detail(dedupe.dhash(photo())))
+
+    def test_index(self) -> None:
+        random = np.random.RandomState(0)
+        index = dedupe.PerceptualIndex(max_distance=4)
+        hashes = {str(key): int(random.randint(0, 2 ** 62)) for key in range(500)}
+        for key, fingerprint in hashes.items():
+            index.add(key, fingerprint)
+
+        for flips in range(8):
+            fingerprint = hashes['42']
+            for bit in random.choice(64, flips, replace=False):
+                fingerprint ^= 1 << int(bit)
+
+            expected = min((dedupe.hamming(fingerprint, h), key) for key, h in hashes.items())
+            found = index.find(fingerprint)
+            self.assertEqual(found, expected[1] if expected[0] <= 4 else None,
+                             'Banded lookups should match a linear scan at {} flipped bits'.format(flips))
+
+        index.remove('42')
+        self.assertNotIn('42', index)
+        self.assertIsNone(index.find(hashes['42']))
+        self.assertEqual(len(index), 499)